@@ -1,9 +1,18 @@
+import logging
 import serial
+from serial_framing import Frame, Frame_Reader
+
+logger = logging.getLogger(__name__)
 
 ###################
 #  ARDUINO to USB  
 ###################
 
+# one CO2 line from the arduino (bytes, without the newline),
+# see serial_framing.py; raises ValueError if it is not an integer
+def parse_co2_line(line):
+    return {"CO2": int(line)}
+
 class Air_Sensor:
 
     # constructor
@@ -11,37 +20,44 @@ class Air_Sensor:
         self.com_port = com_port        #ex 'COM5'
         self.baud_rate = baud_rate        #ex 19200
         self.ser = ""
+        self.reader = Frame_Reader(parse_co2_line, com_port)
         self.connect_port()
     
     # read data from sensor
-    def read_data(self) -> int:
+    # the arduino only reports CO2, measure is accepted so it can be
+    # driven like the other sensor classes
+    # returns None if no reading came in time (nothing is recorded)
+    def read_data(self, measure="CO2") -> int:
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        return frame.get(measure)
+
+    # the newest line as a Frame of measure name -> value (see serial_framing.py)
+    # returns None if no complete line came in time or the port failed
+    def read_frame(self) -> Frame:
         try:
-            value = self.ser.readline()
-            valueInString=str(value, 'UTF-8')
-            if valueInString:
-                return(int(valueInString))
-            else:
-                return 600
+            return self.reader.read_frame(self.ser)
 
         except serial.SerialException as e:
-            print(f"Error reading data: {e}")
+            logger.error(f"Error reading data: {e}")
 
     # connect to port
     def connect_port(self) -> None:
         try:
             # Open the serial port
             self.ser = serial.Serial(self.com_port, self.baud_rate, timeout=1)
-            print("connected to: " + self.ser.portstr)
+            logger.info("connected to: " + self.ser.portstr)
 
         except serial.SerialException as e:
-            print(f"Error opening port: {e}")
+            logger.error(f"Error opening port: {e}")
 
     # disconnect from port
     def disconnect_port(self) -> None:
         try:
             # Close the serial port
             self.ser.close()
-            print("port successfully closed")
+            logger.info("port successfully closed")
 
         except serial.SerialException as e:
-            print(f"Error: {e}")
\ No newline at end of file
+            logger.error(f"Error: {e}")
\ No newline at end of file
@@ -1,17 +1,86 @@
-from flask import Flask, request, jsonify, abort
+from flask import Flask, Response, request, jsonify, abort
 from flask_jwt_extended import create_access_token, JWTManager, verify_jwt_in_request, get_jwt
 from functools import wraps
 import json
+import logging
 import os
 from bson import json_util, ObjectId
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from sys_state import Sys_State
 import time
 from datetime import datetime, timedelta
 from db_config import user_collection, sensor_collection, settings_collection
 import jwt
 import secrets
+import queue
+from downsample import bucket_pipeline, rollup_pipeline, bucket_ms_for, lttb, merge_buckets, MAX_POINTS_LIMIT
+from rollups import bucket_start, rollup_bucket_ms
+from export import export_stream, EXPORT_FORMATS
+from run_archive import series_buckets, series_documents
+from query_cache import Cached_Result, cache_key, is_past
+from metrics import gauge, histogram, render
+
+logger = logging.getLogger(__name__)
+
+# readings waiting to be pushed to socket clients, older readings
+# are dropped when clients cannot keep up so acquisition never waits
+PUSH_QUEUE_SIZE = 10000
+
+# reading times are stored as naive UTC datetimes
+EPOCH = datetime(1970, 1, 1)
+
+# /metrics
+SOCKET_CLIENTS = gauge("socketio_connected_clients", "Connected Socket.IO clients")
+EMIT_SECONDS = histogram("socketio_emit_seconds", "Time to emit one Socket.IO event", ["event"])
+PUSH_QUEUE_DEPTH = gauge("socketio_push_queue_depth", "Readings waiting to be pushed to socket clients")
+
+#----------------------------------------------------------------------------------------
+#   JSON responses for documents straight from Mongo
+#
+#   json_response encodes ObjectId and datetime while the payload is
+#   encoded, in a single json.dumps pass written into the response body
+#   (no json_util.dumps -> json.loads -> jsonify round trip). The output
+#   is the same relaxed extended JSON json_util produces:
+#       ObjectId  {"$oid": "..."}
+#       datetime  {"$date": "2025-04-17T16:35:05.212Z"}
+#   With compact=True datetimes are sent as epoch milliseconds instead,
+#   which is smaller and needs no date parsing in the browser.
+#   Any other BSON type falls back to json_util.
+#----------------------------------------------------------------------------------------
+
+# milliseconds since the epoch of a naive UTC or an aware datetime
+def epoch_ms(value) -> int:
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None) - value.utcoffset()
+    delta = value - EPOCH
+    return delta.days * 86400000 + delta.seconds * 1000 + delta.microseconds // 1000
+
+def bson_default(value):
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.replace(tzinfo=None) - value.utcoffset()
+        if value < EPOCH:
+            return {"$date": {"$numberLong": str(epoch_ms(value))}}
+        millis = value.microsecond // 1000
+        fraction = f".{millis:03d}" if millis else ""
+        return {"$date": f"{value.isoformat(timespec='seconds')}{fraction}Z"}
+    return json_util.default(value)
+
+def compact_bson_default(value):
+    if isinstance(value, datetime):
+        return epoch_ms(value)
+    return bson_default(value)
+
+def json_response(payload, compact=False, status=200) -> Response:
+    body = json.dumps(payload, default=compact_bson_default if compact else bson_default, separators=(",", ":"))
+    return Response(body, status=status, mimetype="application/json")
+
+# compact output is requested with ?compact=1 (or true/yes)
+def compact_requested() -> bool:
+    return request.args.get("compact", "").lower() in ("1", "true", "yes")
 
 class Flask_App():
     # Shared with main
@@ -34,6 +103,10 @@ class Flask_App():
         self.app.config["JWT_COOKIE_SAMESITE"] = "Strict"
         self.jwt = JWTManager(self.app)
 
+        # live push of new readings, see push_reading
+        self.push_queue = queue.Queue(maxsize=PUSH_QUEUE_SIZE)
+        PUSH_QUEUE_DEPTH.set_function(self.push_queue.qsize)
+
         ##############################################################
         #
         #   WORKING ON USER ROLES / PERMS
@@ -76,7 +149,6 @@ class Flask_App():
             user = user_collection.find_one({'email': email})     # looks up the username in the db
 
             if user and ( password == user['password'] ):    # checks password
-                print("im making a token now....")
                 token = create_access_token(
                     identity=str(user['_id']), 
                     additional_claims={
@@ -84,7 +156,7 @@ class Flask_App():
                         'firstName': user['firstName'],
                         'last_name': user['lastName']
                 })   # if successful, create token
-                print("i made a token!")
+                logger.debug(f"token issued for {email}")
                 response = jsonify({'message': 'Login successful'})
                 response = jsonify({
                     'message': 'Login successful',
@@ -102,7 +174,7 @@ class Flask_App():
         @self.app.route("/user_authen/", methods=["POST"])
         def user_authen():
             credentials = request.json
-            print(credentials.get("userEmail"))
+            logger.debug(f"authenticating {credentials.get('userEmail')}")
             user = user_collection.find_one({"email": credentials.get("userEmail")})
             if not user:
                 return {"success": False, "message": "User does not exist"}
@@ -120,30 +192,95 @@ class Flask_App():
         @self.app.route("/sensors", methods=["GET"])
         def get_sensors():
             sensors_cursor = sensor_collection.find()
-            # Convert documents to JSON format using bson's json_util
-            json_sensors = list(map(lambda x: json.loads(json_util.dumps(x)), sensors_cursor))
-            return jsonify({"sensors": json_sensors})
+            return json_response({"sensors": list(sensors_cursor)}, compact_requested())
         
         # This route returns a list of the system settings from the settings collection
         @self.app.route("/settings", methods=["GET"])
         def get_settings():
-            settings_cursor = settings_collection.find()
-            # Convert documents to JSON format using bson's json_util
-            json_settings = list(map(lambda x: json.loads(json_util.dumps(x)), settings_cursor))
-            print(json_settings)
-            return jsonify({"settings": json_settings})
+            settings_list = list(settings_collection.find())
+            return json_response({"settings": settings_list}, compact_requested())
         
         # This route returns the reset settings variable in the system state, determines if the backend has reset and is ready
         @self.app.route("/backend_ready", methods=["GET"])
         def backend_ready():
             reset_sensors = self.state.get("reset sensors")
             return jsonify({"backend_reset": reset_sensors})
+
+        # This route returns the storage writer queue depth, flush latency and rows/sec
+        @self.app.route("/storage_stats", methods=["GET"])
+        def storage_stats():
+            storage_writer = self.state.get_ref("Storage Writer")
+            if storage_writer is None:
+                return jsonify({"message": "Storage writer not running"}), 404
+            return jsonify({"storage": storage_writer.stats()})
+
+        # This route returns the anomaly check counters and the rules active per sensor
+        @self.app.route("/check_stats", methods=["GET"])
+        def check_stats():
+            checker = self.state.get_ref("Check Data")
+            if checker is None:
+                return jsonify({"message": "Anomaly checks not running"}), 404
+            return jsonify({"check_data": checker.stats()})
+
+        # This route returns the analysis query cache hits/misses, hit ratio and memory
+        @self.app.route("/analysis_cache", methods=["GET"])
+        def analysis_cache_stats():
+            cache = self.state.get_ref("Query Cache")
+            if cache is None:
+                return jsonify({"message": "Analysis cache disabled"}), 404
+            return jsonify({"analysis_cache": cache.stats()})
+
+        # This route empties the analysis query cache (readings stored late, see query_cache.py)
+        @self.app.route("/analysis_cache", methods=["DELETE"])
+        @require_role(["admin"])
+        def clear_analysis_cache():
+            cache = self.state.get_ref("Query Cache")
+            if cache is None:
+                return jsonify({"message": "Analysis cache disabled"}), 404
+            cache.clear()
+            return jsonify({"message": "Analysis cache cleared"})
+
+        # Prometheus metrics: sensor reads, storage, Sys_State lock, mail, Socket.IO (see metrics.py)
+        @self.app.route("/metrics", methods=["GET"])
+        def get_metrics():
+            return Response(render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+        # This route returns the Sys_State lock profile: wait/hold times per key and caller,
+        # flagged slow waits with the lock holder and get() copy sizes (see sys_state.py)
+        @self.app.route("/lock_profile", methods=["GET"])
+        @require_role(["admin"])
+        def lock_profile():
+            profile = self.state.lock_profile()
+            if profile is None:
+                return jsonify({"message": "Lock profiling was not started"}), 404
+            return jsonify({"lock_profile": profile})
+
+        # This route starts (a new profile) or stops lock profiling
+        # body: {"enabled": true/false, "threshold_ms": slow wait threshold}
+        @self.app.route("/lock_profile", methods=["PATCH"])
+        @require_role(["admin"])
+        def set_lock_profile():
+            data = request.get_json(silent=True) or {}
+            if data.get("enabled", True):
+                threshold = data.get("threshold_ms")
+                try:
+                    self.state.start_profiling(None if threshold is None else float(threshold) / 1000)
+                except (TypeError, ValueError):
+                    return jsonify({"message": "threshold_ms must be a number"}), 400
+                return jsonify({"message": "Lock profiling started"})
+            self.state.stop_profiling()
+            return jsonify({"message": "Lock profiling stopped"})
+
+        # This route returns how long applying new sensor settings took (hot reconfiguration)
+        @self.app.route("/reconfigure_stats", methods=["GET"])
+        def reconfigure_stats():
+            return jsonify({"reconfiguration": self.state.get("Reconfiguration Stats")})
         
         @self.app.route("/config_sensors", methods=["PATCH"])
         @require_role(["admin"])
         def config_sensors():
             data = request.json['data']
-            print(data)
+            logger.debug(f"sensor configuration: {data}")
             if not data:
                 return jsonify({"message": "You must include all sensor data"}), 400
             try:
@@ -163,6 +300,8 @@ class Flask_App():
                     {},  # Empty query to target the first (and only) document
                     {'$set': {'start_date': datetime.now()}}  # Set 'system_state' to 'running'
                 )
+                # wake main if it is waiting for a run
+                self.state.set("state", "running")
             except Exception as e:
                 return jsonify({"message": str(e)}), 400
             return jsonify({"message": "Sensors Configured!"}), 201
@@ -194,7 +333,7 @@ class Flask_App():
                 sensor_collection.update_one(sensor_id, update)
                 # Flip the flag
                 self.state.set("New Settings", True)
-                print("flipped flag")
+                logger.info("sensor ranges changed, new settings flagged")
                 return jsonify({"message": "Sensor ranges updated."}), 200
             except Exception as e:
                 return jsonify({"message": str(e)}), 400
@@ -215,7 +354,7 @@ class Flask_App():
                 update = {"$set": {"read_frequency": int(frequency)}}
                 settings_collection.update_one(setting_id, update)
                 self.state.set("Read Frequency", int(frequency))
-                print("frequency has been updated")
+                logger.info(f"read frequency set to {int(frequency)}")
 
                 return jsonify({"message": "Sensor range updated."}), 200
             except Exception as e:
@@ -239,23 +378,23 @@ class Flask_App():
             current_run_number = current_setting[0]['run_number']
             update = {"$set": {"run_number": current_run_number+1}}
             settings_collection.update_one({"_id": setting_id}, update)
-            print("run has been stopped")
-            print(self.state.get("terminate"))
+            logger.info("run has been stopped")
             return jsonify({"message": "Run has been stopped"}), 200            
 
         ####################################################################
         #                        ANALYSIS TOOL ROUTES
         ####################################################################
 
-        @self.app.route("/analysis_query/", methods=["POST"])
-        def analysis_query():
-            filters = request.json     # Get the filters
+        # Resolves the analysis filters to the sensors to query and the time range
+        # Returns a list of (Sensor List key, sensor wrapper) pairs, the range
+        # start and the range end (None when the range is open ended)
+        def resolve_analysis_filters(filters):
             tankFilter = filters.get("selectedTank").strip()
             sensorFilter = filters.get("selectedSensor").strip()
             measureFilter = filters.get("selectedMeasure").strip()
             startDateFilter = filters.get("formattedStart").strip()
             endDateFilter = filters.get("formattedEnd").strip()
-            print(tankFilter, sensorFilter, startDateFilter, endDateFilter)
+            logger.debug(f"analysis filters: {tankFilter} {sensorFilter} {startDateFilter} {endDateFilter}")
 
             if tankFilter == "all" and sensorFilter == "all":     # Get sensor id list based on filters
                 sensor_ids_cursor = sensor_collection.find({}, {"_id": 1})
@@ -268,34 +407,238 @@ class Flask_App():
 
             sensor_ids_list = list(sensor_ids_cursor)
             sensor_ids = [sensor['_id'] for sensor in sensor_ids_list]
-            print(sensor_ids)
 
-            result_data = {}
+            matches = []
             Sensor_List = self.state.get("Sensor List")
             for sensor in sensor_ids:
                 for sensor_id, sensor_data in Sensor_List.items():
                     if sensor == sensor_data["id"] and ( measureFilter == "all" or sensor_data["measure"] == measureFilter ):
-                        collection = sensor_data["db"]
-                        if startDateFilter == "0" and endDateFilter == "0":
-                            # Get start data
-                            settings = settings_collection.find_one()
-                            start_date = settings['start_date']
-                            measurements_cursor = collection.find({"time": {"$gte": start_date}})
-                        elif endDateFilter == "0":
-                            tempEndFilter = startDateFilter[:11] + "23:59:59.999Z"
-                            startDate = datetime.strptime(startDateFilter, "%Y-%m-%dT%H:%M:%S.%fZ")
-                            tempEnd = datetime.strptime(tempEndFilter, "%Y-%m-%dT%H:%M:%S.%fZ")
-                            measurements_cursor = collection.find({"time": {"$gte": startDate, "$lt": tempEnd}})
-                        else:
-                            startDate = datetime.strptime(startDateFilter, "%Y-%m-%dT%H:%M:%S.%fZ")
-                            endDate = datetime.strptime(endDateFilter, "%Y-%m-%dT%H:%M:%S.%fZ")
-                            measurements_cursor = collection.find({"time": {"$gte": startDate, "$lt": endDate}})
-                        measurements_list = list(measurements_cursor)
-                        if measurements_list:
-                            result_data[sensor_id] = measurements_list
-
-            json_data = json.loads(json_util.dumps(result_data))
-            return jsonify({"sensor_data": json_data})
+                        matches.append((sensor_id, sensor_data))
+
+            if startDateFilter == "0" and endDateFilter == "0":
+                # Get start data
+                settings = settings_collection.find_one()
+                startDate = settings['start_date']
+                endDate = None
+            elif endDateFilter == "0":
+                tempEndFilter = startDateFilter[:11] + "23:59:59.999Z"
+                startDate = datetime.strptime(startDateFilter, "%Y-%m-%dT%H:%M:%S.%fZ")
+                endDate = datetime.strptime(tempEndFilter, "%Y-%m-%dT%H:%M:%S.%fZ")
+            else:
+                startDate = datetime.strptime(startDateFilter, "%Y-%m-%dT%H:%M:%S.%fZ")
+                endDate = datetime.strptime(endDateFilter, "%Y-%m-%dT%H:%M:%S.%fZ")
+            return matches, startDate, endDate
+
+        # Mongo filter on "time" for a range from resolve_analysis_filters
+        def time_query(range_start, range_end):
+            query = {"$gte": range_start}
+            if range_end is not None:
+                query["$lt"] = range_end
+            return query
+
+        # Optional downsampling parameters of an analysis request
+        # resolution: bucket width in seconds
+        # max_points: upper bound on points per sensor
+        # downsample: "buckets" (default, min/max/mean/count) or "lttb"
+        def parse_downsampling(filters):
+            resolution = filters.get("resolution")
+            max_points = filters.get("max_points")
+            method = filters.get("downsample", "buckets")
+            if resolution is not None:
+                resolution = float(resolution)
+                if resolution <= 0:
+                    raise ValueError("resolution must be positive")
+            if max_points is not None:
+                max_points = min(max(int(max_points), 3), MAX_POINTS_LIMIT)
+            if method not in ("buckets", "lttb"):
+                raise ValueError("downsample must be 'buckets' or 'lttb'")
+            return resolution, max_points, method
+
+        # Buckets of bucket_ms of one sensor in the range
+        # The rollups only answer the buckets strictly between the first and
+        # the last rollup document of the range: those are complete, while
+        # the readings before (older than the rollups, migrated runs) and
+        # after (the last rollup bucket, the one still open) are aggregated
+        # from the raw readings. The three parts never share a bucket.
+        def query_buckets(sensor_data, range_start, range_end, bucket_ms):
+            store = self.state.get_ref("Readings Store")
+
+            def raw_buckets(start, end):
+                query = store.query(sensor_data, time_query(start, end))
+                return list(sensor_data["db"].aggregate(bucket_pipeline(query, bucket_ms)))
+
+            rollups = self.state.get_ref("Rollups")
+            rollup_collection = rollups.collection_for(bucket_ms) if rollups is not None else None
+            if rollup_collection is None:
+                return raw_buckets(range_start, range_end)
+            query = store.rollup_query(sensor_data, time_query(range_start, range_end))
+            first = list(rollup_collection.find(query, {"time": 1}).sort("time", 1).limit(1))
+            last = list(rollup_collection.find(query, {"time": 1}).sort("time", -1).limit(1))
+            if not first:
+                return raw_buckets(range_start, range_end)
+            # the rollup buckets are aligned with the ones asked for (bucket_ms
+            # is a multiple of their width), cut on the bucket_ms boundaries
+            covered_start = bucket_start(first[0]["time"], bucket_ms // 1000) + timedelta(milliseconds=bucket_ms)
+            covered_end = bucket_start(last[0]["time"], bucket_ms // 1000)
+            if covered_start >= covered_end:
+                return raw_buckets(range_start, range_end)
+            query = store.rollup_query(sensor_data, time_query(covered_start, covered_end))
+            return raw_buckets(range_start, covered_start) \
+                + list(rollup_collection.aggregate(rollup_pipeline(query, bucket_ms))) \
+                + raw_buckets(covered_end, range_end)
+
+        # Archived (times, values) of one sensor in the range, None if the archive has none
+        def archived_range(sensor_data, range_start, range_end):
+            archive = self.state.get_ref("Run Archive")
+            if archive is None:
+                return None
+            archived = archive.series_range(sensor_data["id"], sensor_data["measure"], range_start, range_end)
+            return archived if len(archived[0]) else None
+
+        # Time sorted {time, value} readings of one sensor in the range
+        def query_series(sensor_data, range_start, range_end):
+            query = self.state.get_ref("Readings Store").query(sensor_data, time_query(range_start, range_end))
+            readings = list(sensor_data["db"].find({**query, "value": {"$exists": True}}, {"_id": 0, "time": 1, "value": 1}).sort("time", 1))
+            archived = archived_range(sensor_data, range_start, range_end)
+            if archived is not None:
+                readings = sorted(series_documents(*archived) + readings, key=lambda reading: reading["time"])
+            return readings
+
+        # Bucket width (ms) fitting first..last in max_points buckets
+        # rounded up to whole minutes so the rollups can answer, or to
+        # whole seconds, so the width of a live range only changes every
+        # few hundred readings and its cached buckets can be extended
+        def bucket_width(first, last, max_points):
+            bucket_ms = bucket_ms_for(first, last, max_points)
+            if bucket_ms >= 60000:
+                return rollup_bucket_ms(bucket_ms)
+            if bucket_ms >= 1000:
+                return -(-bucket_ms // 1000) * 1000
+            return bucket_ms
+
+        # Readings of one sensor in the range, downsampled if requested, as a
+        # Cached_Result (query_cache.py)
+        # Archived runs are read from the run archive, the rest from MongoDB
+        # Buckets of a minute or more come from the rollups when they exist
+        def compute_readings(sensor_data, range_start, range_end, resolution, max_points, method):
+            immutable = is_past(range_end)
+            collection = sensor_data["db"]
+            query = self.state.get_ref("Readings Store").query(sensor_data, time_query(range_start, range_end))
+            archived = archived_range(sensor_data, range_start, range_end)
+
+            if resolution is None and max_points is None:
+                readings = list(collection.find(query))
+                if archived is not None:
+                    readings = series_documents(*archived, sensor_data["id"]) + readings
+                tail = max((reading["time"] for reading in readings), default=None)
+                return Cached_Result("raw", readings, readings, immutable, tail)
+
+            if method == "lttb" and resolution is None:
+                readings = query_series(sensor_data, range_start, range_end)
+                tail = readings[-1]["time"] if readings else None
+                return Cached_Result("lttb", readings, lttb(readings, max_points), immutable, tail, max_points=max_points)
+
+            first = last = None
+            if resolution is not None:
+                bucket_ms = resolution * 1000
+            else:
+                # size the buckets on the readings actually in the range
+                first = list(collection.find(query, {"time": 1}).sort("time", 1).limit(1))
+                last = list(collection.find(query, {"time": 1}).sort("time", -1).limit(1))
+                bounds = [first[0]["time"], last[0]["time"]] if first else []
+                if archived is not None:
+                    bounds += [archived[0][0].item(), archived[0][-1].item()]
+                if not bounds:
+                    return Cached_Result("buckets", [], [], immutable, max_points=max_points)
+                first, last = min(bounds), max(bounds)
+                bucket_ms = bucket_width(first, last, max_points)
+
+            buckets = query_buckets(sensor_data, range_start, range_end, bucket_ms)
+            if archived is not None:
+                buckets = merge_buckets(series_buckets(*archived, bucket_ms), buckets)
+            tail = buckets[-1]["time"] if buckets else None
+            return Cached_Result("buckets", buckets, buckets, immutable, tail, first, last, bucket_ms, max_points)
+
+        # Readings of one sensor in the range, downsampled if requested
+        # Through the analysis cache: a past range is answered from it, a
+        # live one is extended with the readings from the cached tail on
+        def query_readings(sensor_data, range_start, range_end, resolution, max_points, method):
+            cache = self.state.get_ref("Query Cache")
+            if cache is None:
+                return compute_readings(sensor_data, range_start, range_end, resolution, max_points, method).result
+            key = cache_key(sensor_data, range_start, range_end, resolution, max_points, method)
+            entry = cache.lookup(key)
+            if entry is not None and entry.immutable:
+                cache.count("hit")
+                return entry.result
+            if entry is not None:
+                immutable = is_past(range_end)
+                cut = entry.cut(range_start)
+                if entry.kind == "raw":
+                    query = self.state.get_ref("Readings Store").query(sensor_data, time_query(cut, range_end))
+                    fresh = list(sensor_data["db"].find(query))
+                    archived = archived_range(sensor_data, cut, range_end)
+                    if archived is not None:
+                        fresh = series_documents(*archived, sensor_data["id"]) + fresh
+                else:
+                    fresh = query_series(sensor_data, cut, range_end)
+                entry = entry.extended(fresh, cut, bucket_width, immutable)
+                if entry is not None:
+                    cache.store(key, entry)
+                    cache.count("extended")
+                    return entry.result
+            cache.count("miss")
+            entry = compute_readings(sensor_data, range_start, range_end, resolution, max_points, method)
+            cache.store(key, entry)
+            return entry.result
+
+        @self.app.route("/analysis_query/", methods=["POST"])
+        def analysis_query():
+            filters = request.json     # Get the filters
+            try:
+                resolution, max_points, method = parse_downsampling(filters)
+            except (TypeError, ValueError) as e:
+                return jsonify({"message": str(e)}), 400
+            matches, range_start, range_end = resolve_analysis_filters(filters)
+
+            result_data = {}
+            for sensor_id, sensor_data in matches:
+                measurements_list = query_readings(sensor_data, range_start, range_end, resolution, max_points, method)
+                if measurements_list:
+                    result_data[sensor_id] = measurements_list
+
+            return json_response({"sensor_data": result_data}, compact_requested())
+
+        # Streams the raw readings matching the analysis filters as a download
+        # Same filters as /analysis_query/ plus
+        # format: "ndjson" (default) or "csv"
+        # gzip: true to gzip compress the file
+        @self.app.route("/analysis_export/", methods=["POST"])
+        def analysis_export():
+            filters = request.json     # Get the filters
+            export_format = filters.get("format", "ndjson")
+            if export_format not in EXPORT_FORMATS:
+                return jsonify({"message": "format must be 'ndjson' or 'csv'"}), 400
+            compress = bool(filters.get("gzip", False))
+            matches, range_start, range_end = resolve_analysis_filters(filters)
+
+            store = self.state.get_ref("Readings Store")
+            archive = self.state.get_ref("Run Archive")
+            sources = []
+            for sensor_id, sensor_data in matches:
+                query = store.query(sensor_data, time_query(range_start, range_end))
+                # archived runs stream from the run archive, chunk by chunk
+                archived = archive.chunks(sensor_data["id"], sensor_data["measure"], range_start, range_end) if archive is not None else ()
+                sources.append((sensor_id, sensor_data, sensor_data["db"], query, archived))
+
+            mimetype, extension = EXPORT_FORMATS[export_format]
+            filename = f"analysis_export.{extension}"
+            if compress:
+                mimetype = "application/gzip"
+                filename += ".gz"
+            response = Response(export_stream(sources, export_format, compress), mimetype=mimetype)
+            response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+            return response
 
         ####################################################################
         #                        USER PAGE ROUTES -- talk to user collection
@@ -305,8 +648,7 @@ class Flask_App():
         @self.app.route("/users", methods=["GET"])
         def get_users():
             users_cursor = user_collection.find()
-            json_users = list(map(lambda x: json.loads(json_util.dumps(x)), users_cursor))
-            return jsonify({"users": json_users})
+            return json_response({"users": list(users_cursor)}, compact_requested())
 
         @self.app.route("/create_user", methods=["POST"])
         def create_user():
@@ -324,6 +666,7 @@ class Flask_App():
             if user_collection.find_one({"username": email}):
                 return jsonify({"message": "User already exists"}), 400
             user_collection.insert_one({"firstName": firstName, "lastName": lastName, "email": email, "password": password, "role": role, "notifs": notifs})
+            self.invalidate_recipients()
             return jsonify({"message": "User created successfully"}), 201
 
         @self.app.route("/update_user/<id>", methods=["PATCH"])
@@ -339,6 +682,7 @@ class Flask_App():
             # Define the update operation
             update = {"$set": data}  # Use $set to update the specified fields
             user_collection.update_one(user_id, update)
+            self.invalidate_recipients()
 
             return jsonify({"message": "User updated."}), 200
 
@@ -351,6 +695,7 @@ class Flask_App():
                 return jsonify({"message": "User not found"}), 404
 
             result = user_collection.delete_one(user_id)
+            self.invalidate_recipients()
             return jsonify({"message": "User deleted!"}), 200
         
         # This route returns the settings of a user
@@ -374,7 +719,8 @@ class Flask_App():
             #print("Client connected via WebSocket")
             client_ip = request.remote_addr
             sid = request.sid
-            print(f"🔵 New WebSocket Connection Attempt: {sid} from {client_ip}")
+            SOCKET_CLIENTS.inc()
+            logger.debug(f"WebSocket connected: {sid} from {client_ip}")
 
             # Store connected clients if needed (for debugging)
             #if not hasattr(client_connect, "clients"):
@@ -385,48 +731,61 @@ class Flask_App():
 
         @self.socketio.on('message')
         def client_message(data):
-            print(f"Received WebSocket message: {data}")
+            logger.debug(f"Received WebSocket message: {data}")
             emit('response', {"message": "Hello from WebSocket!"}, broadcast=True)  # Send a response
 
+        # Push mode: clients join a room and get one "reading" event per new reading
+        # request is "home" for every sensor or a sensor id for that sensor only
+        @self.socketio.on('subscribe')
+        def subscribe(data):
+            join_room(push_room(data.get("request")))
+
+        @self.socketio.on('unsubscribe')
+        def unsubscribe(data):
+            leave_room(push_room(data.get("request")))
+
+        def push_room(client_request):
+            if client_request == "home":
+                return "home"
+            return f"sensor-{client_request}"
+
+        # broadcast emit, timed in socketio_emit_seconds under kind
+        # (the event name of a single sensor includes its name)
+        def timed_emit(kind, event, payload):
+            start = time.perf_counter()
+            emit(event, payload, broadcast=True)
+            EMIT_SECONDS.labels(event=kind).observe(time.perf_counter() - start)
+
+        # Legacy polled events, answer with whatever has been read so far
         @self.socketio.on('packet')
         def send_packet(data):
 
             # in system state, in the Sensor List, iterate through the sensors and return the timestamps and data
+            # each sensor's readings are sent as {"time": [...], "value": [...]} columns
+            # optional "last" (newest N readings) and "since" (epoch seconds) limit them
             Sensor_List = self.state.get("Sensor List")
             newData = {}
             client_request = data.get("request")
+            last = data.get("last")
+            since = data.get("since")
 
             if client_request == "home":
                 for sensor_id, sensor_data in Sensor_List.items():
-                    formatted_readings = []
-                    while "recent readings" not in sensor_data or not sensor_data["recent readings"]:
-                        print("Waiting for recent readings...")
-                        time.sleep(1)  # Wait 1 second before checking again
-                    for reading in sensor_data["recent readings"]:
-                        formatted_readings.append({
-                            "time": reading["time"],
-                            "value": reading["value"]
-                        })
-
-                    newData[sensor_id] = formatted_readings # Store in the newData w/ sensor name        
-                emit('packet_home', {"packet_data": newData}, broadcast=True)
+                    if not sensor_data["readings"].current_reading():
+                        continue  # not read yet, never wait for it
+                    # only locks this one sensor
+                    newData[sensor_id] = sensor_data["readings"].recent_columns(last, since) # Store in the newData w/ sensor name
+                timed_emit('packet_home', 'packet_home', {"packet_data": newData})
             else:
                 all_measurements = {}
                 for sensor_name_measure, sensor_data in Sensor_List.items():
                     if str(sensor_data["id"]) == client_request:
                         sensor_name = sensor_data["name"]  # Get the sensor name
-                        formatted_readings = []
-                        while "recent readings" not in sensor_data or not sensor_data["recent readings"]:
-                            print("Waiting for recent readings...")
-                            time.sleep(1)  # Wait 1 second before checking again
-                        for reading in sensor_data["recent readings"]:
-                            formatted_readings.append({
-                                "time": reading["time"],
-                                "value": reading["value"]
-                            })
-                        all_measurements[sensor_name_measure] = formatted_readings
+                        if not sensor_data["readings"].current_reading():
+                            continue  # not read yet, never wait for it
+                        all_measurements[sensor_name_measure] = sensor_data["readings"].recent_columns(last, since)
                 packet = f"packet-{sensor_name}"
-                emit(packet, {"packet_data": all_measurements}, broadcast=True)
+                timed_emit('packet', packet, {"packet_data": all_measurements})
                   
 
         @self.socketio.on('update')
@@ -439,33 +798,31 @@ class Flask_App():
             if client_request == "home":
                 for sensor_id, sensor_data in Sensor_List.items():
                     sensor_name = sensor_data["name"]  # Get the sensor name
-                    while "current reading" not in sensor_data or not sensor_data["current reading"]:
-                        print("Waiting for current reading...")
-                        time.sleep(1)  # Delay to avoid tight loop
-                    reading = sensor_data["current reading"]
+                    if not sensor_data["readings"].current_reading():
+                        continue  # not read yet, never wait for it
+                    reading = sensor_data["readings"].current_reading()
                     newData[sensor_id] = ({
                         "time": reading["time"],
                         "value": reading["value"]
                     }) # Store in the newData w/ sensor name
-                emit('update_home', {"update_data": newData}, broadcast=True)
+                timed_emit('update_home', 'update_home', {"update_data": newData})
             else:
                 all_readings = {}
                 for sensor_name_measure, sensor_data in Sensor_List.items():
                     if str(sensor_data["id"]) == client_request:
                         sensor_name = sensor_data["name"]  # Get the sensor name
-                        while "current reading" not in sensor_data or not sensor_data["current reading"]:
-                            print("Waiting for current reading...")
-                            time.sleep(1)  # Delay to avoid tight loop
-                        all_readings[sensor_name_measure] = sensor_data["current reading"]
+                        if not sensor_data["readings"].current_reading():
+                            continue  # not read yet, never wait for it
+                        all_readings[sensor_name_measure] = sensor_data["readings"].current_reading()
                 update = f"update-{sensor_name}"
-                print("update name:", update)
-                emit(update, {"update_data": all_readings}, broadcast=True)
+                timed_emit('update', update, {"update_data": all_readings})
 
         @self.socketio.on('disconnect')
         def client_disconnect():
             #print("Client disconnected from WebSocket")
             sid = request.sid
-            print(f"🔴 Client disconnected: {sid}")
+            SOCKET_CLIENTS.dec()
+            logger.debug(f"WebSocket disconnected: {sid}")
 
             # Remove client from set
             #if hasattr(client_connect, "clients"):
@@ -478,7 +835,7 @@ class Flask_App():
         @self.app.route('/shutdown', methods=['POST'])
         def shutdown():
             def stop_server():
-                print("Server is shutting down...")
+                logger.info("Server is shutting down...")
                 os._exit(0)  # Forcefully terminate the process
 
             self.socketio.start_background_task(stop_server)
@@ -486,8 +843,47 @@ class Flask_App():
 
     # Method to run the app - used in main
     def run_app(self):
+        self.socketio.start_background_task(self._push_loop)
         self.socketio.run(self.app, debug=False) 
 
+    # Queue a new reading for the subscribed clients
+    # Called from the acquisition side for every committed reading,
+    # never blocks: if the queue is full its oldest reading is dropped
+    # (still stored and served by the packet/update events)
+    def push_reading(self, sensor_wrapper, reading):
+        while True:
+            try:
+                self.push_queue.put_nowait((sensor_wrapper, reading))
+                return
+            except queue.Full:
+                try:
+                    self.push_queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    # The user collection changed, the alert recipients are reloaded
+    # in the background (see recipients.py)
+    def invalidate_recipients(self):
+        recipients = self.state.get_ref("Recipients")
+        if recipients is not None:
+            recipients.invalidate()
+
+    # Emits one small delta event per reading to the home room and the
+    # room of that sensor, each client gets it once even if in both rooms
+    def _push_loop(self):
+        while True:
+            sensor_wrapper, reading = self.push_queue.get()
+            start = time.perf_counter()
+            self.socketio.emit("reading", {
+                "sensor": f"{sensor_wrapper['name']}-{sensor_wrapper['measure']}",
+                "id": str(sensor_wrapper["id"]),
+                "name": sensor_wrapper["name"],
+                "measure": sensor_wrapper["measure"],
+                "time": reading["time"],
+                "value": reading["value"]
+            }, to=["home", f"sensor-{sensor_wrapper['id']}"])
+            EMIT_SECONDS.labels(event="reading").observe(time.perf_counter() - start)
+
 
 # Code to run the app - without main
 if __name__ == '__main__':
@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime
+import serial
+from metrics import histogram
+from serial_framing import Frame
+
+logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------------------------------------
+#   asyncio acquisition engine
+#
+#   Alternative to the thread-per-device/measure mode in main.py.
+#   One thread runs one event loop that drives every device:
+#       - each device gets a task with its own schedule, reads are due
+#         at fixed multiples of Read Frequency from the start instead of
+#         "read time + sleep", so the schedule does not drift
+#       - serial ports are watched with loop.add_reader, bytes are read
+#         as they arrive and split into lines without blocking the loop
+#         (ports without a file descriptor, e.g. on Windows, are read
+#         in the default executor instead)
+#       - sensors without a port (Random_Test_Sensor) are read inline
+#       - frames go through an asyncio queue to a consumer task, which
+#         hands each measure to record_reading (storage and broadcast)
+#   stop() wakes every task immediately, so shutdown/reset do not wait
+#   for a sleep to run out. add_devices/remove_devices start and stop
+#   single devices while the others keep running (hot reconfiguration).
+#----------------------------------------------------------------------------------------
+
+# seconds to wait for the next frame of a serial device before skipping a read
+READ_TIMEOUT = 1.0
+
+# frames waiting for the consumer before device tasks start to wait
+QUEUE_SIZE = 10000
+
+# /metrics, shared with the threaded engine in main.py
+READ_SECONDS = histogram("sensor_read_seconds", "Time to read one value or frame from a sensor", ["sensor"])
+
+class Async_Engine:
+
+    # state is the system state (for Read Frequency), record is called
+    # as record(sensor_wrapper, value, read_time) for every measure
+    def __init__(self, state, record) -> None:
+        self.state = state
+        self.record = record
+        self.loop = None
+        self.thread = None
+        self.stopping = None
+        self.frames = None
+        self.tasks = {}     # id of the sensor object -> device task
+        self.started = threading.Event()
+
+    # run the event loop on its own thread
+    # devices is a list of wrapper lists, each list sharing one sensor object
+    def start(self, devices) -> None:
+        self.started.clear()
+        self.thread = threading.Thread(target=self._run, args=[devices], daemon=True)
+        self.thread.start()
+        self.started.wait()
+
+    # stop every device task and wait for queued readings to be recorded
+    def stop(self) -> None:
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join()
+        self.thread = None
+
+    # start more devices on the running loop
+    def add_devices(self, devices) -> None:
+        asyncio.run_coroutine_threadsafe(self._add_devices(devices), self.loop).result()
+
+    # stop some devices, returns once their ports are closed
+    def remove_devices(self, devices) -> None:
+        asyncio.run_coroutine_threadsafe(self._remove_devices(devices), self.loop).result()
+
+    def _run(self, devices) -> None:
+        asyncio.run(self._main(devices))
+
+    async def _main(self, devices) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        self.frames = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.tasks = {}
+        self.started.set()
+
+        consumer = asyncio.create_task(self._consume(self.frames))
+        await self._add_devices(devices)
+
+        await self.stopping.wait()
+
+        tasks = list(self.tasks.values())
+        self.tasks = {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        # record what was read before the stop, then end the consumer
+        await self.frames.join()
+        consumer.cancel()
+        await asyncio.gather(consumer, return_exceptions=True)
+
+    async def _add_devices(self, devices) -> None:
+        for wrappers in devices:
+            self.tasks[id(wrappers[0]["sensor"])] = asyncio.create_task(self._device_task(wrappers, self.frames))
+
+    async def _remove_devices(self, devices) -> None:
+        tasks = [self.tasks.pop(id(wrappers[0]["sensor"]), None) for wrappers in devices]
+        tasks = [task for task in tasks if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # schedule and read one physical device
+    async def _device_task(self, sensor_wrappers, frames) -> None:
+        sensor = sensor_wrappers[0]["sensor"]
+        read = self._frame_source(sensor)
+        next_read = self.loop.time()
+        try:
+            while True:
+                try:
+                    start = time.perf_counter()
+                    frame = await read()
+                    READ_SECONDS.labels(sensor=sensor_wrappers[0]["name"]).observe(time.perf_counter() - start)
+                    if frame is not None:
+                        # a port frame carries the time it arrived, it may be older than this read
+                        read_time = frame.time if isinstance(frame, Frame) else datetime.now()
+                        await frames.put((sensor_wrappers, frame, read_time))
+                except Exception as err:
+                    logger.error(f"Error in sensor reading for {sensor_wrappers[0]['name']}: {err}")
+
+                # next read is due one period after the previous due time
+                # if we are already past it, skip ahead instead of bursting
+                next_read += self.state.get("Read Frequency")
+                now = self.loop.time()
+                if next_read < now:
+                    next_read = now
+                await asyncio.sleep(next_read - now)
+        finally:
+            self._close(sensor)
+
+    # returns an async function reading one frame from the sensor
+    def _frame_source(self, sensor):
+        port = getattr(sensor, "ser", None)
+        if port is None or not hasattr(sensor, "reader"):
+            # simulated sensor, reading does not block
+            async def read_simulated():
+                return sensor.read_frame()
+            return read_simulated
+
+        try:
+            fd = port.fileno()
+        except (AttributeError, serial.SerialException, OSError):
+            fd = None
+        if fd is None:
+            # no pollable descriptor on this platform, read on a worker thread
+            async def read_in_executor():
+                return await self.loop.run_in_executor(None, sensor.read_frame)
+            return read_in_executor
+
+        return self._watch_port(sensor, port, fd)
+
+    # watch a serial port for incoming bytes and keep the latest frame
+    # lines are split and parsed by the sensor's Frame_Reader (serial_framing.py)
+    def _watch_port(self, sensor, port, fd):
+        port.timeout = 0
+        reader = sensor.reader
+        latest = {"frame": None}
+        arrived = asyncio.Event()
+
+        def on_readable():
+            try:
+                parsed = reader.read_fd(fd)
+            except (serial.SerialException, OSError) as e:
+                logger.error(f"Error reading data: {e}")
+                self.loop.remove_reader(fd)
+                return
+            if parsed:
+                latest["frame"] = parsed[-1]
+                arrived.set()
+
+        self.loop.add_reader(fd, on_readable)
+
+        # use the newest frame since the last read, else wait for the next one
+        async def read_port():
+            if not arrived.is_set():
+                try:
+                    await asyncio.wait_for(arrived.wait(), READ_TIMEOUT)
+                except asyncio.TimeoutError:
+                    return None
+            arrived.clear()
+            frame, latest["frame"] = latest["frame"], None
+            return frame
+
+        return read_port
+
+    # fan frames out to the wrapper of each measure
+    async def _consume(self, frames) -> None:
+        while True:
+            sensor_wrappers, frame, read_time = await frames.get()
+            try:
+                for sensor_wrapper in sensor_wrappers:
+                    if sensor_wrapper["measure"] in frame:
+                        self.record(sensor_wrapper, frame[sensor_wrapper["measure"]], read_time)
+            except Exception as err:
+                logger.error(f"Error storing reading for {sensor_wrappers[0]['name']}: {err}")
+            finally:
+                frames.task_done()
+
+    # stop watching and disconnect a device
+    def _close(self, sensor) -> None:
+        port = getattr(sensor, "ser", None)
+        if port is not None and hasattr(sensor, "reader"):
+            try:
+                self.loop.remove_reader(port.fileno())
+            except (AttributeError, ValueError, OSError, serial.SerialException):
+                pass
+        sensor.disconnect_port()
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+
+#----------------------------------------------------------------------------------------
+#   /analysis_query/ latency and payload size, raw vs downsampled
+#
+#   Restores the recorded runs from WAASMA_flaskdb.zip, adds a synthetic
+#   multi-week run at the default 5 s read frequency, and queries every
+#   run through the Flask route with:
+#       raw               every document (the old behaviour)
+#       resolution=60     one min/max/mean/count bucket per minute
+#       max_points=500    buckets sized to fit 500 points
+#       lttb 500          500 shape preserving real readings
+#
+#   Usage (from backend/): python benchmarks/bench_analysis_query.py [mongodb://...]
+#----------------------------------------------------------------------------------------
+
+# size of the synthetic run, mongomock is far slower than a mongod
+SYNTHETIC_WEEKS = 3
+SYNTHETIC_WEEKS_MONGOMOCK = 1 / 7
+READ_FREQUENCY = 5
+VARIANTS = [
+    ("raw", {}),
+    ("resolution=60", {"resolution": 60}),
+    ("max_points=500", {"max_points": 500}),
+    ("lttb 500", {"max_points": 500, "downsample": "lttb"}),
+]
+
+
+def synthetic_run(database, name, weeks):
+    start = datetime(2025, 1, 1)
+    count = int(weeks * 7 * 24 * 3600 / READ_FREQUENCY)
+    sensor_id = ObjectId()
+    documents = [{"value": 20.0 + (i % 720) / 100.0, "time": start + timedelta(seconds=i * READ_FREQUENCY), "sensor_id": sensor_id}
+                 for i in range(count)]
+    database.drop_collection(name)
+    for i in range(0, count, 50000):
+        database[name].insert_many(documents[i:i + 50000])
+    return count
+
+
+def bench(uri=None):
+    database = sample_data.connect(uri)
+    collections = sample_data.load_collections()
+    sample_data.restore(database, collections)
+    runs = sample_data.run_collections(collections)
+    synthetic = "Synthetic_CO2_collection_run0"
+    synthetic_run(database, synthetic, SYNTHETIC_WEEKS if uri else SYNTHETIC_WEEKS_MONGOMOCK)
+    runs.append(synthetic)
+
+    from sys_state import Sys_State
+    from readings_store import Per_Run_Store
+    import app as app_module
+    sample_data.use_database(database)
+    database.settings_collection.update_one({}, {"$set": {"start_date": datetime(2024, 1, 1)}})
+
+    # every run collection becomes one sensor in the Sensor List
+    sensor_list = {}
+    for run in runs:
+        sensor_id = ObjectId()
+        database.sensor_collection.insert_one({"_id": sensor_id, "name": run, "type": "water", "tank": 99})
+        measure = "CO2" if "_CO2_" in run else "DO"
+        sensor_list[run] = {"id": sensor_id, "name": run, "measure": measure, "db": database[run]}
+
+    state = Sys_State({"Sensor List": {}, "reset sensors": False, "Readings Store": Per_Run_Store(database, 0), "Rollups": None, "Run Archive": None, "Query Cache": None})
+    client = app_module.Flask_App(state).app.test_client()
+
+    print(f"{'collection':<36} {'docs':>7} " + " ".join(f"{label:>22}" for label, _ in VARIANTS))
+    for run in runs:
+        state.set("Sensor List", {run: sensor_list[run]})
+        row = []
+        for label, extra in VARIANTS:
+            body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all",
+                    "formattedStart": "0", "formattedEnd": "0", **extra}
+            start = time.perf_counter()
+            response = client.post("/analysis_query/", json=body)
+            elapsed = time.perf_counter() - start
+            row.append(f"{elapsed * 1000:>8.1f} ms {len(response.data) / 1024:>8.1f} KB")
+        print(f"{run:<36} {database[run].count_documents({}):>7} " + " ".join(f"{cell:>22}" for cell in row))
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,154 @@
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+from check_data import Check_Data, RULES
+from ring_buffer import Ring_Buffer
+
+#----------------------------------------------------------------------------------------
+#   Anomaly checks on the recorded runs
+#
+#   Replay: every run in WAASMA_flaskdb.zip is fed reading by reading
+#   through Check_Data, with the range of its sensor document, and the
+#   raised alerts are counted against the readings the old per reading
+#   range check would have alerted on. tests/test_check_data.py checks
+#   the events against Scalar_Check.
+#
+#   Throughput: windows cut from the recorded runs are checked in batches
+#   of BATCHES sensors, one new reading per sensor and check, reported as
+#   sensor windows checked per second for check() (from per sensor
+#   arrays, as check_proc does) and for the plain Python rules.
+#
+#   Usage (from backend/): python benchmarks/bench_check_data.py
+#----------------------------------------------------------------------------------------
+
+BATCHES = [10, 100, 1000, 5000]
+RECENT_READINGS = 100
+
+
+# the rules of check_data.py for one sensor, one reading at a time
+class Scalar_Check:
+    def __init__(self, rules) -> None:
+        self.rules = rules
+        self.active = {rule: False for rule in RULES}
+
+    def check(self, times, values, low, high) -> list:
+        rules = self.rules
+        latest = values[-1]
+        span = max(high - low, np.finfo(np.float64).tiny)
+        conditions = {}
+
+        band = rules["hysteresis"] * span
+        conditions["range"] = (latest > high or latest < low, low + band <= latest <= high - band)
+
+        history = values[-(rules["zscore_window"] + 1):-1]
+        if len(history) >= rules["zscore_min_points"]:
+            mean = sum(history) / len(history)
+            std = math.sqrt(sum((value - mean) ** 2 for value in history) / len(history))
+            z = abs(latest - mean) / max(std, rules["zscore_floor"] * span)
+            conditions["zscore"] = (z > rules["zscore_raise"], z < rules["zscore_clear"])
+        else:
+            conditions["zscore"] = (False, True)
+
+        if len(values) >= 2 and times[-1] > times[-2]:
+            rate = abs(latest - values[-2]) / (times[-1] - times[-2]) * 60.0
+            limit = rules["rate_limit"] * span
+            conditions["rate"] = (rate > limit, rate < rules["rate_clear"] * limit)
+        else:
+            conditions["rate"] = (False, True)
+
+        recent = values[-rules["flat_points"]:]
+        spread = max(recent) - min(recent)
+        conditions["flatline"] = (len(recent) == rules["flat_points"] and spread <= rules["flat_epsilon"],
+                                  spread > rules["flat_epsilon"])
+
+        events = []
+        for rule in RULES:
+            raised, cleared = conditions[rule]
+            active = (not cleared) if self.active[rule] else raised
+            if active != self.active[rule]:
+                events.append((rule, "raised" if active else "cleared"))
+            self.active[rule] = active
+        return events
+
+
+def recorded_runs():
+    collections = sample_data.load_collections()
+    ranges = {}
+    for sensor in collections["sensor_collection"]:
+        for measure, limits in sensor["measures"].items():
+            ranges[(sensor["name"], measure)] = ranges[measure] = (float(limits["range_low"]), float(limits["range_high"]))
+    runs = []
+    for name in sample_data.run_collections(collections):
+        sensor, measure = name.split("_")[:2]
+        readings = [document for document in collections[name] if "value" in document]
+        times = np.array([document["time"].timestamp() for document in readings])
+        values = np.array([float(document["value"]) for document in readings])
+        # runs of sensors no longer in the dump use the range of the same measure
+        runs.append((name, times, values, *ranges.get((sensor, measure), ranges[measure])))
+    return runs
+
+
+def replay(runs):
+    print(f"{'run':<34} {'readings':>8} {'old alerts':>10} " + " ".join(f"{rule:>9}" for rule in RULES))
+    for name, times, values, low, high in runs:
+        checker = Check_Data()
+        buffer = Ring_Buffer(RECENT_READINGS)
+        raised = dict.fromkeys(RULES, 0)
+        for t, value in zip(times, values):
+            buffer.append(t, value)
+            window_times, window_values = buffer.last()
+            for event in checker.check([(name, window_times, window_values, low, high)]):
+                if event["state"] == "raised":
+                    raised[event["rule"]] += 1
+        old_alerts = int(((values > high) | (values < low)).sum())
+        print(f"{name:<34} {len(values):>8} {old_alerts:>10} " + " ".join(f"{raised[rule]:>9}" for rule in RULES))
+
+
+def throughput(runs):
+    window = Check_Data().window
+    pieces = []
+    for name, times, values, low, high in runs:
+        for end in range(window, len(values), window):
+            pieces.append((times[end - window:end], values[end - window:end], low, high))
+
+    print(f"\n{'sensors':>8} {'check() windows/s':>18} {'python windows/s':>17}")
+    for batch in BATCHES:
+        windows = [(f"sensor{i}", *pieces[i % len(pieces)]) for i in range(batch)]
+
+        # a newer last reading each round, so every window has one new reading
+        rounds = max(3, 20000 // batch)
+        shifted = [[(key, np.append(times[:-1], times[-1] + (round + 1) * 1e6), values, low, high)
+                    for key, times, values, low, high in windows] for round in range(rounds)]
+        checker = Check_Data()
+        checker.check(windows)
+        start = time.perf_counter()
+        for round_windows in shifted:
+            checker.check(round_windows)
+        vectorized = batch * rounds / (time.perf_counter() - start)
+
+        scalars = [Scalar_Check(checker.rules) for _ in windows]
+        lists = [(times.tolist(), values.tolist(), low, high) for _, times, values, low, high in windows]
+        rounds = max(1, 2000 // batch)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for scalar, arguments in zip(scalars, lists):
+                scalar.check(*arguments)
+        python = batch * rounds / (time.perf_counter() - start)
+        print(f"{batch:>8} {vectorized:>18.0f} {python:>17.0f}")
+
+
+def bench():
+    runs = recorded_runs()
+    replay(runs)
+    throughput(runs)
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,115 @@
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+#----------------------------------------------------------------------------------------
+#   Threaded vs asyncio vs selectors acquisition engine
+#
+#   For 10/100/500 simulated devices, runs each engine for RUN_SECONDS at
+#   a Read Frequency of READ_FREQUENCY and reports:
+#       cpu      CPU seconds used per wall second (1.0 = one full core)
+#       rss      peak resident memory of the process
+#       jitter   how far the gap between two reads of a device strays from
+#                the read frequency (mean and p99 of the absolute error)
+#       drift    how late the last read is versus its ideal schedule
+#   Every configuration runs in its own process so memory is not shared.
+#
+#   Usage (from backend/): python benchmarks/bench_engines.py
+#----------------------------------------------------------------------------------------
+
+SENSOR_COUNTS = [10, 100, 500]
+ENGINES = ["threaded", "async", "selector"]
+RUN_SECONDS = 10.0
+READ_FREQUENCY = 1
+
+
+# device stand-in that remembers when it was read
+class Timed_Sensor:
+    def __init__(self):
+        self.reads = []
+
+    def read_frame(self):
+        self.reads.append(time.monotonic())
+        return {"CO2": 8.0, "DO": 3.0}
+
+    def disconnect_port(self):
+        pass
+
+
+class Null_Collection:
+    def insert_one(self, doc):
+        pass
+
+
+def child(engine, count):
+    import main
+    state = main.system_state
+    state.set("Read Frequency", READ_FREQUENCY)
+    state.set("Acquisition Mode", "device")
+    state.set("Acquisition Engine", engine)
+    state.set("last emails", time.time())
+
+    collection = Null_Collection()
+    sensors = []
+    for i in range(count):
+        sensor = Timed_Sensor()
+        sensors.append(sensor)
+        state.add_to_dict("Sensor List", f"Sim{i}-CO2", main.new_sensor_wrapper(sensor, i, f"Sim{i}", "CO2", 10.0, 0.0, collection))
+        state.add_to_dict("Sensor List", f"Sim{i}-DO", main.new_sensor_wrapper(sensor, i, f"Sim{i}", "DO", 10.0, 0.0, collection))
+
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    acquisition = main.start_acquisition()
+    time.sleep(RUN_SECONDS)
+    state.set("terminate", True)
+    stop_start = time.monotonic()
+    main.stop_acquisition(acquisition)
+    stop_seconds = time.monotonic() - stop_start
+    cpu = (time.process_time() - cpu_start) / (time.monotonic() - wall_start)
+
+    errors = []
+    drift = []
+    for sensor in sensors:
+        reads = sensor.reads
+        for earlier, later in zip(reads, reads[1:]):
+            errors.append(abs((later - earlier) - READ_FREQUENCY))
+        if reads:
+            drift.append(reads[-1] - (reads[0] + (len(reads) - 1) * READ_FREQUENCY))
+    errors.sort()
+
+    print(json.dumps({
+        "engine": engine,
+        "sensors": count,
+        "cpu": cpu,
+        "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "jitter_mean_ms": statistics.fmean(errors) * 1000 if errors else 0.0,
+        "jitter_p99_ms": errors[int(len(errors) * 0.99)] * 1000 if errors else 0.0,
+        "drift_ms": statistics.fmean(drift) * 1000 if drift else 0.0,
+        "stop_ms": stop_seconds * 1000,
+        "threads": threading.active_count()
+    }))
+
+
+def bench():
+    print(f"{'engine':>9} {'sensors':>8} {'cpu':>6} {'rss MB':>8} {'jitter ms':>10} {'p99 ms':>8} {'drift ms':>9} {'stop ms':>8}")
+    for count in SENSOR_COUNTS:
+        for engine in ENGINES:
+            out = subprocess.run([sys.executable, __file__, engine, str(count)], capture_output=True, text=True)
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{engine:>9} {count:>8} {result['cpu']:>6.3f} {result['rss_mb']:>8.1f} "
+                  f"{result['jitter_mean_ms']:>10.2f} {result['jitter_p99_ms']:>8.2f} "
+                  f"{result['drift_ms']:>9.1f} {result['stop_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        child(sys.argv[1], int(sys.argv[2]))
+    else:
+        bench()
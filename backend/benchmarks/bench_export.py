@@ -0,0 +1,80 @@
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+from bench_analysis_query import synthetic_run
+
+#----------------------------------------------------------------------------------------
+#   /analysis_query/ vs the streaming /analysis_export/
+#
+#   Restores WAASMA_flaskdb.zip plus synthetic runs of growing length and
+#   downloads each through both routes, reporting time, bytes sent and
+#   the peak Python memory allocated while serving the request. The
+#   analysis query grows with the run, the export stays flat on a mongod.
+#   mongomock loads a whole cursor result up front, so under mongomock the
+#   export peak still grows with the run (about 6x less than the query).
+#
+#   Usage (from backend/): python benchmarks/bench_export.py [mongodb://...]
+#----------------------------------------------------------------------------------------
+
+WEEKS = [1 / 28, 1 / 14, 1 / 7]
+WEEKS_MONGOD = [1 / 7, 1, 3]
+VARIANTS = [
+    ("analysis_query", "/analysis_query/", {}),
+    ("export ndjson", "/analysis_export/", {"format": "ndjson"}),
+    ("export csv", "/analysis_export/", {"format": "csv"}),
+    ("export csv gzip", "/analysis_export/", {"format": "csv", "gzip": True}),
+]
+
+
+def measure(client, path, body):
+    tracemalloc.start()
+    start = time.perf_counter()
+    response = client.post(path, json=body, buffered=False)
+    size = 0
+    for chunk in response.response:
+        size += len(chunk)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, size, peak
+
+
+def bench(uri=None):
+    database = sample_data.connect(uri)
+    sample_data.restore(database, sample_data.load_collections())
+
+    from sys_state import Sys_State
+    from readings_store import Per_Run_Store
+    import app as app_module
+    sample_data.use_database(database)
+    database.settings_collection.update_one({}, {"$set": {"start_date": datetime(2024, 1, 1)}})
+
+    sensor_id = ObjectId()
+    database.sensor_collection.insert_one({"_id": sensor_id, "name": "Synthetic", "type": "water", "tank": 99})
+    state = Sys_State({"Sensor List": {}, "reset sensors": False, "Readings Store": Per_Run_Store(database, 0), "Rollups": None, "Run Archive": None, "Query Cache": None})
+    client = app_module.Flask_App(state).app.test_client()
+    body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all",
+            "formattedStart": "0", "formattedEnd": "0"}
+
+    print(f"{'readings':>9} " + " ".join(f"{label:>30}" for label, _, _ in VARIANTS))
+    for weeks in (WEEKS_MONGOD if uri else WEEKS):
+        name = "Synthetic_CO2_collection_run0"
+        count = synthetic_run(database, name, weeks)
+        state.set("Sensor List", {"Synthetic-CO2": {"id": sensor_id, "name": "Synthetic", "measure": "CO2", "db": database[name]}})
+        row = []
+        for _, path, extra in VARIANTS:
+            elapsed, size, peak = measure(client, path, {**body, **extra})
+            row.append(f"{elapsed * 1000:>7.0f} ms {size / 2**20:>6.1f} MB {peak / 2**20:>6.1f} MB")
+        print(f"{count:>9} " + " ".join(f"{cell:>30}" for cell in row))
+    print("columns: time, bytes sent, peak memory while serving")
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,132 @@
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensor_simulator import format_frame, load_recorded_runs
+from serial_framing import Frame_Reader
+from w_sensor import FIRST_VALUE_FIELD, FRAME_FIELDS, MEASURE_FIELDS, parse_data_line
+
+#----------------------------------------------------------------------------------------
+#   #DATA: frame parsing
+#
+#   Lines: the CO2/DO values of every recorded run in WAASMA_flaskdb.zip
+#   written as #DATA: lines (format_frame, the lines the simulator farm
+#   sends), with CORRUPT_RATE of them damaged (cut short, a bad byte in a
+#   measure, line noise).
+#   Parsers, lines per second over the whole stream:
+#       readline + str  the old Water_Sensor parser, one decoded line at a time
+#       parse_data_line the bytes parser alone, on ready split lines
+#       Frame_Reader    bulk reads of CHUNK bytes fed to a reader, framing
+#                       and parsing (1 byte chunks check partial lines)
+#   Every run must give the same frames and count every damaged line.
+#
+#   Usage (from backend/): python benchmarks/bench_frame_parser.py
+#----------------------------------------------------------------------------------------
+
+CORRUPT_RATE = 0.01
+CHUNKS = [1, 64, 4096, 65536]
+SEED = 7
+
+
+# Water_Sensor.parse_frame before serial_framing.py
+def legacy_parse(line):
+    data_entries = str(line, 'UTF-8', 'replace')[5:].split(",")
+    if len(data_entries) != FRAME_FIELDS:
+        return None
+    frame = {}
+    try:
+        for measure, index in MEASURE_FIELDS.items():
+            frame[measure] = float(data_entries[index])
+    except ValueError:
+        return None
+    for index in range(FIRST_VALUE_FIELD, FRAME_FIELDS):
+        if index not in MEASURE_FIELDS.values():
+            try:
+                frame[f"field{index}"] = float(data_entries[index])
+            except ValueError:
+                pass
+    return frame
+
+
+def damage(line, rng):
+    kind = rng.randrange(3)
+    if kind == 0:
+        # cut before the last field
+        return line[:rng.randrange(8, line.rindex(b","))] + b"\r\n"
+    if kind == 1:
+        # first byte of the CO2 entry
+        start = sum(len(entry) + 1 for entry in line.split(b",")[:MEASURE_FIELDS["CO2"]])
+        return line[:start] + b"x" + line[start + 1:]
+    return bytes(rng.randrange(33, 127) for _ in range(40)) + b"\r\n"
+
+
+def recorded_lines():
+    rng = random.Random(SEED)
+    lines = []
+    corrupt = 0
+    when = datetime(2024, 7, 26, 15, 12, 15)
+    for run in load_recorded_runs().values():
+        count = min(len(values) for _, values in run.values())
+        for i in range(count):
+            line = format_frame({measure: values[i] for measure, (_, values) in run.items()}, when)
+            if rng.random() < CORRUPT_RATE:
+                line = damage(line, rng)
+                corrupt += 1
+            lines.append(line)
+    return lines, corrupt
+
+
+def timed(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def bench():
+    lines, corrupt = recorded_lines()
+    stream = b"".join(lines)
+    print(f"{len(lines)} lines, {corrupt} damaged, {len(stream)} bytes\n")
+    print(f"{'parser':<24} {'lines/s':>10} {'frames':>8} {'corrupt':>8}")
+
+    def legacy():
+        return [frame for frame in map(legacy_parse, lines) if frame is not None]
+    seconds, expected = timed(legacy)
+    print(f"{'readline + str':<24} {len(lines) / seconds:>10.0f} {len(expected):>8} {len(lines) - len(expected):>8}")
+
+    split = [line[:-1] for line in lines]
+    def bytes_parser():
+        out = []
+        for line in split:
+            try:
+                out.append(parse_data_line(line))
+            except ValueError:
+                pass
+        return out
+    seconds, values = timed(bytes_parser)
+    if values != expected:
+        raise AssertionError("parse_data_line differs from the old parser")
+    print(f"{'parse_data_line':<24} {len(lines) / seconds:>10.0f} {len(values):>8} {len(lines) - len(values):>8}")
+
+    for chunk in CHUNKS:
+        def framed():
+            reader = Frame_Reader(parse_data_line, f"bench{chunk}")
+            out = []
+            for start in range(0, len(stream), chunk):
+                out.extend(reader.feed(stream[start:start + chunk]))
+            return reader, out
+        seconds, (reader, frames) = timed(framed, 1 if chunk == 1 else 3)
+        if [frame.values for frame in frames] != expected or reader.corrupt != corrupt or reader.buffer:
+            raise AssertionError(f"Frame_Reader with {chunk} byte reads: {len(frames)} frames, {reader.corrupt} corrupt")
+        print(f"{f'Frame_Reader {chunk} B':<24} {len(lines) / seconds:>10.0f} {len(frames):>8} {reader.corrupt:>8}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,102 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensor_state import Sensor_State
+from sys_state import Sys_State
+
+#----------------------------------------------------------------------------------------
+#   Sys_State lock profiling
+#
+#   The lock_wait workload of suite.py (sensor threads reading their
+#   flags and services, a dashboard thread copying the Sensor List) plus
+#   a thread that hard_locks the state for HARD_LOCK_SECONDS now and then,
+#   as reconfiguration did. Run once without and once with profiling:
+#   reports the accesses per second of both, then the profile, callers
+#   by total hold time, get() copies and the flagged slow waits.
+#
+#   Usage (from backend/): python benchmarks/bench_lock_profile.py
+#----------------------------------------------------------------------------------------
+
+SENSOR_THREADS = 50
+RUN_SECONDS = 3.0
+HARD_LOCK_SECONDS = 0.02
+THRESHOLD = 0.005
+
+
+def sensor_thread(state, stop, operations):
+    while not stop.is_set():
+        state.get("terminate")
+        state.get("reset sensors")
+        state.get_ref("Web App")
+        state.get_ref("Storage Writer")
+        operations[0] += 4
+        time.sleep(0.001)
+
+
+def dashboard_thread(state, stop, operations):
+    while not stop.is_set():
+        state.get("Sensor List")
+        operations[0] += 1
+        time.sleep(0.01)
+
+
+def reconfigure_thread(state, stop, operations):
+    while not stop.is_set():
+        state.hard_lock()
+        time.sleep(HARD_LOCK_SECONDS)
+        state.hard_release()
+        operations[0] += 1
+        time.sleep(0.5)
+
+
+def run(profile):
+    sensor_list = {f"Lock{number}-{measure}": {"id": number, "name": f"Lock{number}", "measure": measure, "readings": Sensor_State(100)}
+                   for number in range(SENSOR_THREADS) for measure in ["CO2", "DO"]}
+    state = Sys_State({"terminate": False, "reset sensors": False, "Sensor List": sensor_list,
+                       "Storage Writer": None, "Web App": None}, ["terminate"])
+    if profile:
+        state.start_profiling(THRESHOLD)
+    stop = threading.Event()
+    operations = [0]
+    threads = [threading.Thread(target=sensor_thread, args=[state, stop, operations]) for _ in range(SENSOR_THREADS)]
+    threads += [threading.Thread(target=dashboard_thread, args=[state, stop, operations]),
+                threading.Thread(target=reconfigure_thread, args=[state, stop, operations])]
+    for thread in threads:
+        thread.start()
+    time.sleep(RUN_SECONDS)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return operations[0] / RUN_SECONDS, state.lock_profile()
+
+
+def bench():
+    plain, _ = run(False)
+    profiled, profile = run(True)
+    print(f"{'profiling':>10} {'accesses/s':>11}")
+    print(f"{'off':>10} {plain:>11.0f}")
+    print(f"{'on':>10} {profiled:>11.0f}")
+
+    print(f"\n{'caller':<48} {'key':<16} {'holds':>7} {'hold ms':>9} {'hold max us':>12} {'wait p99 us':>12}")
+    for caller in profile["callers"]:
+        print(f"{caller['caller']:<48} {str(caller['key']):<16} {caller['hold']['count']:>7} {caller['hold']['total_ms']:>9.1f} "
+              f"{caller['hold']['max_us']:>12.0f} {caller['wait']['p99_us']:>12.0f}")
+
+    print(f"\n{'copied key':<16} {'copies':>7} {'bytes':>11} {'mean us':>8}")
+    for copies in profile["copies"]:
+        print(f"{str(copies['key']):<16} {copies['count']:>7} {copies['bytes']:>11} {copies['mean_us']:>8.2f}")
+
+    print(f"\n{profile['slow_wait_count']} waits over {profile['threshold_ms']:.0f} ms, holders:")
+    holders = {}
+    for wait in profile["slow_waits"]:
+        holders[wait["holder"]["caller"]] = holders.get(wait["holder"]["caller"], 0) + 1
+    for caller, count in sorted(holders.items(), key=lambda item: item[1], reverse=True):
+        print(f"{count:>7}  {caller}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,77 @@
+import os
+import smtplib
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mail_server import mail_server
+from smtp_standin import Local_SMTP_Server
+from sys_state import Sys_State
+
+#----------------------------------------------------------------------------------------
+#   Alert email delivery, per burst connections vs the pooled mail server
+#
+#   Delivers BURSTS bursts of alerts (every user gets one message per
+#   burst, like notification() does) to the in-process SMTP stand-in,
+#   whose HANDSHAKE_DELAY stands in for the connect/STARTTLS/login time
+#   of a real server, and reports wall time, connections and emails.
+#       old     the previous mail_server: connect, sendmail each, quit
+#       pooled  persistent connections on MAIL_WORKERS workers, messages
+#               to one user within the digest window merged into one email
+#
+#   Usage (from backend/): python benchmarks/bench_mail.py
+#----------------------------------------------------------------------------------------
+
+HANDSHAKE_DELAY = 0.3
+USERS = 5
+BURSTS = 10
+BURST_GAP = 0.1
+DIGEST_WINDOW = 0.5
+
+
+def bursts():
+    for burst in range(BURSTS):
+        yield [(f"user{user}@example.com", f"Subject: Sensor Out of Range\n\nalert {burst}") for user in range(USERS)]
+
+
+def old_delivery(standin):
+    start = time.perf_counter()
+    for burst in bursts():
+        server = smtplib.SMTP(standin.host, standin.port)
+        for address, text in burst:
+            server.sendmail("sender@example.com", address, text)
+        server.quit()
+        time.sleep(BURST_GAP)
+    return time.perf_counter() - start
+
+
+def pooled_delivery(standin):
+    state = Sys_State({"terminate": False}, ["terminate"])
+    server = mail_server(standin.host, standin.port, use_tls=False, digest_window=DIGEST_WINDOW)
+    thread = threading.Thread(target=server.run, args=[state])
+    start = time.perf_counter()
+    thread.start()
+    for burst in bursts():
+        for address, text in burst:
+            server.send_email(address, text)
+        time.sleep(BURST_GAP)
+    state.set("terminate", True)
+    thread.join()
+    return time.perf_counter() - start
+
+
+def bench():
+    print(f"{BURSTS} bursts of {USERS} alerts, {HANDSHAKE_DELAY * 1000:.0f} ms handshake")
+    print(f"{'delivery':>8} {'seconds':>8} {'connections':>12} {'emails':>7}")
+    for label, deliver in [("old", old_delivery), ("pooled", pooled_delivery)]:
+        standin = Local_SMTP_Server(handshake_delay=HANDSHAKE_DELAY)
+        standin.start()
+        elapsed = deliver(standin)
+        standin.stop()
+        print(f"{label:>8} {elapsed:>8.2f} {standin.connections:>12} {len(standin.messages):>7}")
+
+
+if __name__ == "__main__":
+    bench()
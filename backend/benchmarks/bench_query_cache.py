@@ -0,0 +1,169 @@
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+from bench_analysis_query import synthetic_run
+
+#----------------------------------------------------------------------------------------
+#   /analysis_query/ result cache
+#
+#   past      a window of a finished synthetic run queried REPEAT times:
+#             the first query (miss) against the next ones (hits)
+#   live      a run still recording, LIVE_APPENDS readings added between
+#             queries of its open range: an uncached query against the
+#             cache extending its entry with the new readings. Every
+#             extended answer is checked against an uncached one
+#   memory    DISTINCT_WINDOWS different windows through a cache of
+#             SMALL_CACHE_MB: entries, evictions, estimated memory
+#   Each for raw, max_points=500 buckets, resolution=60 and lttb 500,
+#   with the hit ratio and memory of /analysis_cache at the end.
+#
+#   Usage (from backend/): python benchmarks/bench_query_cache.py [mongodb://...]
+#----------------------------------------------------------------------------------------
+
+SYNTHETIC_WEEKS = 1
+SYNTHETIC_WEEKS_MONGOMOCK = 1 / 14
+LIVE_HOURS = 6
+LIVE_APPENDS = 12
+READ_FREQUENCY = 5
+REPEAT = 5
+DISTINCT_WINDOWS = 40
+SMALL_CACHE_MB = 4
+VARIANTS = [
+    ("raw", {}),
+    ("max_points=500", {"max_points": 500}),
+    ("resolution=60", {"resolution": 60}),
+    ("lttb 500", {"max_points": 500, "downsample": "lttb"}),
+]
+
+
+def iso(value):
+    return value.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+
+def client_for(database, sensor_list, cache):
+    from sys_state import Sys_State
+    from readings_store import Per_Run_Store
+    import app as app_module
+    state = Sys_State({"Sensor List": sensor_list, "reset sensors": False, "Readings Store": Per_Run_Store(database, 0),
+                       "Rollups": None, "Run Archive": None, "Query Cache": cache})
+    return app_module.Flask_App(state).app.test_client()
+
+
+def post(client, body):
+    start = time.perf_counter()
+    response = client.post("/analysis_query/", json=body)
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise AssertionError(f"{response.status_code}: {response.data[:200]}")
+    return elapsed, response.get_json()["sensor_data"].get("Bench-CO2", [])
+
+
+def same_answer(label, cached, uncached):
+    if len(cached) != len(uncached):
+        raise AssertionError(f"{label}: {len(cached)} points cached, {len(uncached)} uncached")
+    for left, right in zip(cached, uncached):
+        if left["time"] != right["time"] or abs(left["value"] - right["value"]) > 1e-9 * max(1.0, abs(right["value"])):
+            raise AssertionError(f"{label}: {left} cached, {right} uncached")
+        if left.get("count") != right.get("count"):
+            raise AssertionError(f"{label}: bucket {left['time']} has {left.get('count')} readings cached, {right.get('count')} uncached")
+
+
+def bench_past(database, sensor_list, first):
+    from query_cache import Query_Cache
+    cache = Query_Cache()
+    cached = client_for(database, sensor_list, cache)
+    body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all",
+            "formattedStart": iso(first), "formattedEnd": iso(first + timedelta(days=1))}
+    print(f"{'past window':<16} {'miss ms':>9} {'hit ms':>9} {'points':>7}")
+    for label, extra in VARIANTS:
+        miss, answer = post(cached, {**body, **extra})
+        hits = [post(cached, {**body, **extra})[0] for _ in range(REPEAT)]
+        print(f"{label:<16} {miss * 1000:>9.1f} {statistics.median(hits) * 1000:>9.3f} {len(answer):>7}")
+    return cache
+
+
+def bench_live(database, sensor_list, collection, sensor_id):
+    from query_cache import Query_Cache
+    cache = Query_Cache()
+    cached = client_for(database, sensor_list, cache)
+    uncached = client_for(database, sensor_list, None)
+    body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all", "formattedStart": "0", "formattedEnd": "0"}
+    print(f"\n{'live run':<16} {'uncached ms':>12} {'extended ms':>12} {'points':>7}")
+    for label, extra in VARIANTS:
+        post(cached, {**body, **extra})
+        uncached_times, extended_times = [], []
+        for number in range(LIVE_APPENDS):
+            collection.insert_one({"value": 20.0 + number % 7, "time": datetime.now(), "sensor_id": sensor_id})
+            elapsed, answer = post(cached, {**body, **extra})
+            extended_times.append(elapsed)
+            elapsed, expected = post(uncached, {**body, **extra})
+            uncached_times.append(elapsed)
+            same_answer(f"live {label}", answer, expected)
+        print(f"{label:<16} {statistics.median(uncached_times) * 1000:>12.1f} {statistics.median(extended_times) * 1000:>12.1f} {len(answer):>7}")
+    return cache
+
+
+def bench_memory(database, sensor_list, first):
+    from query_cache import Query_Cache
+    cache = Query_Cache(SMALL_CACHE_MB * 1024 * 1024)
+    cached = client_for(database, sensor_list, cache)
+    for number in range(DISTINCT_WINDOWS):
+        window_start = first + timedelta(hours=number)
+        body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all",
+                "formattedStart": iso(window_start), "formattedEnd": iso(window_start + timedelta(hours=6))}
+        post(cached, body)
+    stats = cache.stats()
+    print(f"\n{DISTINCT_WINDOWS} raw 6 h windows in a {SMALL_CACHE_MB} MB cache: {stats['entries']} entries, "
+          f"{stats['evictions']} evicted, {stats['bytes'] / 1024 / 1024:.2f} MB of {stats['max_bytes'] / 1024 / 1024:.0f} MB")
+    if stats["bytes"] > stats["max_bytes"]:
+        raise AssertionError("cache over its memory limit")
+
+
+def bench(uri=None):
+    database = sample_data.connect(uri)
+    sample_data.restore(database, sample_data.load_collections())
+    sample_data.use_database(database)
+
+    past = "Synthetic_CO2_collection_run0"
+    synthetic_run(database, past, SYNTHETIC_WEEKS if uri else SYNTHETIC_WEEKS_MONGOMOCK)
+    past_sensor = database[past].find_one({"time": {"$exists": True}})["sensor_id"]
+    first = database[past].find_one({"time": {"$exists": True}}, sort=[("time", 1)])["time"]
+
+    # the live run: LIVE_HOURS of readings up to now
+    live = "Bench_CO2_collection_run1"
+    live_sensor = ObjectId()
+    now = datetime.now()
+    count = LIVE_HOURS * 3600 // READ_FREQUENCY
+    database.drop_collection(live)
+    database[live].insert_many([{"value": 20.0 + (i % 720) / 100.0, "time": now - timedelta(seconds=(count - i) * READ_FREQUENCY),
+                                 "sensor_id": live_sensor} for i in range(count)])
+    database.settings_collection.update_one({}, {"$set": {"start_date": now - timedelta(hours=LIVE_HOURS)}})
+
+    database.sensor_collection.insert_one({"_id": past_sensor, "name": "Bench", "type": "water", "tank": 99})
+    past_list = {"Bench-CO2": {"id": past_sensor, "name": "Bench", "measure": "CO2", "db": database[past]}}
+    cache = bench_past(database, past_list, first)
+    database.sensor_collection.delete_one({"_id": past_sensor})
+
+    database.sensor_collection.insert_one({"_id": live_sensor, "name": "Bench", "type": "water", "tank": 99})
+    live_list = {"Bench-CO2": {"id": live_sensor, "name": "Bench", "measure": "CO2", "db": database[live]}}
+    live_cache = bench_live(database, live_list, database[live], live_sensor)
+    database.sensor_collection.delete_one({"_id": live_sensor})
+
+    database.sensor_collection.insert_one({"_id": past_sensor, "name": "Bench", "type": "water", "tank": 99})
+    bench_memory(database, past_list, first)
+    database.sensor_collection.delete_one({"_id": past_sensor})
+
+    for label, stats in [("past", cache.stats()), ("live", live_cache.stats())]:
+        print(f"{label} cache: {stats['hit']} hits, {stats['extended']} extended, {stats['miss']} misses, "
+              f"hit ratio {stats['hit_ratio']:.2f}, {stats['entries']} entries, {stats['bytes'] / 1024:.0f} KB")
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,186 @@
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from pymongo.errors import AutoReconnect
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+from reading_wal import Reading_WAL
+from storage_writer import Storage_Writer
+
+#----------------------------------------------------------------------------------------
+#   Write-ahead log for readings
+#
+#   put latency: microseconds per Storage_Writer.put with the log (SQLite
+#       append) and without it (queue), and per insert_one, from THREADS
+#       sensor threads at once
+#   outage: SENSORS readings every PERIOD seconds for OUTAGE_RUN seconds,
+#       MongoDB refusing writes (AutoReconnect) from OUTAGE_START to
+#       OUTAGE_END. Reports the slowest put, the backlog at the end of the
+#       outage, how long the replay took to catch up and its rate, and
+#       checks every reading reached MongoDB exactly once
+#   idempotency: a batch inserted but not removed from the log (the
+#       backend stopped in between) is replayed again, no duplicates
+#
+#   Usage (from backend/): python benchmarks/bench_reading_wal.py [mongodb://...]
+#----------------------------------------------------------------------------------------
+
+THREADS = [1, 8]
+PUTS = 5000
+SENSORS = 200
+PERIOD = 0.01
+OUTAGE_RUN = 6.0
+OUTAGE_START = 1.0
+OUTAGE_END = 4.0
+COLLECTION = "reading_wal_bench"
+
+
+# database whose collections refuse writes while down is set, as a
+# restarting mongod does
+class Outage_Database:
+    def __init__(self, database):
+        self.database = database
+        self.down = threading.Event()
+
+    def __getitem__(self, name):
+        return Outage_Collection(self.database[name], self.down)
+
+
+class Outage_Collection:
+    def __init__(self, collection, down):
+        self.collection = collection
+        self.down = down
+        self.name = collection.name
+
+    def insert_many(self, documents, ordered=True):
+        if self.down.is_set():
+            raise AutoReconnect("connection refused")
+        return self.collection.insert_many(documents, ordered=ordered)
+
+    def insert_one(self, document):
+        if self.down.is_set():
+            raise AutoReconnect("connection refused")
+        return self.collection.insert_one(document)
+
+
+def reading(sensor, number):
+    return {"value": float(number), "time": datetime.now(), "sensor_id": sensor, "number": number}
+
+
+def timed_puts(put, threads):
+    latencies = []
+    def worker(sensor):
+        own = []
+        for number in range(PUTS // threads):
+            start = time.perf_counter()
+            put(reading(sensor, number))
+            own.append(time.perf_counter() - start)
+        latencies.extend(own)
+    workers = [threading.Thread(target=worker, args=[sensor]) for sensor in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    latencies.sort()
+    return latencies
+
+
+def bench_put(database, directory):
+    print(f"{'put':<16} {'threads':>7} {'mean us':>9} {'p50 us':>8} {'p99 us':>8} {'max us':>9}")
+    for threads in THREADS:
+        for name in ["wal", "queue", "insert_one"]:
+            database.drop_collection(COLLECTION)
+            collection = database[COLLECTION]
+            writer = None
+            if name == "insert_one":
+                put = collection.insert_one
+            else:
+                wal = Reading_WAL(os.path.join(directory, f"put{threads}.sqlite3")) if name == "wal" else None
+                writer = Storage_Writer(wal=wal, database=database)
+                writer.start()
+                put = lambda document: writer.put(collection, document)
+            latencies = timed_puts(put, threads)
+            if writer is not None:
+                writer.stop()
+            print(f"{name:<16} {threads:>7} {statistics.fmean(latencies) * 1e6:>9.1f} {latencies[len(latencies) // 2] * 1e6:>8.1f} "
+                  f"{latencies[int(len(latencies) * 0.99)] * 1e6:>8.1f} {latencies[-1] * 1e6:>9.1f}")
+
+
+def bench_outage(database, directory):
+    database.drop_collection(COLLECTION)
+    outage = Outage_Database(database)
+    collection = outage[COLLECTION]
+    wal = Reading_WAL(os.path.join(directory, "outage.sqlite3"))
+    writer = Storage_Writer(wal=wal, database=outage)
+    writer.start()
+
+    produced = 0
+    slowest = 0.0
+    backlog_at_recovery = None
+    start = time.monotonic()
+    while time.monotonic() - start < OUTAGE_RUN:
+        elapsed = time.monotonic() - start
+        if OUTAGE_START <= elapsed < OUTAGE_END and not outage.down.is_set():
+            outage.down.set()
+        if elapsed >= OUTAGE_END and outage.down.is_set():
+            backlog_at_recovery = wal.backlog()
+            outage.down.clear()
+            recovered = time.monotonic()
+            replayed_before = writer.replayed
+        for sensor in range(SENSORS):
+            put_start = time.perf_counter()
+            writer.put(collection, reading(sensor, produced))
+            slowest = max(slowest, time.perf_counter() - put_start)
+            produced += 1
+        time.sleep(PERIOD)
+
+    # catch up: the replay retries on its back off, then drains
+    while wal.backlog():
+        time.sleep(0.01)
+    caught_up = time.monotonic() - recovered
+    rate = (writer.replayed - replayed_before) / caught_up
+    stats = writer.stats()["wal"]
+    writer.stop()
+    stored = database[COLLECTION].count_documents({})
+    unique = len(database[COLLECTION].distinct("number"))
+    print(f"\noutage of {OUTAGE_END - OUTAGE_START:.0f} s at {SENSORS / PERIOD:.0f} readings/s")
+    print(f"{'produced':>9} {'slowest put ms':>15} {'backlog':>8} {'catch up s':>11} {'replay rows/s':>14} {'stored':>7} {'failures':>9}")
+    print(f"{produced:>9} {slowest * 1e3:>15.2f} {backlog_at_recovery:>8} {caught_up:>11.2f} {rate:>14.0f} {stored:>7} {stats['replay_failures']:>9}")
+    if stored != produced or unique != produced:
+        raise AssertionError(f"{produced} readings produced, {stored} stored, {unique} unique")
+
+
+def bench_idempotent(database, directory):
+    database.drop_collection(COLLECTION)
+    wal = Reading_WAL(os.path.join(directory, "idempotent.sqlite3"))
+    for number in range(1000):
+        wal.append(COLLECTION, reading(0, number))
+    # the backend stopped after inserting the first 600 rows, before removing them
+    rows = wal.oldest(600)
+    database[COLLECTION].insert_many([document for _, _, document in rows])
+    writer = Storage_Writer(wal=wal, database=database)
+    writer.start()
+    writer.stop()
+    stored = database[COLLECTION].count_documents({})
+    print(f"\nreplay after a crash: 1000 logged, 600 already stored, {writer.duplicates} duplicates skipped, {stored} stored")
+    if stored != 1000:
+        raise AssertionError(f"{stored} documents after the replay")
+
+
+def bench(uri=None):
+    database = sample_data.connect(uri)
+    with tempfile.TemporaryDirectory() as directory:
+        bench_put(database, directory)
+        bench_outage(database, directory)
+        bench_idempotent(database, directory)
+    database.drop_collection(COLLECTION)
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1] if len(sys.argv) > 1 else None)
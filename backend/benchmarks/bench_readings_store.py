@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+
+#----------------------------------------------------------------------------------------
+#   Per run collections vs the consolidated, indexed readings collection
+#
+#   Restores the recorded runs from WAASMA_flaskdb.zip, adds a synthetic
+#   multi-day run so the collections are large enough to matter, migrates
+#   everything into "readings" with migrate_readings.py and times:
+#       range     one hour of one sensor's measure inside one run
+#       cross run every reading of one sensor's measure in a time range
+#                 (per run: one query per run collection of that sensor)
+#   The per run collections have no index on "time", the consolidated one
+#   uses (sensor_id, measure, time). mongomock ignores indexes, so the
+#   difference only shows against a real mongod.
+#
+#   Usage (from backend/): python benchmarks/bench_readings_store.py [mongodb://...]
+#----------------------------------------------------------------------------------------
+
+SYNTHETIC_DAYS = 7
+SYNTHETIC_DAYS_MONGOMOCK = 1
+READ_FREQUENCY = 5
+REPEATS = 20
+
+
+def synthetic_run(database, days):
+    start = datetime(2025, 1, 1)
+    count = int(days * 24 * 3600 / READ_FREQUENCY)
+    sensor_id = ObjectId()
+    for measure in ["CO2", "DO"]:
+        name = f"Synthetic_{measure}_collection_run0"
+        documents = [{"value": 20.0 + (i % 720) / 100.0, "time": start + timedelta(seconds=i * READ_FREQUENCY), "sensor_id": sensor_id}
+                     for i in range(count)]
+        database.drop_collection(name)
+        for i in range(0, count, 50000):
+            database[name].insert_many(documents[i:i + 50000])
+    return sensor_id, start
+
+
+def timed(query) -> tuple:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        rows = query()
+    return (time.perf_counter() - start) / REPEATS * 1000, rows
+
+
+def bench(uri=None):
+    database = sample_data.connect(uri)
+    collections = sample_data.load_collections()
+    sample_data.restore(database, collections)
+    sensor_id, synthetic_start = synthetic_run(database, SYNTHETIC_DAYS if uri else SYNTHETIC_DAYS_MONGOMOCK)
+
+    from migrate_readings import migrate
+    from readings_store import READINGS_COLLECTION
+    database.drop_collection(READINGS_COLLECTION)
+    start = time.perf_counter()
+    migrate(database)
+    print(f"migration: {time.perf_counter() - start:.2f} s")
+    readings = database[READINGS_COLLECTION]
+
+    print(f"{'query':<40} {'rows':>7} {'per run ms':>11} {'consolidated ms':>16}")
+
+    # one hour of the synthetic run
+    window = {"$gte": synthetic_start + timedelta(hours=12), "$lte": synthetic_start + timedelta(hours=13)}
+    per_run_ms, rows = timed(lambda: len(list(database["Synthetic_CO2_collection_run0"].find({"time": window}))))
+    consolidated_ms, _ = timed(lambda: len(list(readings.find({"sensor_id": sensor_id, "measure": "CO2", "time": window}))))
+    print(f"{'range, 1 h of the synthetic run':<40} {rows:>7} {per_run_ms:>11.2f} {consolidated_ms:>16.2f}")
+
+    # every run of Water1's CO2 readings, per run needs one query per collection
+    water1 = [name for name in database.list_collection_names() if name.startswith("Water1_CO2_collection_run")]
+    water1_ids = readings.distinct("sensor_id", {"sensor_name": "Water1", "measure": "CO2", "test": False})
+    everything = {"$gte": datetime(2025, 1, 1)}
+    per_run_ms, rows = timed(lambda: sum(len(list(database[name].find({"time": everything}))) for name in water1))
+    consolidated_ms, _ = timed(lambda: len(list(readings.find({"sensor_id": {"$in": water1_ids}, "measure": "CO2", "time": everything}))))
+    print(f"{f'cross run, Water1 CO2 ({len(water1)} runs)':<40} {rows:>7} {per_run_ms:>11.2f} {consolidated_ms:>16.2f}")
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensor_state import Sensor_State
+
+#----------------------------------------------------------------------------------------
+#   Recent readings: deque of dictionaries vs the numpy Ring_Buffer
+#
+#   For windows of 100 readings up to a day at 5 s, reports the memory
+#   used per sensor, the cost of a push and the time to build one sensor's
+#   Socket.IO packet (the old per reading dictionaries vs the columns
+#   from recent_columns).
+#
+#   Usage (from backend/): python benchmarks/bench_ring_buffer.py
+#----------------------------------------------------------------------------------------
+
+WINDOWS = [100, 720, 17280]
+PACKETS = 200
+
+
+# the recent readings storage before the ring buffer
+def old_fill(window):
+    recent = deque(maxlen=window)
+    for i in range(window):
+        recent.append({"value": 20.0 + i % 50, "time": 1.7e9 + i * 5})
+    return recent
+
+
+def old_packet(recent):
+    return [{"time": reading["time"], "value": reading["value"]} for reading in list(recent)]
+
+
+def new_fill(window):
+    state = Sensor_State(window)
+    for i in range(window):
+        state.push({"value": 20.0 + i % 50, "time": 1.7e9 + i * 5})
+    return state
+
+
+def measure(fill, packet, window):
+    tracemalloc.start()
+    start = time.perf_counter()
+    buffer = fill(window)
+    push_us = (time.perf_counter() - start) / window * 1e6
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for _ in range(PACKETS):
+        packet(buffer)
+    packet_ms = (time.perf_counter() - start) / PACKETS * 1000
+    return memory, push_us, packet_ms
+
+
+def bench():
+    print(f"{'window':>7} {'storage':>8} {'KB/sensor':>10} {'push us':>8} {'packet ms':>10}")
+    for window in WINDOWS:
+        for label, fill, packet in [("deque", old_fill, old_packet), ("ring", new_fill, lambda state: state.recent_columns())]:
+            memory, push_us, packet_ms = measure(fill, packet, window)
+            print(f"{window:>7} {label:>8} {memory / 1024:>10.1f} {push_us:>8.2f} {packet_ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    bench()
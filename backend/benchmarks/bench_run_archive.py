@@ -0,0 +1,176 @@
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import bson
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+from bench_analysis_query import synthetic_run
+from downsample import bucket_ms_for, bucket_pipeline
+from readings_store import RUN_COLLECTION_PATTERN
+from run_archive import Run_Archive, series_buckets, series_documents
+
+#----------------------------------------------------------------------------------------
+#   Run archive vs MongoDB for finished runs
+#
+#   Converts the runs of WAASMA_flaskdb.zip with the zip converter
+#   (Run_Archive.archive_dump), adds a synthetic run at the default 5 s
+#   read frequency archived from the database (archive_run), and for
+#   every sensor and measure compares, median of REPEAT:
+#       full raw     every reading of the run (find vs series_range)
+#       window 1 h   the readings of one hour in the middle of the run
+#       buckets 500  max_points=500 buckets (bucket_pipeline aggregate
+#                    vs series_buckets)
+#   The answers are checked equal (times to the millisecond, values,
+#   bucket counts). Then the stored size of each run, BSON documents vs
+#   .wcol files, and /analysis_query/ on the synthetic run with its
+#   readings in MongoDB vs in the archive.
+#   mongomock is far slower than a mongod, run with a URI for the real
+#   MongoDB side of the comparison.
+#
+#   Usage (from backend/): python benchmarks/bench_run_archive.py [mongodb://...]
+#----------------------------------------------------------------------------------------
+
+SYNTHETIC_WEEKS = 3
+SYNTHETIC_WEEKS_MONGOMOCK = 1 / 7
+SYNTHETIC = "Synthetic_CO2_collection_run0"
+REPEAT = 5
+MAX_POINTS = 500
+WINDOW = timedelta(hours=1)
+
+
+def timed(function):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def check_readings(label, documents, archived):
+    got = [(document["time"].replace(microsecond=document["time"].microsecond // 1000 * 1000), float(document["value"]))
+           for document in documents]
+    expected = sorted((document["time"], float(document["value"])) for document in archived)
+    if sorted(got) != expected:
+        raise AssertionError(f"{label}: {len(got)} readings from MongoDB, {len(expected)} from the archive")
+
+
+def check_buckets(label, mongo, archived):
+    if [(bucket["time"], bucket["count"]) for bucket in mongo] != [(bucket["time"], bucket["count"]) for bucket in archived]:
+        raise AssertionError(f"{label}: buckets differ")
+    for left, right in zip(mongo, archived):
+        if abs(left["value"] - right["value"]) > 1e-9 * max(1.0, abs(left["value"])) or left["min"] != right["min"] or left["max"] != right["max"]:
+            raise AssertionError(f"{label}: bucket {left['time']} differs")
+
+
+def bench_queries(database, archive, runs):
+    print(f"{'series':<44} {'readings':>8} " + " ".join(f"{label:>24}" for label in ["full raw", "window 1 h", "buckets 500"]))
+    print(f"{'':<44} {'':>8} " + " ".join(f"{'mongo ms':>11} {'archive ms':>12}" for _ in range(3)))
+    for collection_name in runs:
+        collection = database[collection_name]
+        measure = "CO2" if "_CO2_" in collection_name else "DO"
+        for sensor_id in collection.distinct("sensor_id"):
+            times, _ = archive.series_range(sensor_id, measure)
+            if len(times) == 0:
+                continue
+            first, last = times[0].item(), times[-1].item()
+            middle = first + (last - first) / 2
+            ranges = {"full raw": (first, None), "window 1 h": (middle, middle + WINDOW)}
+            row = []
+            for label, (start, end) in ranges.items():
+                query = {"sensor_id": sensor_id, "time": {"$gte": start, **({"$lt": end} if end else {})}}
+                mongo_seconds, documents = timed(lambda: list(collection.find(query)))
+                archive_seconds, archived = timed(lambda: series_documents(*archive.series_range(sensor_id, measure, start, end), sensor_id))
+                check_readings(f"{collection_name} {label}", documents, archived)
+                row.append((mongo_seconds, archive_seconds))
+
+            bucket_ms = bucket_ms_for(first, last, MAX_POINTS)
+            query = {"sensor_id": sensor_id, "time": {"$gte": first}}
+            mongo_seconds, mongo_buckets = timed(lambda: list(collection.aggregate(bucket_pipeline(query, bucket_ms))))
+            archive_seconds, archived_buckets = timed(lambda: series_buckets(*archive.series_range(sensor_id, measure, first), bucket_ms))
+            check_buckets(f"{collection_name} buckets", mongo_buckets, archived_buckets)
+            row.append((mongo_seconds, archive_seconds))
+            match = RUN_COLLECTION_PATTERN.match(collection_name)
+            label = f"{match['name']}_{measure}{match['test'] or ''} run {match['run']} {str(sensor_id)[-6:]}"
+            print(f"{label:<44} {len(times):>8} " + " ".join(f"{mongo * 1000:>11.2f} {archived * 1000:>12.3f}" for mongo, archived in row))
+
+
+def bench_sizes(database, archive, runs):
+    print(f"\n{'run':>5} {'documents':>10} {'bson KB':>9} {'archive KB':>11} {'ratio':>6}")
+    by_run = {}
+    for collection_name in runs:
+        run = int(collection_name.rsplit("run", 1)[1])
+        documents = list(database[collection_name].find())
+        count, size = by_run.get(run, (0, 0))
+        by_run[run] = (count + len(documents), size + sum(len(bson.encode(document)) for document in documents))
+    for run, (count, size) in sorted(by_run.items()):
+        directory = os.path.join(archive.root, f"run{run}")
+        archived = sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.endswith(".wcol"))
+        print(f"{run:>5} {count:>10} {size / 1024:>9.1f} {archived / 1024:>11.1f} {size / archived:>6.1f}")
+
+
+def bench_route(database, archive):
+    from sys_state import Sys_State
+    from readings_store import Per_Run_Store
+    import app as app_module
+    sample_data.use_database(database)
+    database.settings_collection.update_one({}, {"$set": {"start_date": datetime(2024, 1, 1)}})
+    # the sensor the synthetic readings were stored with, its current run (1000) is empty
+    sensor_id = database[SYNTHETIC].find_one({"time": {"$exists": True}})["sensor_id"]
+    database.sensor_collection.insert_one({"_id": sensor_id, "name": "Synthetic", "type": "water", "tank": 99})
+    database.drop_collection("Synthetic_CO2_collection_run1000")
+    sources = {
+        "mongodb": (database[SYNTHETIC], None),
+        "archive": (database["Synthetic_CO2_collection_run1000"], archive)
+    }
+    print(f"\n/analysis_query/ on the synthetic run ({database[SYNTHETIC].count_documents({})} documents)")
+    print(f"{'variant':<16} {'mongodb ms':>11} {'archive ms':>11} {'mongodb KB':>11} {'archive KB':>11}")
+    for variant, extra in [("raw", {}), ("max_points=500", {"max_points": MAX_POINTS}), ("lttb 500", {"max_points": MAX_POINTS, "downsample": "lttb"})]:
+        row = []
+        answers = []
+        for source, (collection, run_archive) in sources.items():
+            state = Sys_State({"Sensor List": {"Synthetic-CO2": {"id": sensor_id, "name": "Synthetic", "measure": "CO2", "db": collection}},
+                               "reset sensors": False, "Readings Store": Per_Run_Store(database, 1000), "Rollups": None,
+                               "Run Archive": run_archive, "Query Cache": None})
+            client = app_module.Flask_App(state).app.test_client()
+            body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all",
+                    "formattedStart": "0", "formattedEnd": "0", **extra}
+            seconds, response = timed(lambda: client.post("/analysis_query/?compact=1", json=body))
+            answers.append(response.get_json()["sensor_data"]["Synthetic-CO2"])
+            row.append((seconds, len(response.data)))
+        if len(answers[0]) != len(answers[1]):
+            raise AssertionError(f"{variant}: {len(answers[0])} points from MongoDB, {len(answers[1])} from the archive")
+        print(f"{variant:<16} {row[0][0] * 1000:>11.1f} {row[1][0] * 1000:>11.1f} {row[0][1] / 1024:>11.1f} {row[1][1] / 1024:>11.1f}")
+    database.sensor_collection.delete_one({"_id": sensor_id})
+
+
+def bench(uri=None):
+    database = sample_data.connect(uri)
+    collections = sample_data.load_collections()
+    sample_data.restore(database, collections)
+    synthetic_run(database, SYNTHETIC, SYNTHETIC_WEEKS if uri else SYNTHETIC_WEEKS_MONGOMOCK)
+    runs = sample_data.run_collections(collections) + [SYNTHETIC]
+
+    with tempfile.TemporaryDirectory() as root:
+        archive = Run_Archive(root)
+        start = time.perf_counter()
+        converted = archive.archive_dump()
+        print(f"converted runs {converted} of {os.path.basename(sample_data.ZIP_PATH)} in {(time.perf_counter() - start) * 1000:.0f} ms")
+        start = time.perf_counter()
+        archive.archive_run(database, 0)
+        print(f"archived the synthetic run from the database in {(time.perf_counter() - start) * 1000:.0f} ms\n")
+
+        bench_queries(database, archive, runs)
+        bench_sizes(database, archive, runs)
+        bench_route(database, archive)
+        archive.close()
+
+
+if __name__ == "__main__":
+    bench(sys.argv[1] if len(sys.argv) > 1 else None)
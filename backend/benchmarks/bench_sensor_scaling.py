@@ -0,0 +1,98 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import main
+
+#----------------------------------------------------------------------------------------
+#   Acquisition throughput vs sensor count
+#
+#   Runs N simulated sensors through sensor_proc for a fixed time and
+#   counts the readings written, once with the old model (serial read
+#   and DB write inside system_state.hard_lock) and once with the
+#   per-sensor Sensor_State model used by main.sensor_proc now.
+#   Each simulated read blocks for READ_LATENCY seconds like a serial
+#   readline waiting for the meter.
+#
+#   Usage (from backend/): python benchmarks/bench_sensor_scaling.py
+#----------------------------------------------------------------------------------------
+
+READ_LATENCY = 0.01
+RUN_SECONDS = 2.0
+SENSOR_COUNTS = [2, 10, 50, 100, 200]
+
+
+class Simulated_Sensor:
+    def read_data(self, measure):
+        time.sleep(READ_LATENCY)
+        return 5.0
+
+    def disconnect_port(self):
+        pass
+
+
+# collection stand-in that only counts writes
+class Counting_Collection:
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def insert_one(self, doc):
+        with self.lock:
+            self.count += 1
+
+
+# the pre Sensor_State loop: read and store while holding the global lock
+# record_reading looks its services up in system_state, whose lock is not
+# reentrant, so the store is looked up before and the insert done inline
+def global_lock_proc(sensor_wrapper):
+    state = main.system_state
+    readings_store = state.get_ref("Readings Store")
+    while not state.get("terminate"):
+        state.hard_lock()
+        try:
+            value = sensor_wrapper["sensor"].read_data(sensor_wrapper["measure"])
+            read_time = datetime.now()
+            sensor_wrapper["readings"].push({"value": value, "time": read_time.timestamp()})
+            sensor_wrapper["db"].insert_one(readings_store.document(sensor_wrapper, value, read_time))
+        finally:
+            state.hard_release()
+
+
+def run(count, target):
+    collection = Counting_Collection()
+    main.system_state.set("terminate", False)
+    main.system_state.set("reset sensors", False)
+    main.system_state.set("Read Frequency", 0)
+    main.system_state.set("last emails", time.time())
+
+    threads = []
+    for i in range(count):
+        wrapper = main.new_sensor_wrapper(Simulated_Sensor(), i, f"Sim{i}", "CO2", 10.0, 0.0, collection)
+        threads.append(threading.Thread(target=target, args=[wrapper]))
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(RUN_SECONDS)
+    main.system_state.set("terminate", True)
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return collection.count / elapsed
+
+
+def bench():
+    print(f"{'sensors':>8} {'global lock r/s':>16} {'per-sensor r/s':>16} {'speedup':>8}")
+    for count in SENSOR_COUNTS:
+        old = run(count, global_lock_proc)
+        new = run(count, main.sensor_proc)
+        print(f"{count:>8} {old:>16.1f} {new:>16.1f} {new / old:>8.1f}x")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,122 @@
+import os
+import resource
+import statistics
+import sys
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from async_engine import Async_Engine
+from sensor_simulator import Simulator_Farm, create_model
+from serial_mux import Serial_Mux
+from sys_state import Sys_State
+from w_sensor import MEASURE_FIELDS, Water_Sensor
+
+#----------------------------------------------------------------------------------------
+#   Acquisition engines on pty serial ports
+#
+#   DEVICE_COUNTS simulated meters (sensor_simulator.py), each writing a
+#   #DATA: frame every FRAME_INTERVAL seconds to a pty, read through a
+#   real Water_Sensor on the slave side and sampled every READ_FREQUENCY
+#   seconds by:
+#       threaded  one thread per device, read_frame then sleep (device_proc)
+#       async     Async_Engine, loop.add_reader on every port
+#       selector  Serial_Mux, one thread and one selector for every port
+#   Reports the threads the engine added, CPU seconds per wall second,
+#   readings recorded per second (the ideal is devices / READ_FREQUENCY),
+#   the age of the recorded frames (record time - arrival time) and
+#   failed reads.
+#
+#   Usage (from backend/): python benchmarks/bench_serial_mux.py
+#----------------------------------------------------------------------------------------
+
+DEVICE_COUNTS = [10, 100, 300]
+ENGINES = ["threaded", "async", "selector"]
+FRAME_INTERVAL = 0.1
+READ_FREQUENCY = 0.5
+RUN_SECONDS = 5.0
+
+
+# device_proc without the system state flags
+# pyserial selects the port on every read, which fails for descriptors
+# past 1023 (a few hundred ports), those reads are counted in errors
+def device_thread(wrappers, stop, record, errors):
+    sensor = wrappers[0]["sensor"]
+    while not stop.is_set():
+        try:
+            frame = sensor.read_frame()
+        except ValueError:
+            errors[0] += 1
+            frame = None
+        if frame is not None:
+            for wrapper in wrappers:
+                record(wrapper, frame[wrapper["measure"]], frame.time)
+        stop.wait(READ_FREQUENCY)
+
+
+def run(engine, count):
+    farm = Simulator_Farm(FRAME_INTERVAL)
+    ports = [farm.add_device({measure: create_model({"noise": 0.1, "seed": number}, measure) for measure in MEASURE_FIELDS})
+             for number in range(count)]
+    farm.start()
+    devices = []
+    for number, port in enumerate(ports):
+        sensor = Water_Sensor(port, 19200)
+        devices.append([{"sensor": sensor, "name": f"Pty{number}", "measure": measure} for measure in MEASURE_FIELDS])
+    state = Sys_State({"Read Frequency": READ_FREQUENCY})
+
+    ages = []
+    recorded = [0]
+    errors = [0]
+    def record(wrapper, value, read_time):
+        recorded[0] += 1
+        if wrapper["measure"] == "CO2":
+            ages.append((datetime.now() - read_time).total_seconds())
+
+    threads_before = threading.active_count()
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    if engine == "threaded":
+        stop = threading.Event()
+        device_threads = [threading.Thread(target=device_thread, args=[wrappers, stop, record, errors]) for wrappers in devices]
+        for thread in device_threads:
+            thread.start()
+    else:
+        acquisition = (Async_Engine if engine == "async" else Serial_Mux)(state, record)
+        acquisition.start(devices)
+    time.sleep(RUN_SECONDS)
+    added_threads = threading.active_count() - threads_before
+    cpu = (time.process_time() - cpu_start) / (time.monotonic() - wall_start)
+    readings = recorded[0] / len(MEASURE_FIELDS) / RUN_SECONDS
+
+    if engine == "threaded":
+        stop.set()
+        for thread in device_threads:
+            thread.join()
+        for wrappers in devices:
+            wrappers[0]["sensor"].disconnect_port()
+    else:
+        acquisition.stop()
+    farm.stop()
+    ages.sort()
+    return {"threads": added_threads, "errors": errors[0], "cpu": cpu, "readings_per_s": readings,
+            "age_p50_ms": ages[len(ages) // 2] * 1000 if ages else 0.0,
+            "age_p99_ms": ages[int(len(ages) * 0.99)] * 1000 if ages else 0.0,
+            "age_mean_ms": statistics.fmean(ages) * 1000 if ages else 0.0}
+
+
+def bench():
+    print(f"{'engine':>9} {'devices':>8} {'threads':>8} {'cpu':>6} {'readings/s':>11} {'ideal':>6} "
+          f"{'age p50 ms':>11} {'age p99 ms':>11} {'errors':>7}")
+    for count in DEVICE_COUNTS:
+        for engine in ENGINES:
+            result = run(engine, count)
+            print(f"{engine:>9} {count:>8} {result['threads']:>8} {result['cpu']:>6.3f} {result['readings_per_s']:>11.1f} "
+                  f"{count / READ_FREQUENCY:>6.0f} {result['age_p50_ms']:>11.2f} {result['age_p99_ms']:>11.2f} {result['errors']:>7}")
+    print(f"\npeak rss {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    bench()
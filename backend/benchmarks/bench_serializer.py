@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+import time
+from bson import json_util
+from flask import jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+
+#----------------------------------------------------------------------------------------
+#   BSON -> JSON response encoding
+#
+#   Encodes every reading in WAASMA_flaskdb.zip the way /analysis_query/
+#   used to (json_util.dumps -> json.loads -> jsonify) and with
+#   json_response from app.py, normal and compact (epoch ms times).
+#   Reports the best of REPEATS runs and the response size.
+#
+#   Usage (from backend/): python benchmarks/bench_serializer.py
+#----------------------------------------------------------------------------------------
+
+REPEATS = 5
+
+
+def best_of(encode) -> tuple:
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        body = encode()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, len(body)
+
+
+def bench():
+    import app as app_module
+    collections = sample_data.load_collections()
+    payload = {name: collections[name] for name in sample_data.run_collections(collections)}
+    count = sum(len(documents) for documents in payload.values())
+
+    flask_app = app_module.Flask_App(None).app
+    with flask_app.test_request_context():
+        def old_path():
+            json_data = json.loads(json_util.dumps(payload))
+            return jsonify({"sensor_data": json_data}).get_data()
+
+        variants = [
+            ("json_util + jsonify", old_path),
+            ("json_response", lambda: app_module.json_response({"sensor_data": payload}).get_data()),
+            ("json_response compact", lambda: app_module.json_response({"sensor_data": payload}, compact=True).get_data()),
+        ]
+        print(f"{count} documents")
+        print(f"{'encoder':<24} {'ms':>8} {'docs/s':>10} {'KB':>8}")
+        for label, encode in variants:
+            elapsed, size = best_of(encode)
+            print(f"{label:<24} {elapsed * 1000:>8.1f} {count / elapsed:>10.0f} {size / 1024:>8.1f}")
+
+
+if __name__ == "__main__":
+    bench()
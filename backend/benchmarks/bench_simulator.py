@@ -0,0 +1,87 @@
+import os
+import selectors
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from sensor_simulator import Simulator_Farm, Replay_Model, create_model, load_recorded_runs
+from serial_framing import Frame_Reader
+from w_sensor import MEASURE_FIELDS, parse_data_line
+
+#----------------------------------------------------------------------------------------
+#   Simulator farm frame rates
+#
+#   Signal devices: DEVICE_COUNTS devices at INTERVAL seconds each, every
+#   pty drained by one selector thread and every line parsed by a
+#   Frame_Reader with the Water_Sensor parser. Reports the frames asked for, written,
+#   dropped and parsed per second.
+#   Replay: every recorded run of WAASMA_flaskdb.zip at SPEEDS, frames
+#   per second the farm writes for them.
+#
+#   Usage (from backend/): python benchmarks/bench_simulator.py
+#----------------------------------------------------------------------------------------
+
+DEVICE_COUNTS = [10, 100, 300]
+INTERVAL = 0.1
+SPEEDS = [1, 10, 100, 1000]
+RUN_SECONDS = 3.0
+
+
+# reads every slave side and parses the complete lines
+def drain(ports, stop, counts):
+    selector = selectors.DefaultSelector()
+    files = [os.open(port, os.O_RDONLY | os.O_NONBLOCK | os.O_NOCTTY) for port in ports]
+    readers = {}
+    for fd, port in zip(files, ports):
+        selector.register(fd, selectors.EVENT_READ)
+        readers[fd] = Frame_Reader(parse_data_line, port)
+    while not stop.is_set():
+        for key, _ in selector.select(0.1):
+            counts["parsed"] += len(readers[key.fd].feed(os.read(key.fd, 65536)))
+    counts["bad"] = sum(reader.corrupt for reader in readers.values())
+    for fd in files:
+        os.close(fd)
+
+
+def run_farm(add_devices, seconds):
+    farm = Simulator_Farm(INTERVAL)
+    ports = add_devices(farm)
+    counts = {"parsed": 0, "bad": 0}
+    stop = threading.Event()
+    reader = threading.Thread(target=drain, args=[ports, stop, counts])
+    reader.start()
+    farm.start()
+    time.sleep(seconds)
+    stats = farm.stats()
+    farm.stop()
+    time.sleep(0.2)
+    stop.set()
+    reader.join()
+    return stats, counts
+
+
+def bench():
+    print(f"{'devices':>8} {'asked/s':>9} {'written/s':>10} {'dropped':>8} {'parsed/s':>9} {'bad':>5}")
+    for count in DEVICE_COUNTS:
+        def add_devices(farm):
+            return [farm.add_device({measure: create_model({"noise": 0.2, "spike_rate": 0.01, "spike_size": 5, "seed": number}, measure)
+                                     for measure in MEASURE_FIELDS}) for number in range(count)]
+        stats, counts = run_farm(add_devices, RUN_SECONDS)
+        print(f"{count:>8} {count / INTERVAL:>9.0f} {stats['frames'] / RUN_SECONDS:>10.0f} {stats['dropped']:>8} "
+              f"{counts['parsed'] / RUN_SECONDS:>9.0f} {counts['bad']:>5}")
+
+    runs = load_recorded_runs()
+    print(f"\n{len(runs)} recorded runs replayed")
+    print(f"{'speed':>8} {'written/s':>10} {'dropped':>8} {'parsed/s':>9}")
+    for speed in SPEEDS:
+        def add_devices(farm):
+            return [farm.add_device({measure: Replay_Model(times, values, speed) for measure, (times, values) in run.items()})
+                    for run in runs.values()]
+        stats, counts = run_farm(add_devices, RUN_SECONDS)
+        print(f"{speed:>7}x {stats['frames'] / RUN_SECONDS:>10.0f} {stats['dropped']:>8} {counts['parsed'] / RUN_SECONDS:>9.0f}")
+
+
+if __name__ == "__main__":
+    bench()
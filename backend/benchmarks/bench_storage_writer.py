@@ -0,0 +1,94 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from storage_writer import Storage_Writer
+
+#----------------------------------------------------------------------------------------
+#   Ingest rate: insert_one per reading vs the batching Storage_Writer
+#
+#   SENSORS threads each produce READINGS documents as fast as they can.
+#   The collection stand-in charges ROUND_TRIP seconds per call plus a
+#   small per-document cost, which is roughly how a local mongod behaves.
+#   Pass a MongoDB URI as the first argument to use a real server instead.
+#
+#   Usage (from backend/): python benchmarks/bench_storage_writer.py [mongodb://...]
+#----------------------------------------------------------------------------------------
+
+SENSORS = 100
+READINGS = 50
+ROUND_TRIP = 0.001
+PER_DOCUMENT = 0.00001
+
+
+class Latency_Collection:
+    name = "latency_collection"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    # one network round trip at a time, like a single pooled connection
+    def insert_one(self, doc):
+        with self.lock:
+            time.sleep(ROUND_TRIP + PER_DOCUMENT)
+            self.count += 1
+
+    def insert_many(self, docs, ordered=True):
+        with self.lock:
+            time.sleep(ROUND_TRIP + PER_DOCUMENT * len(docs))
+            self.count += len(docs)
+
+
+def produce(store, collection, sensor):
+    for i in range(READINGS):
+        store(collection, {"value": float(i), "time": time.time(), "sensor_id": sensor})
+
+
+def run(store, collection):
+    threads = [threading.Thread(target=produce, args=[store, collection, i]) for i in range(SENSORS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def bench(collection_factory):
+    total = SENSORS * READINGS
+
+    collection = collection_factory()
+    elapsed = run(lambda c, doc: c.insert_one(doc), collection)
+    print(f"insert_one:     {total / elapsed:>10.0f} rows/s")
+
+    for batch_size, interval in [(100, 0.5), (500, 1.0), (2000, 1.0)]:
+        collection = collection_factory()
+        writer = Storage_Writer(batch_size, interval)
+        writer.start()
+        start = time.perf_counter()
+        run(writer.put, collection)
+        writer.stop()   # includes writing out the tail of the queue
+        elapsed = time.perf_counter() - start
+        stats = writer.stats()
+        print(f"writer b={batch_size:<5} i={interval:<4} {total / elapsed:>10.0f} rows/s  "
+              f"flushes={stats['flushes']} max flush={stats['max_flush_seconds'] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        from pymongo import MongoClient
+        client = MongoClient(sys.argv[1])
+        database = client.WAASMA_benchmark
+
+        def collection_factory():
+            database.drop_collection("storage_writer_bench")
+            return database.storage_writer_bench
+
+        bench(collection_factory)
+        client.drop_database("WAASMA_benchmark")
+    else:
+        bench(Latency_Collection)
@@ -0,0 +1,71 @@
+import os
+import sys
+import zipfile
+import bson
+
+#----------------------------------------------------------------------------------------
+#   Recorded data for the benchmarks
+#
+#   Loads the mongodump in WAASMA_flaskdb.zip at the repository root
+#   (settings, sensors, users and the Water*_collection_run* readings)
+#   and restores it into a benchmark database, either on a MongoDB
+#   server given by URI or, without a URI, into an in-process mongomock
+#   stand-in so the benchmarks also run without a mongod.
+#----------------------------------------------------------------------------------------
+
+ZIP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "WAASMA_flaskdb.zip")
+DATABASE_NAME = "WAASMA_benchmark"
+
+# backend modules that import collections from db_config
+DB_CONFIG_USERS = ["app", "main"]
+
+
+# collection name -> list of documents from the dump
+def load_collections(path=ZIP_PATH) -> dict:
+    collections = {}
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            if name.endswith(".bson"):
+                collection = os.path.basename(name)[:-len(".bson")]
+                collections[collection] = bson.decode_all(archive.read(name))
+    return collections
+
+
+# names of the per run reading collections in the dump
+def run_collections(collections) -> list:
+    return sorted(name for name in collections if "_collection_run" in name)
+
+
+# benchmark database on the given server, mongomock without a URI
+def connect(uri=None):
+    if uri:
+        from pymongo import MongoClient
+        return MongoClient(uri)[DATABASE_NAME]
+    import mongomock
+    return mongomock.MongoClient()[DATABASE_NAME]
+
+
+# replace the benchmark database contents with the given collections
+def restore(database, collections) -> None:
+    for name, documents in collections.items():
+        database.drop_collection(name)
+        if documents:
+            database[name].insert_many([dict(document) for document in documents])
+
+
+# point db_config (and the modules that imported from it) at database
+def use_database(database) -> None:
+    import db_config
+    db_config.db = database
+    names = ["user_collection", "settings_collection", "sensor_collection", "test_sensor_collection", "sensor_config_collection"]
+    for name in names:
+        setattr(db_config, name, database[name])
+    for module_name in DB_CONFIG_USERS:
+        module = sys.modules.get(module_name)
+        if module is None:
+            continue
+        if hasattr(module, "db"):
+            module.db = database
+        for name in names:
+            if hasattr(module, name):
+                setattr(module, name, database[name])
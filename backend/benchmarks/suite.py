@@ -0,0 +1,372 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from bson import ObjectId
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import sample_data
+from bench_analysis_query import synthetic_run
+
+#----------------------------------------------------------------------------------------
+#   End to end benchmark suite, results as JSON
+#
+#   Runs against a MongoDB server given by URI or, without one, the
+#   in-process mongomock stand-in (see sample_data.py). Sections:
+#       ingest          readings/s stored end to end (sensor threads,
+#                       record_reading, storage writer, database) for
+#                       INGEST_SENSORS simulated devices at each of
+#                       INGEST_FREQUENCIES read frequencies, over the
+#                       whole read periods after the first read
+#       analysis_query  latency and payload size of /analysis_query/ for
+#                       ranges of QUERY_HOURS on a synthetic run and the
+#                       longest recorded run of WAASMA_flaskdb.zip, raw and
+#                       with max_points=500
+#       socket          time for an update/packet request to be answered
+#                       and broadcast to SOCKET_CLIENTS connected clients
+#       lock_wait       time threads wait for the Sys_State lock with
+#                       LOCK_THREADS sensor threads and a dashboard reader
+#   The JSON (to --output or stdout) has one list of result rows per
+#   section plus the run's metadata, tables go to stderr. --compare
+#   prints the change of every number against an earlier JSON file.
+#
+#   Usage (from backend/):
+#       python benchmarks/suite.py [--uri mongodb://...] [--only ingest,socket]
+#                                  [--output results.json] [--compare baseline.json]
+#----------------------------------------------------------------------------------------
+
+INGEST_SENSORS = [10, 50, 200]
+INGEST_FREQUENCIES = [0.1, 1.0]
+INGEST_SECONDS = 3.0
+
+QUERY_HOURS = [1, 6, 24, 168]
+QUERY_REPEAT = 3
+SYNTHETIC_WEEKS = 1
+SYNTHETIC_WEEKS_MONGOMOCK = 1 / 7
+
+SOCKET_CLIENTS = [1, 10, 50, 200]
+SOCKET_SENSORS = 20
+SOCKET_REQUESTS = 50
+
+LOCK_THREADS = [1, 10, 50, 200]
+LOCK_SECONDS = 2.0
+
+SECTIONS = ["ingest", "analysis_query", "socket", "lock_wait"]
+
+# fields that identify a result row of each section, for --compare
+ROW_KEYS = {"ingest": ["sensors", "read_frequency"], "analysis_query": ["run", "range_hours", "variant"],
+            "socket": ["clients", "event"], "lock_wait": ["threads"]}
+
+
+def table(title, header, rows):
+    print(f"\n{title}", file=sys.stderr)
+    print(" ".join(f"{name:>14}" for name in header), file=sys.stderr)
+    for row in rows:
+        cells = [f"{row[name]:>14.3f}" if isinstance(row[name], float) else f"{str(row[name])[-14:]:>14}" for name in header]
+        print(" ".join(cells), file=sys.stderr)
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# state the app and the acquisition code expect, as main sets it up
+def reset_state(state, database):
+    from readings_store import Per_Run_Store
+    state.set("terminate", False)
+    state.set("reset sensors", False)
+    state.set("Sensor List", {})
+    state.set("Readings Store", Per_Run_Store(database, 0))
+    state.set("Rollups", None)
+    state.set("Storage Writer", None)
+    state.set("Web App", None)
+    state.set("last emails", time.time())
+
+
+#   ingest
+def bench_ingest(database, uri):
+    import main
+    from random_test_sensor import Random_Test_Sensor
+    from storage_writer import Storage_Writer
+    state = main.system_state
+    rows = []
+    for frequency in INGEST_FREQUENCIES:
+        for count in INGEST_SENSORS:
+            reset_state(state, database)
+            state.set("Read Frequency", frequency)
+            state.set("Acquisition Mode", "device")
+            state.set("Acquisition Engine", "threaded")
+            collections = []
+            for number in range(count):
+                sensor = Random_Test_Sensor({"noise": 0.1, "seed": number})
+                for measure in ["CO2", "DO"]:
+                    collection = database[f"Ingest{number}_{measure}_collection_bench"]
+                    database.drop_collection(collection.name)
+                    collections.append(collection)
+                    state.add_to_dict("Sensor List", f"Ingest{number}-{measure}",
+                                      main.new_sensor_wrapper(sensor, number, f"Ingest{number}", measure, 40.0, 0.0, collection))
+            writer = Storage_Writer()
+            writer.start()
+            state.set("Storage Writer", writer)
+
+            acquisition = main.start_acquisition()
+            time.sleep(INGEST_SECONDS)
+            state.set("terminate", True)
+            main.stop_acquisition(acquisition)
+            writer.stop()
+
+            # every device reads once right at the start, the rate is taken
+            # over the whole periods after that first read: the readings of
+            # each collection from its second one, for `periods` periods
+            periods = max(1, int(INGEST_SECONDS / frequency) - 1)
+            stored = counted = 0
+            for collection in collections:
+                times = [document["time"] for document in collection.find({}, {"time": 1}).sort("time", 1)]
+                stored += len(times)
+                if times:
+                    end = times[0] + timedelta(seconds=(periods + 0.5) * frequency)
+                    counted += sum(1 for read_time in times[1:] if read_time < end)
+                database.drop_collection(collection.name)
+            rows.append({"sensors": count, "read_frequency": frequency,
+                         "target_per_s": 2 * count / frequency,
+                         "readings_per_s": counted / (periods * frequency),
+                         "readings": stored})
+    table("ingest", ["sensors", "read_frequency", "target_per_s", "readings_per_s"], rows)
+    return rows
+
+
+#   analysis_query
+def bench_analysis_query(database, uri):
+    import app as app_module
+    from sys_state import Sys_State
+    from readings_store import Per_Run_Store
+    collections = sample_data.load_collections()
+    sample_data.restore(database, collections)
+    sample_data.use_database(database)
+
+    runs = sample_data.run_collections(collections)
+    recorded = max(runs, key=lambda name: len(collections[name]))
+    synthetic = "Synthetic_CO2_collection_run0"
+    synthetic_run(database, synthetic, SYNTHETIC_WEEKS if uri else SYNTHETIC_WEEKS_MONGOMOCK)
+
+    sensor_id = ObjectId()
+    database.sensor_collection.insert_one({"_id": sensor_id, "name": "Suite", "type": "water", "tank": 99})
+    state = Sys_State({"Sensor List": {}, "reset sensors": False, "Readings Store": Per_Run_Store(database, 0), "Rollups": None, "Run Archive": None, "Query Cache": None})
+    client = app_module.Flask_App(state).app.test_client()
+
+    rows = []
+    for run in [recorded, synthetic]:
+        collection = database[run]
+        measure = "CO2" if "_CO2_" in run else "DO"
+        state.set("Sensor List", {run: {"id": sensor_id, "name": run, "measure": measure, "db": collection}})
+        first = collection.find_one({"time": {"$exists": True}}, sort=[("time", 1)])["time"]
+        last = collection.find_one({"time": {"$exists": True}}, sort=[("time", -1)])["time"]
+        span_hours = (last - first).total_seconds() / 3600
+        for hours in [hours for hours in QUERY_HOURS if hours <= span_hours] + [round(span_hours, 2)]:
+            end = first + timedelta(hours=hours)
+            for variant, extra in [("raw", {}), ("max_points=500", {"max_points": 500})]:
+                body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all",
+                        "formattedStart": first.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+                        "formattedEnd": end.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z", **extra}
+                timings = []
+                for _ in range(QUERY_REPEAT):
+                    start = time.perf_counter()
+                    response = client.post("/analysis_query/", json=body)
+                    timings.append(time.perf_counter() - start)
+                rows.append({"run": run, "range_hours": float(hours), "variant": variant,
+                             "status": response.status_code,
+                             "latency_ms": statistics.median(timings) * 1000,
+                             "payload_kb": len(response.data) / 1024})
+    database.sensor_collection.delete_one({"_id": sensor_id})
+    table("analysis_query", ["run", "range_hours", "variant", "latency_ms", "payload_kb"], rows)
+    return rows
+
+
+#   socket
+def bench_socket(database, uri):
+    import app as app_module
+    from sys_state import Sys_State
+    from sensor_state import Sensor_State
+    sensor_list = {}
+    for number in range(SOCKET_SENSORS):
+        for measure in ["CO2", "DO"]:
+            readings = Sensor_State(100)
+            for i in range(100):
+                readings.push({"value": 20.0 + i % 7, "time": 1.7e9 + i * 5})
+            sensor_list[f"Socket{number}-{measure}"] = {"id": ObjectId(), "name": f"Socket{number}", "measure": measure, "readings": readings}
+    state = Sys_State({"Sensor List": sensor_list, "reset sensors": False, "Rollups": None, "Web App": None})
+    web_app = app_module.Flask_App(state)
+
+    rows = []
+    for count in SOCKET_CLIENTS:
+        clients = [web_app.socketio.test_client(web_app.app) for _ in range(count)]
+        for event, reply in [("update", "update_home"), ("packet", "packet_home")]:
+            timings = []
+            for _ in range(SOCKET_REQUESTS):
+                start = time.perf_counter()
+                clients[0].emit(event, {"request": "home"})
+                timings.append(time.perf_counter() - start)
+                # every client got the broadcast
+                for client in clients:
+                    assert any(message["name"] == reply for message in client.get_received())
+            rows.append({"clients": count, "event": event,
+                         "mean_ms": statistics.fmean(timings) * 1000,
+                         "p99_ms": percentile(timings, 0.99) * 1000})
+        for client in clients:
+            client.disconnect()
+    table("socket", ["clients", "event", "mean_ms", "p99_ms"], rows)
+    return rows
+
+
+#   lock_wait
+# Sys_State lock that records how long every acquire waited
+class Timed_Lock:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = []
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self.lock.acquire(blocking, timeout)
+        self.waits.append(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+def bench_lock_wait(database, uri):
+    from sys_state import Sys_State
+    from sensor_state import Sensor_State
+    rows = []
+    for count in LOCK_THREADS:
+        sensor_list = {f"Lock{number}-{measure}": {"id": number, "name": f"Lock{number}", "measure": measure, "readings": Sensor_State(100)}
+                       for number in range(count) for measure in ["CO2", "DO"]}
+        state = Sys_State({"terminate": False, "reset sensors": False, "Read Frequency": 5, "Sensor List": sensor_list,
+                           "Readings Store": None, "Storage Writer": None, "Web App": None, "Rollups": None,
+                           "last emails": time.time()}, ["terminate"])
+        state.lock = Timed_Lock()
+        state.changed = threading.Condition(state.lock)
+        stop = threading.Event()
+        operations = [0]
+
+        # what a sensor thread does around each reading
+        def sensor_thread():
+            while not stop.is_set():
+                state.get("terminate")
+                state.get("reset sensors")
+                state.get_ref("Web App")
+                state.get_ref("Readings Store")
+                state.get_ref("Storage Writer")
+                state.get_ref("Rollups")
+                operations[0] += 6
+                time.sleep(0.001)
+
+        # what the socket handlers and /sensors do
+        def dashboard_thread():
+            while not stop.is_set():
+                state.get("Sensor List")
+                operations[0] += 1
+                time.sleep(0.01)
+
+        threads = [threading.Thread(target=sensor_thread) for _ in range(count)] + [threading.Thread(target=dashboard_thread)]
+        for thread in threads:
+            thread.start()
+        time.sleep(LOCK_SECONDS)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        waits = state.lock.waits
+        rows.append({"threads": count, "acquires": len(waits),
+                     "operations_per_s": operations[0] / LOCK_SECONDS,
+                     "wait_mean_us": statistics.fmean(waits) * 1e6 if waits else 0.0,
+                     "wait_p99_us": percentile(waits, 0.99) * 1e6,
+                     "wait_max_us": max(waits, default=0.0) * 1e6})
+    table("lock_wait", ["threads", "operations_per_s", "wait_mean_us", "wait_p99_us", "wait_max_us"], rows)
+    return rows
+
+
+def metadata(uri):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"time": datetime.now().isoformat(timespec="seconds"), "commit": commit,
+            "database": "mongod" if uri else "mongomock", "python": platform.python_version(),
+            "machine": platform.machine(), "cpus": os.cpu_count()}
+
+
+# numbers of a results file by "section/row key/field"
+def flatten(results):
+    out = {}
+    for section in SECTIONS:
+        for row in results.get(section, []):
+            key = ",".join(f"{name}={row[name]}" for name in ROW_KEYS[section])
+            for name, value in row.items():
+                if isinstance(value, (int, float)) and name not in ROW_KEYS[section]:
+                    out[f"{section}/{key}/{name}"] = value
+    return out
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as file:
+        baseline = flatten(json.load(file))
+    print(f"\nchange against {baseline_path}", file=sys.stderr)
+    for key, value in flatten(results).items():
+        if key in baseline and baseline[key]:
+            print(f"{key:<90} {baseline[key]:>12.3f} -> {value:>12.3f} {(value / baseline[key] - 1) * 100:>+8.1f}%", file=sys.stderr)
+
+
+def run(uri=None, only=None):
+    database = sample_data.connect(uri)
+    # the backend modules use the benchmark database
+    import main
+    import app
+    sample_data.use_database(database)
+    results = {"meta": metadata(uri)}
+    benches = {"ingest": bench_ingest, "analysis_query": bench_analysis_query, "socket": bench_socket, "lock_wait": bench_lock_wait}
+    for section in SECTIONS:
+        if only and section not in only:
+            continue
+        results[section] = benches[section](database, uri)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End to end benchmark suite")
+    parser.add_argument("--uri", help="MongoDB URI, mongomock without one")
+    parser.add_argument("--only", help="comma separated sections: " + ",".join(SECTIONS))
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    arguments = parser.parse_args()
+
+    # the backend prints on every reading and request
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = run(arguments.uri, arguments.only.split(",") if arguments.only else None)
+    if arguments.output:
+        with open(arguments.output, "w") as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if arguments.compare:
+        compare(results, arguments.compare)
@@ -1,18 +1,240 @@
-
-# class for checking incoming data measurements
-class Check_Data:
-
-    # constructor
-    def __init__(self, input) -> None:
-        self.data = ""
-    
-    # grab range from db?
-    def get_range(self, sensor) -> None:
-        self.data = sensor
-
-    # check data with range
-    def check_data(self, measurement) -> bool:
-        if self.data:
-            return True
-        else:
-            return False
\ No newline at end of file
+import threading
+import time
+import numpy as np
+
+#----------------------------------------------------------------------------------------
+#   Anomaly checks for the incoming readings
+#
+#   Check_Data evaluates the recent window of many sensors at once: the
+#   windows are packed into one (sensors x readings) array, newest reading
+#   in the last column and NaN padding on the left, and every rule is a
+#   handful of NumPy operations over that array. It runs on its own
+#   thread (check_proc in main.py), never on the acquisition threads.
+#
+#   Rules, evaluated on every reading newer than the last check, oldest
+#   first, each over the window of readings ending with it:
+#       range       outside the sensor's low/high range
+#       zscore      further than zscore_raise standard deviations from the
+#                   mean of the zscore_window readings before it
+#       rate        changed faster than rate_limit (fraction of the range
+#                   per minute) since the previous reading
+#       flatline    the last flat_points readings all within flat_epsilon,
+#                   a stuck sensor or a dead probe
+#
+#   Hysteresis: a rule is raised once and stays active until the reading
+#   is back well inside the limit (range: hysteresis * range inside low/high,
+#   zscore: below zscore_clear, rate: below rate_clear * rate_limit,
+#   flatline: any change), so a reading hovering at a threshold raises one
+#   alert instead of one per reading. check() returns only the changes,
+#   as "raised"/"cleared" events.
+#   Up to backlog readings per sensor are evaluated in one check, the
+#   windows are then window + backlog - 1 readings wide (columns). A
+#   sensor without a new reading since the last check is skipped.
+#----------------------------------------------------------------------------------------
+
+RULES = ("range", "zscore", "rate", "flatline")
+
+DEFAULT_RULES = {
+    # rules that are evaluated
+    "rules": RULES,
+    # range: clear once the reading is this fraction of the range inside low/high
+    "hysteresis": 0.05,
+    # zscore: readings the mean/deviation is taken over, fewest needed
+    "zscore_window": 60,
+    "zscore_min_points": 20,
+    "zscore_raise": 4.0,
+    "zscore_clear": 2.5,
+    # smallest deviation used, fraction of the range, keeps steady
+    # integer readings from raising on their first step
+    "zscore_floor": 0.01,
+    # rate: fraction of the range per minute, clear below rate_clear of it
+    "rate_limit": 0.5,
+    "rate_clear": 0.5,
+    # flatline: identical readings in a row (60 is five minutes at 5 s)
+    "flat_points": 60,
+    "flat_epsilon": 0.0,
+    # new readings of a sensor evaluated per check, older ones are skipped
+    "backlog": 40,
+}
+
+class Check_Data:
+
+    # constructor, rules overrides entries of DEFAULT_RULES
+    def __init__(self, rules=None) -> None:
+        self.rules = dict(DEFAULT_RULES)
+        self.rules.update(rules or {})
+        self.enabled = np.array([rule in self.rules["rules"] for rule in RULES])
+        # readings a window needs to cover every rule
+        self.window = max(int(self.rules["zscore_window"]) + 1, int(self.rules["flat_points"]), 2)
+        # readings check() packs per sensor, the window of the oldest new reading on
+        self.columns = self.window + max(1, int(self.rules["backlog"])) - 1
+
+        # state per sensor key, rows of self.active / self.last_time
+        self.lock = threading.Lock()
+        self.index = {}
+        self.active = np.zeros((0, len(RULES)), dtype=bool)
+        self.last_time = np.zeros(0)
+
+        # statistics
+        self.checks = 0
+        self.windows = 0
+        self.seconds = 0.0
+
+    # checks a batch of sensor windows
+    # windows: (key, times, values, low, high) with times/values arrays
+    # oldest first, only the last self.columns readings are used
+    # Returns the raised/cleared events, see check_arrays
+    def check(self, windows) -> list:
+        keys = [window[0] for window in windows]
+        times = np.full((len(windows), self.columns), np.nan)
+        values = np.full((len(windows), self.columns), np.nan)
+        for row, (_, window_times, window_values, _, _) in enumerate(windows):
+            n = min(len(window_values), self.columns)
+            if n > 0:
+                times[row, self.columns - n:] = window_times[len(window_times) - n:]
+                values[row, self.columns - n:] = window_values[len(window_values) - n:]
+        low = np.array([window[3] for window in windows], dtype=np.float64)
+        high = np.array([window[4] for window in windows], dtype=np.float64)
+        return self.check_arrays(keys, times, values, low, high)
+
+    # checks windows already packed into (sensors x readings) arrays,
+    # newest reading last, NaN where a sensor has fewer readings
+    # Every reading newer than the last check is evaluated, oldest first,
+    # as long as a full self.window of columns ends with it
+    # Returns a list of {"sensor", "rule", "state", "value", "time", "detail"}
+    # in the order the readings were evaluated
+    def check_arrays(self, keys, times, values, low, high) -> list:
+        start = time.perf_counter()
+        with self.lock:
+            rows = self._rows(keys)
+
+            # new readings per sensor, the newest columns (NaN times compare False)
+            new = (times > self.last_time[rows][:, None]) & ~np.isnan(values)
+            pending = np.minimum(new.sum(axis=1), max(1, times.shape[1] - self.window + 1))
+            if not pending.any():
+                return []
+
+            # one step per reading back from the newest, all sensors
+            # with a reading that far back are evaluated together
+            events = []
+            for back in range(int(pending.max()) - 1, -1, -1):
+                picked = np.flatnonzero(pending > back)
+                end = times.shape[1] - back
+                columns = slice(max(0, end - self.window), end)
+                events += self._step(keys, picked, rows[picked], times[picked, columns], values[picked, columns],
+                                     low[picked], high[picked])
+                self.windows += len(picked)
+
+            self.checks += 1
+            self.seconds += time.perf_counter() - start
+            return events
+
+    # rules that are currently raised for a sensor key
+    def active_rules(self, key) -> list:
+        with self.lock:
+            row = self.index.get(key)
+            if row is None:
+                return []
+            return [rule for rule, active in zip(RULES, self.active[row]) if active]
+
+    # drops the state of sensors that were removed
+    def forget(self, keys) -> None:
+        with self.lock:
+            for key in keys:
+                row = self.index.get(key)
+                if row is not None:
+                    self.active[row] = False
+                    self.last_time[row] = -np.inf
+
+    # counters for monitoring
+    def stats(self) -> dict:
+        with self.lock:
+            return {"checks": self.checks, "windows": self.windows, "seconds": self.seconds,
+                    "active": {key: [rule for rule, active in zip(RULES, self.active[row]) if active]
+                               for key, row in self.index.items() if self.active[row].any()}}
+
+    # evaluates the newest reading of the picked windows and moves their
+    # rule states on, returns the changes as events (lock held)
+    def _step(self, keys, picked, rows, times, values, low, high) -> list:
+        latest = values[:, -1]
+        latest_time = times[:, -1]
+        raise_, clear, detail = self._evaluate(times, values, low, high, latest)
+
+        before = self.active[rows]
+        after = np.where(before, ~clear, raise_) & self.enabled
+        self.active[rows] = after
+        self.last_time[rows] = latest_time
+
+        events = []
+        for i, rule in zip(*np.nonzero(after != before)):
+            events.append({
+                "sensor": keys[picked[i]],
+                "rule": RULES[rule],
+                "state": "raised" if after[i, rule] else "cleared",
+                "value": float(latest[i]),
+                "time": float(latest_time[i]),
+                "detail": float(detail[i, rule])
+            })
+        return events
+
+    # state rows of the keys, new keys get a cleared row
+    def _rows(self, keys) -> np.ndarray:
+        new = [key for key in dict.fromkeys(keys) if key not in self.index]
+        if new:
+            for key in new:
+                self.index[key] = len(self.index)
+            self.active = np.vstack([self.active, np.zeros((len(new), len(RULES)), dtype=bool)])
+            self.last_time = np.concatenate([self.last_time, np.full(len(new), -np.inf)])
+        return np.array([self.index[key] for key in keys], dtype=np.intp)
+
+    # raise/clear conditions, (sensors x rules) each, and the measured
+    # quantity per rule (reading, z, rate per minute, spread) for the events
+    def _evaluate(self, times, values, low, high, latest) -> tuple:
+        rules = self.rules
+        n = len(latest)
+        span = np.maximum(high - low, np.finfo(np.float64).tiny)
+        raise_ = np.zeros((n, len(RULES)), dtype=bool)
+        clear = np.zeros((n, len(RULES)), dtype=bool)
+        detail = np.zeros((n, len(RULES)))
+
+        # range
+        band = rules["hysteresis"] * span
+        raise_[:, 0] = (latest > high) | (latest < low)
+        clear[:, 0] = (latest <= high - band) & (latest >= low + band)
+        detail[:, 0] = latest
+
+        # zscore over the readings before the newest one
+        history = values[:, -(int(rules["zscore_window"]) + 1):-1]
+        present = ~np.isnan(history)
+        count = present.sum(axis=1)
+        filled = np.where(present, history, 0.0)
+        mean = filled.sum(axis=1) / np.maximum(count, 1)
+        deviation = np.where(present, history - mean[:, None], 0.0)
+        std = np.sqrt((deviation * deviation).sum(axis=1) / np.maximum(count, 1))
+        z = np.abs(latest - mean) / np.maximum(std, rules["zscore_floor"] * span)
+        enough = count >= rules["zscore_min_points"]
+        raise_[:, 1] = enough & (z > rules["zscore_raise"])
+        clear[:, 1] = ~enough | (z < rules["zscore_clear"])
+        detail[:, 1] = np.where(enough, z, 0.0)
+
+        # rate of change since the previous reading, per minute
+        previous = values[:, -2]
+        elapsed = times[:, -1] - times[:, -2]
+        has_rate = ~np.isnan(previous) & (elapsed > 0)
+        rate = np.where(has_rate, np.abs(latest - previous) / np.where(has_rate, elapsed, 1.0) * 60.0, 0.0)
+        limit = rules["rate_limit"] * span
+        raise_[:, 2] = has_rate & (rate > limit)
+        clear[:, 2] = ~has_rate | (rate < rules["rate_clear"] * limit)
+        detail[:, 2] = rate
+
+        # flatline, NaN padding is filled with the newest reading so it
+        # does not change the spread
+        recent = values[:, -int(rules["flat_points"]):]
+        full = ~np.isnan(recent).any(axis=1)
+        recent = np.where(np.isnan(recent), latest[:, None], recent)
+        spread = recent.max(axis=1) - recent.min(axis=1)
+        raise_[:, 3] = full & (spread <= rules["flat_epsilon"])
+        clear[:, 3] = spread > rules["flat_epsilon"]
+        detail[:, 3] = spread
+
+        return raise_, clear, detail
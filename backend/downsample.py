@@ -0,0 +1,130 @@
+import math
+from datetime import datetime
+
+#----------------------------------------------------------------------------------------
+#   Downsampling for analysis queries
+#
+#   Two ways to bound the size of a chart series regardless of how long
+#   the requested range is:
+#       bucket_pipeline: Mongo aggregation grouping readings into fixed
+#           time buckets with min/max/mean/count, done by the database
+#       lttb: Largest-Triangle-Three-Buckets, picks real readings that
+#           keep the visual shape of the line (peaks and dips survive)
+#   Both return documents shaped like readings ("time" and "value"), so
+#   the analysis page can chart them without changes.
+#----------------------------------------------------------------------------------------
+
+# upper limit for max_points, keeps a single request bounded
+MAX_POINTS_LIMIT = 10000
+
+# reading times are stored as naive datetimes
+EPOCH = datetime(1970, 1, 1)
+
+# Aggregation pipeline for time buckets of bucket_ms milliseconds
+# match selects the readings (see the readings store query method)
+# Buckets are aligned to multiples of bucket_ms since the epoch, "time"
+# is the bucket start and "value" the mean of the bucket
+def bucket_pipeline(match, bucket_ms) -> list:
+    bucket_ms = max(1, int(bucket_ms))
+    # date - date is milliseconds and date - milliseconds is a date,
+    # so the bucket start stays a date without any type conversion
+    epoch_ms = {"$subtract": ["$time", EPOCH]}
+    return [
+        {"$match": {**match, "value": {"$exists": True}}},
+        {"$group": {
+            "_id": {"$subtract": ["$time", {"$mod": [epoch_ms, bucket_ms]}]},
+            "value": {"$avg": "$value"},
+            "min": {"$min": "$value"},
+            "max": {"$max": "$value"},
+            "count": {"$sum": 1}
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "time": "$_id", "value": 1, "min": 1, "max": 1, "count": 1}}
+    ]
+
+# Aggregation pipeline regrouping rollup documents (see rollups.py) into
+# buckets of bucket_ms milliseconds, a multiple of the rollup resolution
+# Same output as bucket_pipeline, computed from count/sum/min/max
+def rollup_pipeline(match, bucket_ms) -> list:
+    bucket_ms = max(1, int(bucket_ms))
+    epoch_ms = {"$subtract": ["$time", EPOCH]}
+    return [
+        {"$match": match},
+        {"$group": {
+            "_id": {"$subtract": ["$time", {"$mod": [epoch_ms, bucket_ms]}]},
+            "sum": {"$sum": "$sum"},
+            "min": {"$min": "$min"},
+            "max": {"$max": "$max"},
+            "count": {"$sum": "$count"}
+        }},
+        {"$sort": {"_id": 1}},
+        {"$project": {"_id": 0, "time": "$_id", "value": {"$divide": ["$sum", "$count"]}, "min": 1, "max": 1, "count": 1}}
+    ]
+
+# Buckets of two sources for the same range (run archive and MongoDB) as
+# one time sorted list, a bucket both have is merged from their counts
+def merge_buckets(first, second) -> list:
+    if not first or not second:
+        return first or second
+    merged = {bucket["time"]: bucket for bucket in first}
+    for bucket in second:
+        other = merged.get(bucket["time"])
+        if other is None:
+            merged[bucket["time"]] = bucket
+            continue
+        count = other["count"] + bucket["count"]
+        merged[bucket["time"]] = {
+            "time": bucket["time"],
+            "value": (other["value"] * other["count"] + bucket["value"] * bucket["count"]) / count,
+            "min": min(other["min"], bucket["min"]),
+            "max": max(other["max"], bucket["max"]),
+            "count": count
+        }
+    return [merged[time] for time in sorted(merged)]
+
+# Bucket width (ms) so that range_start..range_end fits in max_points buckets
+# Buckets are aligned to the epoch, range_start is usually inside the first
+# one, so the span is split in max_points - 1 widths to leave room for it
+def bucket_ms_for(range_start, range_end, max_points) -> int:
+    span_ms = (range_end - range_start).total_seconds() * 1000
+    return max(1, math.ceil(span_ms / max(1, max_points - 1)))
+
+# Largest-Triangle-Three-Buckets downsampling
+# readings is a time sorted list of {"time": datetime, "value": number}
+# returns at most threshold of those readings, always keeping the first and last
+def lttb(readings, threshold) -> list:
+    count = len(readings)
+    threshold = max(3, threshold)
+    if threshold >= count:
+        return readings
+
+    xs = [reading["time"].timestamp() for reading in readings]
+    ys = [reading["value"] for reading in readings]
+    sampled = [readings[0]]
+
+    # the first and last points are fixed, the rest is split into buckets
+    every = (count - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # average of the next bucket is the third triangle point
+        next_start = int(math.floor((i + 1) * every)) + 1
+        next_end = min(int(math.floor((i + 2) * every)) + 1, count)
+        span = next_end - next_start
+        avg_x = sum(xs[next_start:next_end]) / span
+        avg_y = sum(ys[next_start:next_end]) / span
+
+        # keep the point of this bucket forming the largest triangle
+        start = int(math.floor(i * every)) + 1
+        end = int(math.floor((i + 1) * every)) + 1
+        best_area = -1.0
+        best = start
+        for j in range(start, end):
+            area = abs((xs[a] - avg_x) * (ys[j] - ys[a]) - (xs[a] - xs[j]) * (avg_y - ys[a]))
+            if area > best_area:
+                best_area = area
+                best = j
+        sampled.append(readings[best])
+        a = best
+
+    sampled.append(readings[-1])
+    return sampled
@@ -0,0 +1,101 @@
+import csv
+import io
+import json
+import zlib
+import numpy as np
+
+#----------------------------------------------------------------------------------------
+#   Streaming export of analysis results
+#
+#   The rows are produced straight from the Mongo cursors and encoded
+#   as NDJSON (one JSON object per line) or CSV, a batch of rows at a
+#   time, optionally gzip compressed. Nothing but the current batch is
+#   held in memory, so a full run exports in constant memory.
+#
+#   Each row is {sensor, sensor_id, measure, time, value}, with "sensor"
+#   the Sensor List key ("Water1-CO2") and "time" in the same ISO format
+#   the analysis page sends its filters in.
+#   Archived runs (run_archive.py) come first, from their decompressed
+#   chunks, one chunk of arrays in memory at a time.
+#----------------------------------------------------------------------------------------
+
+# documents per cursor batch and rows per chunk sent to the client
+EXPORT_BATCH_SIZE = 1000
+
+# format -> (mimetype, file extension)
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv")
+}
+
+CSV_COLUMNS = ["sensor", "sensor_id", "measure", "time", "value"]
+
+# sources is a list of (Sensor List key, sensor wrapper, collection, filter,
+# archived chunks), the chunks are (times, values) arrays from Run_Archive.chunks
+# yields one row per reading, reading the cursors batch by batch
+def export_rows(sources):
+    for sensor_key, sensor_wrapper, collection, query, archived in sources:
+        sensor_id = str(sensor_wrapper["id"])
+        measure = sensor_wrapper["measure"]
+        for times, values in archived:
+            for time, value in zip(np.datetime_as_string(times, unit="ms").tolist(), values.tolist()):
+                yield {
+                    "sensor": sensor_key,
+                    "sensor_id": sensor_id,
+                    "measure": measure,
+                    "time": time + "Z",
+                    "value": value
+                }
+        # no sort: readings are stored in time order and a sort on an
+        # unindexed run collection would make the server buffer it all
+        cursor = collection.find(query, {"_id": 0, "time": 1, "value": 1}).batch_size(EXPORT_BATCH_SIZE)
+        for reading in cursor:
+            yield {
+                "sensor": sensor_key,
+                "sensor_id": sensor_id,
+                "measure": measure,
+                "time": reading["time"].isoformat(timespec="milliseconds") + "Z",
+                "value": reading.get("value")
+            }
+
+def ndjson_chunks(rows):
+    batch = []
+    for row in rows:
+        batch.append(json.dumps(row, separators=(",", ":")))
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            yield "\n".join(batch) + "\n"
+            batch = []
+    if batch:
+        yield "\n".join(batch) + "\n"
+
+def csv_chunks(rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=CSV_COLUMNS, lineterminator="\n")
+    writer.writeheader()
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count >= EXPORT_BATCH_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            count = 0
+    yield buffer.getvalue()
+
+# gzip stream of the encoded chunks, only yields when the compressor has output
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(wbits=31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+# body of an export response in the given format
+def export_stream(sources, export_format, compress):
+    rows = export_rows(sources)
+    chunks = ndjson_chunks(rows) if export_format == "ndjson" else csv_chunks(rows)
+    if compress:
+        return gzip_chunks(chunks)
+    return (chunk.encode("utf-8") for chunk in chunks)
@@ -1,51 +1,213 @@
+import logging
+import queue
 import smtplib
 import threading
 import time
 from collections import deque
+from metrics import gauge, histogram
+
+logger = logging.getLogger(__name__)
 
 # system for sending emails to users.
 # emails are recieved in the outbox deque
-# when the deque is not empty, connects to gmail and sends emails
-# until it is empty.
-# disconnects and repeats until terminate flag is set
+# the first message to an address is sent right away, further messages
+# to it within digest_window seconds are collected and sent as one digest
+# when the window ends
+# messages and digests are delivered by a small pool of worker threads, each keeping
+# its own persistent SMTP connection (see SMTP_Connection), so a burst
+# costs one STARTTLS/login per worker instead of one per burst and a
+# slow server does not hold up the other workers
+# runs until terminate flag is set, pending digests are sent right away then
+# waits on the system state condition, send_email and terminate wake it
+
+# seconds messages to one recipient are collected into a digest
+DIGEST_WINDOW = 60
+
+# delivery threads, each with its own SMTP connection
+MAIL_WORKERS = 2
+
+# an idle connection is checked with NOOP this often and closed
+# once it has been idle for IDLE_CLOSE seconds
+KEEPALIVE = 30
+IDLE_CLOSE = 300
+
+# /metrics
+OUTBOX_DEPTH = gauge("mail_outbox_depth", "Emails waiting to be sent", ["stage"])
+SEND_SECONDS = histogram("mail_send_seconds", "Time to hand one email to the SMTP server", ["result"])
+
+# one persistent SMTP connection, reconnects when the server dropped it
+class SMTP_Connection:
+	def __init__(self, host, port, sender, password, use_tls):
+		self.host = host
+		self.port = port
+		self.sender = sender
+		self.password = password
+		self.use_tls = use_tls
+		self.server = None
+		self.last_used = 0.0
+		self.connects = 0
+
+	# sends one message, reconnecting and retrying once if the connection was lost
+	def send(self, address, text):
+		try:
+			self._ensure()
+			self.server.sendmail(self.sender, address, text)
+		except (smtplib.SMTPServerDisconnected, OSError):
+			self.close()
+			self._ensure()
+			self.server.sendmail(self.sender, address, text)
+		self.last_used = time.monotonic()
+
+	# called while idle: NOOP to keep the connection, closed after IDLE_CLOSE
+	def keepalive(self):
+		if self.server is None:
+			return
+		if time.monotonic() - self.last_used > IDLE_CLOSE:
+			self.close()
+			return
+		try:
+			if self.server.noop()[0] != 250:
+				self.close()
+		except (smtplib.SMTPException, OSError):
+			self.close()
+
+	def close(self):
+		if self.server is None:
+			return
+		try:
+			self.server.quit()
+		except (smtplib.SMTPException, OSError):
+			pass
+		self.server = None
+
+	# connects and logs in if there is no live connection
+	def _ensure(self):
+		if self.server is not None:
+			return
+		server = smtplib.SMTP(self.host, self.port, timeout=30)
+		if self.use_tls:
+			server.starttls()
+			server.login(self.sender, self.password)
+		self.server = server
+		self.connects += 1
+		self.last_used = time.monotonic()
+
 class mail_server:
 	sender = None
-	server = None
+	state = None
 	outbox = deque()
 
-	def __init__(self):
+	# host/port/use_tls default to gmail, the "local" mail mode points them
+	# at an in-process stand-in instead (see smtp_standin.py)
+	def __init__(self, host="smtp.gmail.com", port=587, use_tls=True, workers=MAIL_WORKERS, digest_window=DIGEST_WINDOW):
 		self.sender = 'fitaqualabnotification@gmail.com'
+		self.password = "imiqzepqgyrnzzod"
+		self.host = host
+		self.port = port
+		self.use_tls = use_tls
+		self.workers = workers
+		self.digest_window = digest_window
+		self.outbox = deque()
+		self.pending = {}	# address -> (end of its digest window, [texts collected])
+		self.deliveries = queue.Queue()
+		self.lock = threading.Lock()
+		self.counts = {"received": 0, "digests": 0, "sent": 0, "failed": 0, "connects": 0}
 
 	def run(self, state):
-		while(True):
-			if (len(self.outbox) == 0):
-				# terminate escape
-				if(state.get("terminate")):
-					break
+		self.state = state
+		# outbox: not dispatched yet, queued: waiting for a delivery worker
+		OUTBOX_DEPTH.labels(stage="outbox").set_function(lambda: len(self.outbox))
+		OUTBOX_DEPTH.labels(stage="queued").set_function(self.deliveries.qsize)
+		threads = [threading.Thread(target=self._deliver, daemon=True) for _ in range(self.workers)]
+		for thread in threads:
+			thread.start()
 
-				# if no emails, do nothing
-				time.sleep(1)
-				continue
+		while(True):
+			# sleep until there is mail, a digest is due or the system terminates
+			due = min((pending[0] for pending in self.pending.values()), default=None)
+			timeout = None if due is None else max(0.0, due - time.monotonic())
+			state.wait_for(lambda parameters: len(self.outbox) > 0 or parameters["terminate"], timeout)
+			terminate = state.get("terminate")
 
-			# connect and send emails
-			self._connect_()
+			# send to addresses without an open window, collect the rest
+			now = time.monotonic()
 			while len(self.outbox) > 0:
-				#try:
 				message = self.outbox.popleft()
-				self.server.sendmail(self.sender, message["reciever"], message["text"])
+				address = message["reciever"]
+				if address in self.pending:
+					self.pending[address][1].append(message["text"])
+				else:
+					self.pending[address] = (now + self.digest_window, [])
+					self.deliveries.put((address, message["text"]))
 
-			# disconnect
-			self.server.quit()
+			# windows that ended (all of them on terminate) send what they collected
+			for address in [address for address, (due, _) in self.pending.items() if terminate or due <= now]:
+				_, texts = self.pending.pop(address)
+				if len(texts) == 0:
+					continue
+				self.deliveries.put((address, digest(texts)))
+				with self.lock:
+					self.counts["digests"] += 1
+				# keep collecting for another window after a digest
+				self.pending[address] = (now + self.digest_window, [])
+
+			# terminate escape
+			if terminate:
+				break
 
+		# workers finish the queued digests, then end
+		for _ in threads:
+			self.deliveries.put(None)
+		for thread in threads:
+			thread.join()
 		return
 
 	# adds email to outbox
 	def send_email(self, address, text):
 		self.outbox.append({"reciever": address, "text": text})
+		with self.lock:
+			self.counts["received"] += 1
+		# mail available, wake run
+		if self.state is not None:
+			self.state.notify()
+
+	# delivery counters for monitoring
+	def stats(self):
+		with self.lock:
+			return dict(self.counts)
 
-	# connects to gmail and logs in
-	def _connect_(self):
-		self.server = smtplib.SMTP("smtp.gmail.com", 587)
-		self.server.starttls()
-		self.server.login(self.sender, "imiqzepqgyrnzzod")
+	# delivery worker, one persistent connection each
+	def _deliver(self):
+		connection = SMTP_Connection(self.host, self.port, self.sender, self.password, self.use_tls)
+		while(True):
+			try:
+				item = self.deliveries.get(timeout=KEEPALIVE)
+			except queue.Empty:
+				connection.keepalive()
+				continue
+			if item is None:
+				break
+			address, text = item
+			connects = connection.connects
+			start = time.perf_counter()
+			try:
+				connection.send(address, text)
+				result = "sent"
+			except (smtplib.SMTPException, OSError) as err:
+				logger.error(f"Mail server: could not send to {address}: {err}")
+				connection.close()
+				result = "failed"
+			SEND_SECONDS.labels(result=result).observe(time.perf_counter() - start)
+			with self.lock:
+				self.counts[result] += 1
+				self.counts["connects"] += connection.connects - connects
+		connection.close()
 
+# merges the messages for one recipient into one email
+# messages are "Subject: ...\n\nbody" texts, a single message is sent as is
+def digest(texts):
+	if len(texts) == 1:
+		return texts[0]
+	subject = texts[0].split("\n\n", 1)[0]
+	bodies = [text.split("\n\n", 1)[-1] for text in texts]
+	return f"{subject} ({len(texts)} alerts)\n\n" + "\n\n----\n\n".join(bodies)
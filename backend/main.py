@@ -1,17 +1,32 @@
 from w_sensor import Water_Sensor
 from a_sensor import Air_Sensor
+from serial_framing import Frame
 from db_config import db, user_collection, sensor_collection, settings_collection
 from flask import jsonify
 import json
 from bson import json_util
+import logging
 import threading
 import time
 from datetime import datetime
-from collections import deque
 from app import Flask_App
-from mail_server import mail_server
+from mail_server import mail_server, digest
+from smtp_standin import Local_SMTP_Server
 from sys_state import Sys_State
 from random_test_sensor import Random_Test_Sensor
+from sensor_state import Sensor_State
+from storage_writer import Storage_Writer
+from reading_wal import Reading_WAL, DEFAULT_PATH as DEFAULT_WAL_PATH
+from async_engine import Async_Engine
+from serial_mux import Serial_Mux
+from readings_store import create_store, Per_Run_Store
+from run_archive import Run_Archive, DEFAULT_ROOT as DEFAULT_ARCHIVE_ROOT
+from query_cache import Query_Cache, DEFAULT_MAX_MB as DEFAULT_CACHE_MB
+from rollups import Rollup_Stage
+from reconfigure import diff_sensors, port_config
+from recipients import Recipient_Cache
+from check_data import Check_Data
+from metrics import histogram
 from pymongo import MongoClient
 import requests
 
@@ -26,7 +41,9 @@ import requests
 #   avoid freezes while waiting on IO from the sensors
 #   Data is communicated between threads primarily using the
 #   sys_state class. In short it is a semaphore protected dictionary
-#   see sys_state.py for details. main.py also contains the code
+#   see sys_state.py for details. Readings themselves are kept per
+#   sensor in a Sensor_State (see sensor_state.py) so sensors never
+#   wait on each other. main.py also contains the code
 #   for sensor_proc, which is the function the sensor threads execute
 #   in.  
 
@@ -39,18 +56,45 @@ import requests
 #           Connect to sensors on their Com ports
 #           Compile all sensor information
 #           Run threads for each sensor
+#           Run the anomaly check thread (see check_proc)
 #       Running State:
+#           Sleeps until terminate or new settings is signalled
+#           (see Sys_State.wait_for), no polling
 #           Checks for terminate flag
 #               Moves to terminate
 #           Checks for new settings flag
-#               Kills all sensor threads
-#               Repeats all startup steps with ne configs in DB
+#               Diffs the sensor configs in the DB with the running sensors
+#               Applies range changes in place, stops/starts only the
+#               sensors that were removed, added or moved to another port
 #           Repeat
 #       Terminate:
 #           Rejoin all other threads
 #           Ends
 #----------------------------------------------------------------------------------------
 
+# keys of system_state that wake threads waiting on it when set:
+# terminate, reset, new settings, settings changed (read frequency,
+# run state). The mail server is woken through the same condition
+SIGNALS = ["terminate", "reset sensors", "New Settings", "Read Frequency", "state"]
+
+# how often the startup wait re-reads the settings in case they were changed
+# outside the web app, the web app wakes it right away
+SETTINGS_RECHECK = 60
+
+# how often the run archiving checks whether the write-ahead log has
+# replayed the readings of the finished runs
+ARCHIVE_WAL_RECHECK = 1.0
+
+# backend log format, the level comes from log_level in the settings doc
+# (debug, info, warning, error or off, see configure_logging)
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+logger = logging.getLogger("main")
+
+# hot path timings for /metrics (the same metrics are updated by async_engine.py)
+READ_SECONDS = histogram("sensor_read_seconds", "Time to read one value or frame from a sensor", ["sensor"])
+MONGO_WRITE_SECONDS = histogram("mongo_write_seconds", "Time of one write to MongoDB", ["operation"])
+
 # Semaphore protected dictionary
 system_state = Sys_State({
     # Contains the state of the system, placeholder is Initial, system goes between "waiting" and "running"
@@ -78,15 +122,67 @@ system_state = Sys_State({
     # signals main that changes have been made to sensor configs
     "New Settings": False,
 
+    # how long applying new settings took, see reconfigure_sensors
+    "Reconfiguration Stats": {"count": 0, "last_seconds": 0.0, "max_seconds": 0.0,
+                              "updated": 0, "added": 0, "removed": 0},
+
     # Access point to the mail server
     "Mail Server": None,
 
+    # anomaly rules over the recent readings, see check_data.py
+    # access with get_ref
+    "Check Data": None,
+
+    # addresses of the users with notifications on, see recipients.py
+    # access with get_ref
+    "Recipients": None,
+
+    # "gmail": alerts are sent through gmail
+    # "local": alerts go to an in-process SMTP stand-in, see smtp_standin.py
+    "Mail Mode": "gmail",
+
+    # The Flask_App, used to push new readings to socket clients
+    # access with get_ref
+    "Web App": None,
+
+    # Where readings are written, see readings_store.py
+    # access with get_ref
+    "Readings Store": Per_Run_Store(db, 0),
+
+    # Minute/hour rollups of the readings, see rollups.py
+    # access with get_ref
+    "Rollups": None,
+
+    # Background writer batching sensor readings into the DB
+    # see storage_writer.py, access with get_ref
+    "Storage Writer": None,
+
+    # Columnar archive of the finished runs, see run_archive.py
+    # access with get_ref, None when the run_archive setting is false
+    "Run Archive": None,
+
+    # Results of /analysis_query/ by sensor and filter, see query_cache.py
+    # access with get_ref, None when the analysis_cache_mb setting is 0
+    "Query Cache": None,
+
     # how often to read the sensors (in seconds)
     "Read Frequency": 5,
 
+    # how many recent readings each sensor keeps in memory for the dashboards
+    "Recent Readings": 100,
+
+    # "device": one thread per physical device, each frame fans out to all its measures
+    # "measure": one thread per sensor-measure, each reading its own frame
+    "Acquisition Mode": "device",
+
+    # "threaded": sensor threads as described by Acquisition Mode
+    # "async": every device driven from one asyncio event loop, see async_engine.py
+    # "selector": every port read from one thread through a selector, see serial_mux.py
+    "Acquisition Engine": "threaded",
+
     # When the last time a batch of emails was sent out
     "last emails": time.time() - 600
-})
+}, SIGNALS)
 
 def main():
     #--------------------#
@@ -100,10 +196,16 @@ def main():
     # pulls state values from db
     db_settings_cursor = settings_collection.find()
     db_settings_list = list(db_settings_cursor)
+    configure_logging(db_settings_list[0].get('log_level', "info"))
+    # Sys_State lock profiling from startup, lock_profile_ms is the slow wait threshold
+    # (it can also be started and stopped with PATCH /lock_profile)
+    if db_settings_list[0].get('lock_profile_ms') is not None:
+        system_state.start_profiling(float(db_settings_list[0]['lock_profile_ms']) / 1000)
     system_state.set("state", db_settings_list[0]['system_state'])
     while system_state.get("state") == "waiting":
-        print("waiting for system running")
-        time.sleep(5)
+        logger.info("waiting for system running")
+        # /config_sensors sets the state when a run is configured
+        system_state.wait_for(lambda parameters: parameters["state"] != "waiting", SETTINGS_RECHECK)
         db_settings_cursor = settings_collection.find()
         db_settings_list = list(db_settings_cursor)
         system_state.set("state", db_settings_list[0]['system_state'])
@@ -112,7 +214,31 @@ def main():
     # Get and set the read frequency
     system_state.set("Read Frequency", db_settings_list[0]['read_frequency'])
 
-    # initialize mail server
+    # recent readings kept per sensor (720 is an hour at the default 5 s)
+    system_state.set("Recent Readings", db_settings_list[0].get('recent_readings', 100))
+
+    # one read per physical device ("device") or per sensor-measure ("measure")
+    system_state.set("Acquisition Mode", db_settings_list[0].get('acquisition_mode', "device"))
+
+    # sensor threads ("threaded"), one asyncio event loop ("async") or one selector thread ("selector")
+    system_state.set("Acquisition Engine", db_settings_list[0].get('acquisition_engine', "threaded"))
+
+    # initialize the storage writer, batch size and flush interval are tunable from the settings
+    # readings go through the write-ahead log at reading_wal (a path, false turns it off)
+    wal_path = db_settings_list[0].get('reading_wal', DEFAULT_WAL_PATH)
+    wal = Reading_WAL(wal_path) if wal_path else None
+    # readings logged before this start may belong to the run that just finished
+    wal_mark = wal.last_seq() if wal is not None else 0
+    storage_writer = Storage_Writer(db_settings_list[0].get('write_batch_size', 500), db_settings_list[0].get('write_flush_interval', 1.0),
+                                    wal=wal, database=db)
+    storage_writer.start()
+    system_state.set("Storage Writer", storage_writer)
+
+    # initialize mail server, gmail or the local stand-in
+    system_state.set("Mail Mode", db_settings_list[0].get('mail_mode', "gmail"))
+    recipients = Recipient_Cache(user_collection, db_settings_list[0].get('recipient_ttl', 300))
+    recipients.load()
+    system_state.set("Recipients", recipients)
     mail_thread = threading.Thread(target=mail_init, args=[system_state])
     mail_thread.start()
 
@@ -124,148 +250,182 @@ def main():
     # Startup Section    #
     #--------------------#
 
-    print("Looking for sensors")
+    logger.info("Looking for sensors")
 
-    # Loops until all sensors are added
-    # While loop should only run once, it confirms the correct sensor count
-    # of tries again
-    sensor_config = sensor_collection.find()
     settings = settings_collection.find()
     settings_list = list(settings)
 
-    # This loops through all the sensors
-    for sensor in sensor_config:
-        # dynamically create a new collection and add to the tuple, this will read from sensor collection
-        if sensor["connection"] == "test":
-            CO2_db_name = f"{sensor['name']}_CO2_test_collection_run{settings_list[0]["run_number"]}"   # db for CO2
-            DO_db_name = f"{sensor["name"]}_DO_test_collection_run{settings_list[0]["run_number"]}"   # db for DO
-            CO2_db_collection = db[CO2_db_name]
-            DO_db_collection = db[DO_db_name]
-            CO2_db_collection.insert_one({"init": "collection created"})
-            DO_db_collection.insert_one({"init": "collection created"})
-            system_state.add_to_list("raw_sensors", (Random_Test_Sensor(), sensor["_id"], sensor["name"], "CO2", float(sensor["measures"]["CO2"]["range_high"]), float(sensor["measures"]["CO2"]["range_low"]), CO2_db_collection))
-            system_state.add_to_list("raw_sensors", (Random_Test_Sensor(), sensor["_id"], sensor["name"], "DO", float(sensor["measures"]["DO"]["range_high"]), float(sensor["measures"]["DO"]["range_low"]), DO_db_collection))
-        else:
-            CO2_db_name = f"{sensor['name']}_CO2_collection_run{settings_list[0]["run_number"]}"   # db for CO2
-            DO_db_name = f"{sensor["name"]}_DO_collection_run{settings_list[0]["run_number"]}"   # db for DO
-            CO2_db_collection = db[CO2_db_name]
-            DO_db_collection = db[DO_db_name]
-            CO2_db_collection.insert_one({"init": "collection created"})
-            DO_db_collection.insert_one({"init": "collection created"})
-            if sensor["type"] == "water":
-                water_sensor = Water_Sensor(sensor["connection"], sensor["baud_rate"])
-                system_state.add_to_list("raw_sensors", (water_sensor, sensor["_id"], sensor["name"], "CO2", float(sensor["measures"]["CO2"]["range_high"]), float(sensor["measures"]["CO2"]["range_low"]), CO2_db_collection))
-                system_state.add_to_list("raw_sensors", (water_sensor, sensor["_id"], sensor["name"], "DO", float(sensor["measures"]["DO"]["range_high"]), float(sensor["measures"]["DO"]["range_low"]), DO_db_collection))
-            elif sensor["type"] == "air":
-                air_sensor = Air_Sensor(sensor["connection"], sensor["baud_rate"])
-                system_state.add_to_list("raw_sensors", (air_sensor, sensor["_id"], sensor["name"], "CO2", float(sensor["measures"]["CO2"]["range_high"]), float(sensor["measures"]["CO2"]["range_low"]), CO2_db_collection))
-                system_state.add_to_list("raw_sensors", (air_sensor, sensor["_id"], sensor["name"], "DO", float(sensor["measures"]["DO"]["range_high"]), float(sensor["measures"]["DO"]["range_low"]), DO_db_collection))
-    
-    print("sensors connected")
+    # per run collections or the consolidated readings collection, see readings_store.py
+    readings_store = create_store(db, settings_list[0])
+    system_state.set("Readings Store", readings_store)
+
+    # analysis query results are cached in up to analysis_cache_mb megabytes (0 turns it off)
+    cache_mb = float(settings_list[0].get('analysis_cache_mb', DEFAULT_CACHE_MB))
+    if cache_mb > 0:
+        system_state.set("Query Cache", Query_Cache(cache_mb * 1024 * 1024))
 
-    # convert the raw sensor data to sensor wrappers
-    # repackaging the sensor info into a more usable form
-    for data_set in system_state.get("raw_sensors"):
-        system_state.add_to_dict("Sensor List", f"{data_set[2]}-{data_set[3]}", new_sensor_wrapper(*data_set))
+    # finished runs are compacted into the run archive at run_archive (a path, false turns it off)
+    archive_root = settings_list[0].get('run_archive', DEFAULT_ARCHIVE_ROOT)
+    if archive_root:
+        archive = Run_Archive(archive_root)
+        readings_store.exclude_runs(archive.runs())
+        system_state.set("Run Archive", archive)
+        archive_thread = threading.Thread(target=archive_proc, args=[archive, wal, wal_mark, readings_store, settings_list[0]["run_number"]], daemon=True)
+        archive_thread.start()
 
-    print("sensors wrapped")
+    # minute/hour rollups kept while the readings come in
+    rollups = Rollup_Stage(db, settings_list[0]["run_number"])
+    system_state.set("Rollups", rollups)
 
-    # create list of threads for each sensor
-    sensor_threads = []
-    for sensor in system_state.get("Sensor List").values():
-        sensor_threads.append(threading.Thread(target=sensor_proc, args=[sensor]))
+    # connect to every sensor in the sensor collection
+    load_sensors(readings_store)
 
-    # begin threads
+    logger.info("sensors wrapped")
+
+    # begin acquisition, threads or event loop depending on the engine
     # sleep prevents certain concurrency issues
     time.sleep(5)
-    for thread in sensor_threads:
-        thread.start()
+    acquisition = start_acquisition()
+
+    # anomaly checks run on their own thread, off the acquisition threads
+    checker = Check_Data(db_settings_list[0].get('check_rules'))
+    system_state.set("Check Data", checker)
+    check_thread = threading.Thread(target=check_proc, args=[checker])
+    check_thread.start()
 
-    print("all threads active")
+    logger.info("all threads active")
     # main state
     while not system_state.get("terminate"):
-        # If the flag is True, reset sensors and apply updates
-        if system_state.get("New Settings"):
-            print("New Settings Detected!!!!")
-            system_state.set("reset sensors", True)
-
-            # all sensor threads stopped
-            for thread in sensor_threads:
-                thread.join()
-            print("all sensor threads joined")
-
-            # repeat the startup procedure
-            # Empty raw sensors, sensor threads, and sensor list
-            system_state.set("raw_sensors", [])
-            sensor_threads = []
-            system_state.set("Sensor List", {})
-
-            # DB query to reset sensors
-            sensor_config = sensor_collection.find()   # get all the sensors
-            for sensor in sensor_config:
-                if sensor["connection"] == "test":
-                    CO2_db_name = f"{sensor['name']}_CO2_test_collection_run{settings_list[0]["run_number"]}"   # db for CO2
-                    DO_db_name = f"{sensor["name"]}_DO_test_collection_run{settings_list[0]["run_number"]}"   # db for DO
-                    CO2_db_collection = db[CO2_db_name]
-                    DO_db_collection = db[DO_db_name]
-                    CO2_db_collection.insert_one({"init": "collection created"})
-                    DO_db_collection.insert_one({"init": "collection created"})
-                    system_state.add_to_list("raw_sensors", (Random_Test_Sensor(), sensor["_id"], sensor["name"], "CO2", float(sensor["measures"]["CO2"]["range_high"]), float(sensor["measures"]["CO2"]["range_low"]), CO2_db_collection))
-                    system_state.add_to_list("raw_sensors", (Random_Test_Sensor(), sensor["_id"], sensor["name"], "DO", float(sensor["measures"]["DO"]["range_high"]), float(sensor["measures"]["DO"]["range_low"]), DO_db_collection))
-                else:
-                    CO2_db_name = f"{sensor['name']}_CO2_collection_run{settings_list[0]["run_number"]}"   # db for CO2
-                    DO_db_name = f"{sensor["name"]}_DO_collection_run{settings_list[0]["run_number"]}"   # db for DO
-                    CO2_db_collection = db[CO2_db_name]
-                    DO_db_collection = db[DO_db_name]
-                    CO2_db_collection.insert_one({"init": "collection created"})
-                    DO_db_collection.insert_one({"init": "collection created"})
-                    if sensor["type"] == "water":
-                        water_sensor = Water_Sensor(sensor["connection"], sensor["baud_rate"])
-                        system_state.add_to_list("raw_sensors", (water_sensor, sensor["_id"], sensor["name"], "CO2", float(sensor["measures"]["CO2"]["range_high"]), float(sensor["measures"]["CO2"]["range_low"]), CO2_db_collection))
-                        system_state.add_to_list("raw_sensors", (water_sensor, sensor["_id"], sensor["name"], "DO", float(sensor["measures"]["DO"]["range_high"]), float(sensor["measures"]["DO"]["range_low"]), DO_db_collection))
-                    elif sensor["type"] == "air":
-                        air_sensor = Air_Sensor(sensor["connection"], sensor["baud_rate"])
-                        system_state.add_to_list("raw_sensors", (air_sensor, sensor["_id"], sensor["name"], "CO2", float(sensor["measures"]["CO2"]["range_high"]), float(sensor["measures"]["CO2"]["range_low"]), CO2_db_collection))
-                        system_state.add_to_list("raw_sensors", (air_sensor, sensor["_id"], sensor["name"], "DO", float(sensor["measures"]["DO"]["range_high"]), float(sensor["measures"]["DO"]["range_low"]), DO_db_collection))
-    
-            for data_set in system_state.get("raw_sensors"):
-                system_state.add_to_dict("Sensor List", f"{data_set[2]}-{data_set[3]}", new_sensor_wrapper(*data_set))
-
-            print("sensors rewrapped")
+        # sleep until something needs doing
+        system_state.wait_for(lambda parameters: parameters["terminate"] or parameters["New Settings"])
 
-            # create list of threads for each sensor
-            for sensor in system_state.get("Sensor List").values():
-                sensor_threads.append(threading.Thread(target=sensor_proc, args=[sensor]))
+        # If the flag is True, apply the sensor config changes
+        if system_state.get("New Settings"):
+            logger.info("New Settings Detected")
 
-            system_state.set("reset sensors", False) # Reset 'reset sensors'
+            # reset the flag first, a change made while applying this one
+            # sets it again and is picked up on the next pass
+            system_state.set("New Settings", False)
 
-            # begin threads
-            for thread in sensor_threads:
-                thread.start()
+            # only the sensors that changed are touched
+            reconfigure_sensors(acquisition, readings_store)
 
-            print("all threads active again")
+    # end main state while
+    logger.debug(f"terminate: {system_state.get('terminate')}")
 
-            # reset the new settings flag
-            system_state.set("New Settings", False) # Reset 'New Settings'
+    # stop the sensors and write out their last readings
+    # before the flask shutdown ends the process
+    stop_acquisition(acquisition)
+    check_thread.join()
+    write_rollups(rollups.flush_open())
+    storage_writer.stop()
 
-    # end main state while
-    print(system_state.get("terminate"))
-    
     stop_flask()   # Stop flask server
 
     # Join all threads
     app_thread.join()
     mail_thread.join()
-    for thread in sensor_threads:
-        thread.join()
 
-    
 
-    print("all threads closed")
+    logger.info("all threads closed")
     # ends program
     # data = w_sensor1.disconnect_port()    --- implement at end of run for sensors
 
 
+#   Connects to every sensor in the sensor collection
+#   Fills raw_sensors with one tuple per sensor measure and
+#   the Sensor List with the matching sensor wrappers
+def load_sensors(readings_store):
+    system_state.set("raw_sensors", [])
+
+    # This loops through all the sensors
+    for sensor in sensor_collection.find():
+        for key, sensor_wrapper in wrap_sensor(sensor, readings_store).items():
+            system_state.add_to_dict("Sensor List", key, sensor_wrapper)
+
+    logger.info("sensors connected")
+
+#   Connects to one sensor document's device
+#   Adds its tuples to raw_sensors and returns its sensor wrappers
+#   by Sensor List key, not added to the Sensor List yet
+def wrap_sensor(sensor, readings_store):
+    wrappers = {}
+    for data_set in raw_sensor_tuples(sensor, readings_store):
+        system_state.add_to_list("raw_sensors", data_set)
+        # repackaging the sensor info into a more usable form
+        sensor_wrapper = new_sensor_wrapper(*data_set)
+        # port settings the device was opened with, see reconfigure.py
+        sensor_wrapper["config"] = port_config(sensor)
+        wrappers[f"{data_set[2]}-{data_set[3]}"] = sensor_wrapper
+    return wrappers
+
+#   Applies the sensor collection to the running sensors
+#   See reconfigure.py for how sensors are compared. Range changes are
+#   written into the running wrappers, removed and re-ported devices
+#   are stopped and new ones started, everything else keeps reading.
+#   The time taken is kept in "Reconfiguration Stats".
+def reconfigure_sensors(acquisition, readings_store):
+    start = time.perf_counter()
+    plan = diff_sensors(list(sensor_collection.find()), system_state.get("Sensor List"))
+
+    # thresholds only, applied in place
+    for sensor_wrapper, high, low in plan["update"]:
+        sensor_wrapper["high"] = high
+        sensor_wrapper["low"] = low
+
+    # stop removed and re-ported devices before their ports are reopened
+    removed = dict(plan["remove"])
+    stop_devices(acquisition, group_devices(removed))
+    for key in removed:
+        system_state.remove_from_dict("Sensor List", key)
+    checker = system_state.get_ref("Check Data")
+    if checker is not None:
+        checker.forget(removed)
+    removed_ids = {sensor_wrapper["id"] for sensor_wrapper in removed.values()}
+    system_state.set("raw_sensors", [data_set for data_set in system_state.get("raw_sensors") if data_set[1] not in removed_ids])
+
+    # start added and re-ported devices
+    added = {}
+    for sensor in plan["add"]:
+        added.update(wrap_sensor(sensor, readings_store))
+    for key, sensor_wrapper in added.items():
+        system_state.add_to_dict("Sensor List", key, sensor_wrapper)
+    start_devices(acquisition, group_devices(added))
+
+    elapsed = time.perf_counter() - start
+    stats = system_state.get("Reconfiguration Stats")
+    stats.update({
+        "count": stats["count"] + 1,
+        "last_seconds": elapsed,
+        "max_seconds": max(stats["max_seconds"], elapsed),
+        "updated": len(plan["update"]),
+        "added": len(added),
+        "removed": len(removed)
+    })
+    system_state.set("Reconfiguration Stats", stats)
+    logger.info(f"reconfigured in {elapsed * 1000:.1f} ms: {len(plan['update'])} ranges updated, {len(added)} sensor measures added, {len(removed)} removed")
+
+#   Creates the sensor object of one sensor document and
+#   returns its (sensor object, sensor id, sensor name, measure,
+#   high, low, db collection) tuple for each measure
+#   The sensor object is shared by the measures of the device
+def raw_sensor_tuples(sensor, readings_store):
+    if sensor["connection"] == "test":
+        device = Random_Test_Sensor(sensor.get("simulation"))
+    elif sensor["type"] == "water":
+        device = Water_Sensor(sensor["connection"], sensor["baud_rate"])
+    elif sensor["type"] == "air":
+        device = Air_Sensor(sensor["connection"], sensor["baud_rate"])
+    else:
+        return []
+
+    out = []
+    for measure in ["CO2", "DO"]:
+        # collection the store writes this measure to, created for the run if needed
+        collection = readings_store.collection(sensor, measure)
+        out.append((device, sensor["_id"], sensor["name"], measure, float(sensor["measures"][measure]["range_high"]), float(sensor["measures"][measure]["range_low"]), collection))
+    return out
+
 # creates dictionary breakdown for sensor
 # This is intended to make it easier to access the
 # sensor parameters
@@ -278,10 +438,12 @@ def new_sensor_wrapper(sensor, id, name, measure, high, low, db):
         "high": high,
         "low": low,
         "db": db,
-        "current reading": {},
-        "recent readings": deque()
+        # current reading and recent readings, protected by their own lock
+        "readings": Sensor_State(system_state.get("Recent Readings")),
+        # set to stop this sensor's acquisition (removed or reconfigured)
+        "stop": threading.Event()
     }
-    print("wrapping sensor ", name, " of measure ", measure)
+    logger.debug(f"wrapping sensor {name} of measure {measure}")
     return out
 
 
@@ -290,97 +452,308 @@ def new_sensor_wrapper(sensor, id, name, measure, high, low, db):
 #   Summary:
 #   Thread repeatedly reads sensor value and stores it.
 #   Keeps a reccord of recent readings.
-#   Because thread is directly modifying shared variables, 
-#   most computation is in a semaphore lock.
-#   CAUTION: uncaught exceptions in the semaphore lock will 
-#   freeze all other threads since it never releases. That is
-#   why there is a very broad try catch covering the lock.
+#   The serial read happens without holding any lock, the reading
+#   is then published through the sensor's own Sensor_State, so
+#   a slow sensor only delays itself and readers (Flask routes,
+#   socket handlers) can snapshot one sensor without blocking the
+#   others. The global system_state lock is only taken for the
+#   short flag and email cooldown checks.
 
 #   Execution Flow (sensor_proc)
 #       Check if terminate or reset flags have been flipped
 #           End thread if either has
 #       Read new value
-#       Lock the semaphore
-#       Store reading in que of this sensors recent readings
-#       Store reading in DB
-#       Release semaphore
+#       Store reading (see record_reading)
 #       Wait based on system configurations
 def sensor_proc(sensor_wrapper):
     # will continuously update with the current value of
-    # this sensor then sleep, shared storage needs protection
+    # this sensor then sleep
 
     # read sensor data
-    while (not system_state.get("terminate")) and (not system_state.get("reset sensors")):
-        # Lock the semaphore
-        system_state.hard_lock()
-        # get current sensor value
-        current_reading = {"value":sensor_wrapper["sensor"].read_data(sensor_wrapper["measure"]), "time": datetime.now().timestamp()}
+    stop = sensor_wrapper["stop"]
+    while (not system_state.get("terminate")) and (not system_state.get("reset sensors")) and (not stop.is_set()):
+        # avoid killing the thread with an exception
+        try:
+            # get current sensor value, serial IO is done outside any lock
+            start = time.perf_counter()
+            value = sensor_wrapper["sensor"].read_data(sensor_wrapper["measure"])
+            READ_SECONDS.labels(sensor=sensor_wrapper["name"]).observe(time.perf_counter() - start)
+            record_reading(sensor_wrapper, value, datetime.now())
+        except Exception as err:
+            logger.error(f"Error in sensor reading for {sensor_wrapper['name']}: {err}")
+
+        sensor_sleep(stop)
+
+    # disconnect the sensor as terminate/reset sensors/stop is true
+    sensor_wrapper["sensor"].disconnect_port()
 
-        # avoid freezing the entire system with an exception
+#   device_proc: Multithread entry point for each physical device
+
+#   Summary:
+#   Device level version of sensor_proc. A Water_Sensor reports
+#   every measure in one #DATA: frame, so the port is read once
+#   per cycle and the parsed frame is fanned out to the wrapper
+#   of each measure with one shared timestamp. This halves the
+#   serial traffic compared to one sensor_proc per measure and
+#   makes CO2/DO pairs come from the same instant.
+#   sensor_wrappers are all the wrappers sharing one sensor object.
+def device_proc(sensor_wrappers):
+    sensor = sensor_wrappers[0]["sensor"]
+    stop = sensor_wrappers[0]["stop"]
+    while (not system_state.get("terminate")) and (not system_state.get("reset sensors")) and (not stop.is_set()):
         try:
-            # store reading in the wrapper
-            sensor_wrapper["current reading"] = current_reading
-            sensor_wrapper["recent readings"].append(current_reading)
-
-            # check if reading in range
-            high = sensor_wrapper["high"]
-            low = sensor_wrapper["low"]
-
-            # if reading out of range, notify users
-            if current_reading["value"] > high or current_reading["value"] < low:
-                # if it has been at least 10 minutes since last email
-                if time.time() - system_state["last emails"] > 600:
-                    notification(sensor_wrapper)
-                    system_state["last emails"] = time.time()
-
-            # limit length of recent readings
-            while len(sensor_wrapper["recent readings"]) > 0:
-                if len(sensor_wrapper["recent readings"]) > 100:
-                    sensor_wrapper["recent readings"].popleft()
-                else:
-                    break
-
-            # Creating a DB entry with the current reading
-            sensor_wrapper["db"].insert_one({"value": current_reading["value"], "time": datetime.now(), "sensor_id": sensor_wrapper["id"]})
+            # one serial read for all measures
+            start = time.perf_counter()
+            frame = sensor.read_frame()
+            READ_SECONDS.labels(sensor=sensor_wrappers[0]["name"]).observe(time.perf_counter() - start)
+            # a port frame carries the time its line arrived
+            read_time = frame.time if isinstance(frame, Frame) else datetime.now()
+            if frame is not None:
+                for sensor_wrapper in sensor_wrappers:
+                    if sensor_wrapper["measure"] in frame:
+                        record_reading(sensor_wrapper, frame[sensor_wrapper["measure"]], read_time)
         except Exception as err:
-            print("Error in sensor reading for " + sensor_wrapper["name"])
-            print("\n" + str(err))
+            logger.error(f"Error in sensor reading for {sensor_wrappers[0]['name']}: {err}")
+
+        sensor_sleep(stop)
+
+    # disconnect the device once for all of its measures
+    sensor.disconnect_port()
+
+#   Sleep between sensor reads
+#   Waits for Read Frequency seconds on the system state condition,
+#   so terminate, reset and the sensor's stop event end it right away
+#   and a Read Frequency change applies to the sleep in progress
+def sensor_sleep(stop):
+    start_sleep = time.monotonic()
+
+    def done(parameters):
+        return parameters["terminate"] or parameters["reset sensors"] or stop.is_set() \
+            or time.monotonic() - start_sleep >= parameters["Read Frequency"]
+
+    # a timeout with done still False means the frequency went up, wait again
+    while not system_state.wait_for(done, system_state.get("Read Frequency")):
+        pass
+
+#   Creates the (unstarted) acquisition threads for the Sensor List
+#   Returns them by device (id of the sensor object), see device_threads
+def create_sensor_threads():
+    return {id(wrappers[0]["sensor"]): device_threads(wrappers) for wrappers in group_devices(system_state.get("Sensor List"))}
+
+#   Creates the (unstarted) acquisition threads of one device
+#   "device" mode: one device_proc shared by its measures
+#   "measure" mode: one sensor_proc per sensor-measure wrapper
+def device_threads(sensor_wrappers):
+    if system_state.get("Acquisition Mode") == "measure":
+        return [threading.Thread(target=sensor_proc, args=[sensor_wrapper]) for sensor_wrapper in sensor_wrappers]
+    return [threading.Thread(target=device_proc, args=[sensor_wrappers])]
+
+#   Groups the wrappers of a sensor list by the sensor object they read from
+#   Returns a list of wrapper lists, one per physical device
+def group_devices(sensor_list):
+    devices = {}
+    for sensor_wrapper in sensor_list.values():
+        devices.setdefault(id(sensor_wrapper["sensor"]), []).append(sensor_wrapper)
+    return list(devices.values())
+
+#   Starts reading the Sensor List with the configured engine
+#   Returns the handle stop_acquisition needs (threads by device, Async_Engine or Serial_Mux)
+def start_acquisition():
+    engines = {"async": Async_Engine, "selector": Serial_Mux}
+    engine_class = engines.get(system_state.get("Acquisition Engine"))
+    if engine_class is not None:
+        engine = engine_class(system_state, record_reading)
+        engine.start(group_devices(system_state.get("Sensor List")))
+        return engine
+
+    sensor_threads = create_sensor_threads()
+    for threads in sensor_threads.values():
+        for thread in threads:
+            thread.start()
+    return sensor_threads
+
+#   Waits for acquisition to end after terminate or reset sensors was set
+def stop_acquisition(acquisition):
+    if isinstance(acquisition, (Async_Engine, Serial_Mux)):
+        acquisition.stop()
+        return
+    for threads in acquisition.values():
+        for thread in threads:
+            thread.join()
+
+#   Starts more devices on running acquisition
+#   devices is a list of wrapper lists, one per sensor object (see group_devices)
+def start_devices(acquisition, devices):
+    if isinstance(acquisition, (Async_Engine, Serial_Mux)):
+        acquisition.add_devices(devices)
+        return
+    for sensor_wrappers in devices:
+        threads = device_threads(sensor_wrappers)
+        acquisition[id(sensor_wrappers[0]["sensor"])] = threads
+        for thread in threads:
+            thread.start()
+
+#   Stops some devices of running acquisition and waits until their ports are closed
+def stop_devices(acquisition, devices):
+    for sensor_wrappers in devices:
+        for sensor_wrapper in sensor_wrappers:
+            sensor_wrapper["stop"].set()
+    # wake the threads sleeping in sensor_sleep
+    system_state.notify()
+    if isinstance(acquisition, (Async_Engine, Serial_Mux)):
+        acquisition.remove_devices(devices)
+        return
+    for sensor_wrappers in devices:
+        for thread in acquisition.pop(id(sensor_wrappers[0]["sensor"]), []):
+            thread.join()
+
+#   Stores one reading for a sensor wrapper
+
+#   Publishes the reading to the wrapper's Sensor_State and the
+#   subscribed socket clients and queues it for the DB on the
+#   storage writer (direct insert if no writer is running),
+#   together with the rollup buckets it closed.
+#   Range and anomaly checks are done by check_proc.
+#   Besides the wrapper's own lock only the system_state lock is
+#   taken, briefly, to look up the services (get_ref), so this is
+#   safe to call from any sensor thread concurrently but not while
+#   holding system_state.hard_lock (the lock is not reentrant).
+def record_reading(sensor_wrapper, value, read_time):
+    # sensor classes return None when the port failed
+    if value is None:
+        return
+
+    current_reading = {"value": value, "time": read_time.timestamp()}
+    sensor_wrapper["readings"].push(current_reading)
+
+    # push the new reading to subscribed dashboards
+    web_app = system_state.get_ref("Web App")
+    if web_app is not None:
+        web_app.push_reading(sensor_wrapper, current_reading)
+
+    # Creating a DB entry with the current reading
+    entry = system_state.get_ref("Readings Store").document(sensor_wrapper, value, read_time)
+    storage_writer = system_state.get_ref("Storage Writer")
+    if storage_writer is not None:
+        storage_writer.put(sensor_wrapper["db"], entry)
+    else:
+        start = time.perf_counter()
+        sensor_wrapper["db"].insert_one(entry)
+        MONGO_WRITE_SECONDS.labels(operation="insert_one").observe(time.perf_counter() - start)
+
+    rollups = system_state.get_ref("Rollups")
+    if rollups is not None:
+        write_rollups(rollups.add(sensor_wrapper, value, read_time))
+
+#   Writes closed rollup buckets, (collection, document) pairs from
+#   Rollup_Stage, through the storage writer if it is running
+def write_rollups(documents):
+    storage_writer = system_state.get_ref("Storage Writer")
+    for collection, document in documents:
+        if storage_writer is not None:
+            storage_writer.put(collection, document)
+        else:
+            collection.insert_one(document)
 
-        # release semaphore
-        system_state.hard_release()
+#   check_proc: Thread entry point for the anomaly checks
 
-        # This is the sleep timer functionality
-        # sleep
-        start_sleep = time.time()
-        while ( (time.time() - start_sleep) < system_state.get("Read Frequency")) and (not system_state.get("reset sensors")):
-            time.sleep(1)
+#   Summary:
+#   Every Read Frequency seconds the recent window of every sensor
+#   is checked in one batch (see check_data.py), so the rules never
+#   run on the acquisition threads. Every reading since the last
+#   pass is checked, not only the newest one.
+#   Newly raised alerts notify the users, at most one email round
+#   every 10 minutes: alerts raised while the cooldown runs are kept
+#   and sent together, as one digest, once it is over.
+def check_proc(checker):
+    alerts = []
+    while not system_state.get("terminate"):
+        try:
+            sensor_list = system_state.get("Sensor List")
+            windows = []
+            for key, sensor_wrapper in sensor_list.items():
+                times, values = sensor_wrapper["readings"].window(checker.columns)
+                windows.append((key, times, values, sensor_wrapper["low"], sensor_wrapper["high"]))
+            for event in checker.check(windows):
+                if event["state"] == "raised":
+                    alerts.append((sensor_list[event["sensor"]], event))
+            # if it has been at least 10 minutes since last email
+            now = time.time()
+            if alerts and system_state.compare_and_set("last emails", lambda last: now - last > 600, now):
+                notification(alerts)
+                alerts = []
+        except Exception as err:
+            logger.error(f"Error in anomaly checks: {err}")
 
-    # disconnect the sensor as terminate/reset sensors is true
-    sensor_wrapper["sensor"].disconnect_port()
+        system_state.wait_for(lambda parameters: parameters["terminate"], system_state.get("Read Frequency"))
+
+#   archive_proc: Thread entry point compacting the finished runs
+
+#   Summary:
+#   Waits for the write-ahead log to replay the readings it held at
+#   startup (they may belong to the run that just finished), then
+#   archives every run before run_number that is not archived yet
+#   (see run_archive.py). Each archived run is left out of the store's
+#   queries from then on, the analysis routes read it from the archive.
+def archive_proc(archive, wal, wal_mark, readings_store, run_number):
+    while wal is not None and not wal.replayed_through(wal_mark):
+        if system_state.wait_for(lambda parameters: parameters["terminate"], ARCHIVE_WAL_RECHECK):
+            return
+    try:
+        archive.archive_pending(db, run_number, lambda run: readings_store.exclude_runs(archive.runs()))
+    except Exception as err:
+        logger.error(f"Error archiving runs: {err}")
 
 #   Provides emails to the email server
 
 #   Created email message to send to all addresses
 #   Gives that email to each address in the mail server.
-#   Occurs within sensor_proc semaphore lock, so no
-#   concurrency protection in this method.
-def notification(sensor):
+#   alerts are (sensor wrapper, raised event) pairs, several
+#   are merged into one digest email (see mail_server.digest).
+#   Only one thread at a time gets here because of the
+#   "last emails" cooldown claim in check_proc.
+#   The addresses come from the recipient cache, the user
+#   collection is never read here.
+def notification(alerts):
     ms = system_state.parameters["mail server"]
-    text = "Subject: Sensor Out of Range\n\n" + \
-    "Sensor value out of range: " + \
-    "\nsensor " + sensor["name"] +" read value " + str(sensor["recent readings"][-1]["value"]) + \
-    "\nNot with " + str(sensor["low"]) + "-" + str(sensor["high"]) + " range"    
-    users_cursor = user_collection.find()
-    user_list = list(users_cursor)
-    emails = []
-
-    for user in user_list:
-        print("email sent")
-        ms.send_email(user["email"], text)
+    text = digest([alert_text(sensor, event) for sensor, event in alerts])
+    for email in system_state.get_ref("Recipients").addresses():
+        logger.debug(f"alert email queued for {email}")
+        ms.send_email(email, text)
+
+#   Email text of one raised check (see check_data.py), the
+#   rule decides the subject and what the message says.
+def alert_text(sensor, event):
+    reading = "\nsensor " + sensor["name"] + " " + sensor["measure"] + " read value " + str(event["value"])
+    if event["rule"] == "zscore":
+        text = "Subject: Sensor Reading Unusual\n\n" + reading + \
+        "\n" + f"{event['detail']:.1f}" + " standard deviations from its recent readings"
+    elif event["rule"] == "rate":
+        text = "Subject: Sensor Reading Changing Fast\n\n" + reading + \
+        "\nchanging by " + f"{event['detail']:.3g}" + " per minute"
+    elif event["rule"] == "flatline":
+        text = "Subject: Sensor Reading Stuck\n\n" + reading + \
+        "\nthe reading has not changed recently, check the sensor"
+    else:
+        text = "Subject: Sensor Out of Range\n\n" + \
+        "Sensor value out of range: " + reading + \
+        "\nNot with " + str(sensor["low"]) + "-" + str(sensor["high"]) + " range"
+    return text
+
+#   Sets the level of the backend loggers
+#   level is a logging level name, "off" turns logging off
+def configure_logging(level):
+    level = str(level).lower()
+    if level == "off":
+        logging.disable(logging.CRITICAL)
+        return
+    logging.disable(logging.NOTSET)
+    logging.getLogger().setLevel(getattr(logging, level.upper(), logging.INFO))
 
 #   Create Flask App and hand it execution on this thread.
 def app_init(state):
     my_app = Flask_App(state)
+    state.set("Web App", my_app)
     my_app.run_app()
     pass
 
@@ -389,17 +762,25 @@ def stop_flask():
     try:
         requests.post("http://localhost:5000/shutdown")
     except requests.exceptions.ConnectionError:
-        print("Flask server already stopped or not reachable.")
+        logger.warning("Flask server already stopped or not reachable.")
 
 #   Create mail server and hand it execution on this thread.
 def mail_init(state):
-    ms = mail_server()
+    if state.get("Mail Mode") == "local":
+        standin = Local_SMTP_Server()
+        standin.start()
+        logger.info(f"mail goes to the local SMTP stand-in on port {standin.port}")
+        ms = mail_server(standin.host, standin.port, use_tls=False)
+    else:
+        ms = mail_server()
     system_state.set("mail server", ms)
     ms.run(state)
 
 # If main fails, try and shut down the other threads
-try:
-    main()
-except Exception as err:
-    print(err)
-    system_state.set("terminate", True)
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    try:
+        main()
+    except Exception as err:
+        logger.exception(err)
+        system_state.set("terminate", True)
@@ -0,0 +1,233 @@
+import bisect
+import math
+import threading
+
+#----------------------------------------------------------------------------------------
+#   Instrumentation for the /metrics endpoint
+#
+#   Counters, gauges and histograms kept in process and rendered in the
+#   Prometheus text exposition format by render(). Modules create their
+#   metrics once at import time with counter()/gauge()/histogram() and
+#   update them from the hot paths, e.g.
+#       READ_SECONDS = histogram("sensor_read_seconds", "Serial read time", ["sensor"])
+#       READ_SECONDS.labels(sensor="Water1").observe(0.012)
+#   An update is a dictionary lookup and a short lock, the children of
+#   labelled metrics are cached. A gauge can also be given a function,
+#   which is called when the metrics are rendered (queue depths).
+#   No client library is needed, the format is plain text.
+#----------------------------------------------------------------------------------------
+
+# latency buckets in seconds, 100 us to 10 s
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# label values are escaped as the text format requires
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+def _label_text(names, values, extra="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and math.isnan(value):
+        return "NaN"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.children = {}
+        if not self.labelnames:
+            self.children[()] = self._child()
+
+    # the child for one set of label values, created on first use
+    def labels(self, *values, **named):
+        key = tuple(str(value) for value in values) if values else tuple(str(named[name]) for name in self.labelnames)
+        child = self.children.get(key)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(key, self._child())
+        return child
+
+    # drops the children of label values that went away (removed sensors)
+    def remove(self, *values) -> None:
+        with self.lock:
+            self.children.pop(tuple(str(value) for value in values), None)
+
+    def samples(self) -> list:
+        with self.lock:
+            children = list(self.children.items())
+        out = []
+        for key, child in children:
+            out.extend(child.samples(self.name, self.labelnames, key))
+        return out
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_number(value)}" for name, labels, value in self.samples())
+        return "\n".join(lines)
+
+class _Counter_Child:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, names, key) -> list:
+        return [(name, _label_text(names, key), self.value)]
+
+# exposed as <name>_total
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()) -> None:
+        super().__init__(name if name.endswith("_total") else f"{name}_total", help, labelnames)
+
+    def _child(self):
+        return _Counter_Child()
+
+    def inc(self, amount=1) -> None:
+        self.children[()].inc(amount)
+
+class _Gauge_Child:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.value = 0.0
+        self.function = None
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def inc(self, amount=1) -> None:
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1) -> None:
+        self.inc(-amount)
+
+    # value read when the metrics are rendered
+    def set_function(self, function) -> None:
+        self.function = function
+
+    def samples(self, name, names, key) -> list:
+        value = self.value
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception:
+                value = math.nan
+        return [(name, _label_text(names, key), value)]
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _child(self):
+        return _Gauge_Child()
+
+    def set(self, value) -> None:
+        self.children[()].set(value)
+
+    def inc(self, amount=1) -> None:
+        self.children[()].inc(amount)
+
+    def dec(self, amount=1) -> None:
+        self.children[()].dec(amount)
+
+    def set_function(self, function) -> None:
+        self.children[()].set_function(function)
+
+class _Histogram_Child:
+    def __init__(self, bounds) -> None:
+        self.lock = threading.Lock()
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value) -> None:
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.sum += value
+
+    # for callers that already hold a lock serializing every update
+    # of this child (the Sys_State lock timings)
+    def observe_serialized(self, value) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def observe_many(self, values) -> None:
+        with self.lock:
+            for value in values:
+                self.counts[bisect.bisect_left(self.bounds, value)] += 1
+                self.sum += value
+
+    def samples(self, name, names, key) -> list:
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        out = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + (math.inf,), counts):
+            cumulative += count
+            out.append((f"{name}_bucket", _label_text(names, key, f'le="{_number(bound)}"'), cumulative))
+        out.append((f"{name}_sum", _label_text(names, key), total))
+        out.append((f"{name}_count", _label_text(names, key), cumulative))
+        return out
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> None:
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _child(self):
+        return _Histogram_Child(self.bounds)
+
+    def observe(self, value) -> None:
+        self.children[()].observe(value)
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    # returns the existing metric when a module is imported twice
+    def add(self, metric):
+        with self.lock:
+            return self.metrics.setdefault(metric.name, metric)
+
+    # every metric in the Prometheus text format
+    def render(self) -> str:
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name, help, labelnames=()) -> Counter:
+    return REGISTRY.add(Counter(name, help, labelnames))
+
+def gauge(name, help, labelnames=()) -> Gauge:
+    return REGISTRY.add(Gauge(name, help, labelnames))
+
+def histogram(name, help, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.add(Histogram(name, help, labelnames, buckets))
+
+def render() -> str:
+    return REGISTRY.render()
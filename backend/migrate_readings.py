@@ -0,0 +1,95 @@
+from pymongo.errors import BulkWriteError
+from readings_store import READINGS_COLLECTION, RUN_COLLECTION_PATTERN, ensure_indexes
+
+#----------------------------------------------------------------------------------------
+#   Copies the per run collections ({name}_{measure}_collection_run{N})
+#   into the consolidated "readings" collection
+#
+#   Every reading keeps its original _id, so running the migration again
+#   (for example after more runs were recorded with the per_run backend)
+#   only adds the readings that are not there yet. The per run collections
+#   are left untouched, drop them by hand once the "consolidated"
+#   storage_backend is in use.
+#
+#   Usage (from backend/): python migrate_readings.py
+#----------------------------------------------------------------------------------------
+
+BATCH_SIZE = 1000
+
+# duplicate key, the reading was migrated before
+DUPLICATE_KEY = 11000
+
+
+# consolidated document for a reading of a per run collection
+def consolidated_document(document, match, sensor_ids) -> dict:
+    sensor_id = document.get("sensor_id", sensor_ids.get(match["name"]))
+    return {
+        "_id": document["_id"],
+        "run": int(match["run"]),
+        "sensor_id": sensor_id,
+        "sensor_name": match["name"],
+        "measure": match["measure"],
+        "test": match["test"] is not None,
+        "time": document["time"],
+        "value": document.get("value")
+    }
+
+
+# inserts a batch, returns how many documents were new
+def insert_batch(readings, batch) -> int:
+    try:
+        return len(readings.insert_many(batch, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        others = [error for error in errors if error.get("code") != DUPLICATE_KEY]
+        if others:
+            raise
+        return len(batch) - len(errors)
+
+
+# migrates one per run collection, returns (readings seen, readings inserted)
+def migrate_collection(collection, match, readings, sensor_ids) -> tuple:
+    seen = 0
+    inserted = 0
+    batch = []
+    # the init documents have no "time" and are not readings
+    for document in collection.find({"time": {"$exists": True}}):
+        batch.append(consolidated_document(document, match, sensor_ids))
+        if len(batch) >= BATCH_SIZE:
+            seen += len(batch)
+            inserted += insert_batch(readings, batch)
+            batch = []
+    if batch:
+        seen += len(batch)
+        inserted += insert_batch(readings, batch)
+    return seen, inserted
+
+
+def migrate(db) -> dict:
+    readings = db[READINGS_COLLECTION]
+    ensure_indexes(readings)
+
+    # readings recorded before sensor_id was stored fall back to the sensor name
+    sensor_ids = {}
+    for collection_name in ["sensor_collection", "test_sensor_collection"]:
+        for sensor in db[collection_name].find({}, {"name": 1}):
+            sensor_ids.setdefault(sensor["name"], sensor["_id"])
+
+    totals = {"collections": 0, "seen": 0, "inserted": 0}
+    for name in sorted(db.list_collection_names()):
+        match = RUN_COLLECTION_PATTERN.match(name)
+        if match is None:
+            continue
+        seen, inserted = migrate_collection(db[name], match, readings, sensor_ids)
+        print(f"{name}: {seen} readings, {inserted} new")
+        totals["collections"] += 1
+        totals["seen"] += seen
+        totals["inserted"] += inserted
+
+    print(f"migrated {totals['collections']} collections, {totals['inserted']} of {totals['seen']} readings were new")
+    return totals
+
+
+if __name__ == "__main__":
+    from db_config import db
+    migrate(db)
@@ -0,0 +1,191 @@
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import numpy as np
+from downsample import EPOCH, lttb
+from metrics import counter, gauge
+from run_archive import series_buckets
+
+#----------------------------------------------------------------------------------------
+#   Result cache for /analysis_query/
+#
+#   One entry per sensor and normalized query (cache_key): the sensor's
+#   id, measure and collection, the time range and the downsampling.
+#   Entries are kept in least recently used order within max_bytes
+#   (estimated Python memory of the cached documents), the least
+#   recently used ones are evicted to make room.
+#
+#   A query whose range ended more than SETTLE_SECONDS ago (a past day,
+#   a closed run) cannot change, its entry is returned as is. A range
+#   still open (the live run) is extended on every hit: the readings
+#   from cut() on, a little before the cached tail since readings reach
+#   MongoDB a few seconds after they are read, are fetched and replace
+#   the end of the entry (extended()). For max_points buckets the width
+#   depends on the span of the readings, when it changes the entry is
+#   recomputed (a miss).
+#   A reading stored more than SETTLE_SECONDS late (replayed from the
+#   write-ahead log after a MongoDB outage) is missing from the past
+#   windows cached meanwhile, DELETE /analysis_cache clears them.
+#
+#   Entry kinds:
+#       raw      the documents of the range
+#       lttb     the time sorted readings (live entries only) and their lttb
+#       buckets  min/max/mean/count buckets of bucket_ms
+#----------------------------------------------------------------------------------------
+
+# default size limit, the analysis_cache_mb setting (0 turns the cache off)
+DEFAULT_MAX_MB = 64
+
+# readings reach MongoDB within this of their time (storage writer flush, log replay)
+SETTLE_SECONDS = 120
+
+# /metrics
+CACHE_REQUESTS = counter("analysis_cache_requests", "Analysis query results by cache outcome", ["result"])
+CACHE_BYTES = gauge("analysis_cache_bytes", "Estimated memory of the cached analysis query results")
+CACHE_ENTRIES = gauge("analysis_cache_entries", "Cached analysis query results")
+
+OUTCOMES = ["hit", "extended", "miss"]
+
+# cache key of one sensor's query, method only matters when it is used
+def cache_key(sensor_data, range_start, range_end, resolution, max_points, method) -> tuple:
+    if resolution is None and max_points is None:
+        method = "raw"
+    elif resolution is not None:
+        method = "buckets"
+    return (str(sensor_data["id"]), sensor_data["measure"], getattr(sensor_data["db"], "name", None),
+            range_start, range_end, resolution, max_points, method)
+
+# whether a range is over for good, now as the readings are timed (naive local)
+def is_past(range_end, now=None) -> bool:
+    if range_end is None:
+        return False
+    return range_end <= (now or datetime.now()) - timedelta(seconds=SETTLE_SECONDS)
+
+# estimated memory of a list of similar documents, from the first one
+def estimate_bytes(documents) -> int:
+    if not documents:
+        return sys.getsizeof(documents)
+    first = documents[0]
+    per_document = sys.getsizeof(first) + sum(sys.getsizeof(value) for value in first.values())
+    return sys.getsizeof(documents) + per_document * len(documents)
+
+# buckets of time sorted {time, value} readings, same documents as bucket_pipeline
+def readings_buckets(readings, bucket_ms) -> list:
+    readings = [reading for reading in readings if reading["value"] is not None]
+    times = np.array([reading["time"] for reading in readings], dtype="datetime64[us]")
+    values = np.array([reading["value"] for reading in readings], dtype=np.float64)
+    return series_buckets(times, values, bucket_ms)
+
+class Cached_Result:
+    __slots__ = ("kind", "data", "result", "immutable", "tail", "first", "last", "bucket_ms", "max_points", "size")
+
+    # data is what extended() builds on (documents, readings or buckets),
+    # result what the query returns; tail the time the live part starts
+    # from (last reading, or the start of the last bucket)
+    # first/last: the readings' span, for buckets sized by max_points
+    def __init__(self, kind, data, result, immutable, tail=None, first=None, last=None, bucket_ms=None, max_points=None) -> None:
+        self.kind = kind
+        self.data = None if immutable and kind == "lttb" else data
+        self.result = result
+        self.immutable = immutable
+        self.tail = tail
+        self.first = first
+        self.last = last
+        self.bucket_ms = bucket_ms
+        self.max_points = max_points
+        self.size = estimate_bytes(result) + (estimate_bytes(self.data) if self.data is not None and self.data is not result else 0)
+
+    # where the live part of the entry is fetched again from
+    def cut(self, range_start):
+        if self.tail is None:
+            return range_start
+        cut = max(range_start, self.tail - timedelta(seconds=SETTLE_SECONDS))
+        if self.kind == "buckets":
+            # back to the start of its bucket, the buckets before it are complete
+            since_epoch = int((cut - EPOCH) / timedelta(milliseconds=1))
+            cut = max(range_start, EPOCH + timedelta(milliseconds=since_epoch - since_epoch % max(1, int(self.bucket_ms))))
+        return cut
+
+    # a new entry with everything from cut on replaced by fresh, the readings
+    # of [cut, range end) (documents for raw, {time, value} sorted otherwise)
+    # bucket_width(first, last, max_points) sizes max_points buckets, the
+    # result is None when their width changed
+    # immutable: the range is over by now, the entry will not change again
+    def extended(self, fresh, cut, bucket_width, immutable=False):
+        if self.kind == "raw":
+            data = [document for document in self.data if document["time"] < cut] + fresh
+            tail = max((document["time"] for document in fresh), default=self.tail)
+            return Cached_Result("raw", data, data, immutable, tail)
+        if self.kind == "lttb":
+            data = [reading for reading in self.data if reading["time"] < cut] + fresh
+            tail = data[-1]["time"] if data else None
+            return Cached_Result("lttb", data, lttb(data, self.max_points), immutable, tail, max_points=self.max_points)
+
+        first, last = self.first, self.last
+        if self.max_points is not None and fresh:
+            first = fresh[0]["time"] if first is None else first
+            last = fresh[-1]["time"]
+            if bucket_width(first, last, self.max_points) != self.bucket_ms:
+                return None
+        data = [bucket for bucket in self.data if bucket["time"] < cut] + readings_buckets(fresh, self.bucket_ms)
+        tail = data[-1]["time"] if data else None
+        return Cached_Result("buckets", data, data, immutable, tail, first, last, self.bucket_ms, self.max_points)
+
+class Query_Cache:
+
+    # constructor, max_bytes of estimated memory for the entries
+    def __init__(self, max_bytes=DEFAULT_MAX_MB * 1024 * 1024) -> None:
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.outcomes = {outcome: 0 for outcome in OUTCOMES}
+        self.requests = {outcome: CACHE_REQUESTS.labels(result=outcome) for outcome in OUTCOMES}
+        CACHE_BYTES.set_function(lambda: self.bytes)
+        CACHE_ENTRIES.set_function(lambda: len(self.entries))
+
+    # the entry for key (most recently used from now on), None if not cached
+    def lookup(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    # caches entry under key, evicting the least recently used entries
+    # to stay within max_bytes; an entry larger than that is not kept
+    def store(self, key, entry) -> None:
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size
+            if entry.size > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    # records how a query was answered, "hit", "extended" or "miss"
+    def count(self, outcome) -> None:
+        with self.lock:
+            self.outcomes[outcome] += 1
+        self.requests[outcome].inc()
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    # outcomes, hit ratio (hits and extended entries over all queries) and memory
+    def stats(self) -> dict:
+        with self.lock:
+            total = sum(self.outcomes.values())
+            return {**self.outcomes,
+                    "hit_ratio": (self.outcomes["hit"] + self.outcomes["extended"]) / total if total else None,
+                    "entries": len(self.entries), "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "evictions": self.evictions}
@@ -1,23 +1,26 @@
 import time
-import random
+from sensor_simulator import create_model
 
+# "test" connection sensor, no port
+# Values come from simulation models (see sensor_simulator.py), configured
+# by the "simulation" entry of the sensor document. Without one every
+# read returns the old fixed values, 8 for CO2 and 3 for DO.
 class Random_Test_Sensor:
-	def __init__(self):
+	def __init__(self, simulation=None, runs=None):
 		self.flag = True
-		pass
+		self.start = time.monotonic()
+		self.models = {measure: create_model(simulation, measure, runs) for measure in ["CO2", "DO"]}
 
 	def read_data(self, measure):
-		#data_from_read = "#DATA: 07/26/24,15:12:15,0.0,21.93,7.42,27.2,-2.76,104.6,8.91,4983.4,0.6,163.3,-18.8"
-		#data_wo_header = data_from_read[5:]
-		#data_entries = data_wo_header.split(",")
-		# Return 5th entry - the CO2 data
-		#if self.flag:
-		#	self.flag = False
-		#	return float(data_entries[4])
-		#else:
-		#	self.flag = True
-		#		return 5.75
-		if measure == "CO2":
-			return 8
-		if measure == "DO":
-			return 3
\ No newline at end of file
+		model = self.models.get(measure)
+		if model is None:
+			return None
+		return model.value(time.monotonic() - self.start)
+
+	# every measure of one simulated frame
+	def read_frame(self):
+		elapsed = time.monotonic() - self.start
+		return {measure: model.value(elapsed) for measure, model in self.models.items()}
+
+	def disconnect_port(self):
+		pass
@@ -0,0 +1,116 @@
+import logging
+import os
+import sqlite3
+import threading
+import bson
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------------------------------------
+#   Write-ahead log for sensor readings
+#
+#   A local SQLite database in WAL mode holding the readings that are not
+#   in MongoDB yet. Storage_Writer.put appends each document here and
+#   returns, a slow or restarting mongod never blocks a sensor and the
+#   readings of an outage survive it (and a restart of the backend).
+#   The replay thread of Storage_Writer reads the oldest rows in batches,
+#   inserts them and then removes them.
+#
+#   Rows are (seq, collection name, BSON document). seq is AUTOINCREMENT,
+#   it keeps growing after the log drains instead of starting over, so a
+#   last_seq() taken at startup stays a valid mark for replayed_through.
+#   Each document gets its _id when it is appended, so a batch replayed
+#   twice (the backend stopped between the insert and the remove) only
+#   gives duplicate key errors for the documents already in MongoDB:
+#   replay is idempotent.
+#
+#   synchronous=NORMAL: a commit is an append to the -wal file without
+#   an fsync, it survives the process dying but not a power cut. The
+#   appending connection never checkpoints (copying the -wal file back
+#   into the database, with an fsync), the replay connection does it
+#   after removing a batch, so a sensor never waits for one.
+#----------------------------------------------------------------------------------------
+
+# next to this file unless the reading_wal setting gives a path
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "readings_wal.sqlite3")
+
+# milliseconds a connection waits for the other one's write lock
+BUSY_TIMEOUT_MS = 5000
+
+TABLE = "CREATE TABLE readings (seq INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, document BLOB NOT NULL)"
+
+class Reading_WAL:
+
+    # opens (or creates) the log at path
+    def __init__(self, path=DEFAULT_PATH) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = self._connect()
+        self.connection.execute("PRAGMA wal_autocheckpoint=0")
+        table = self.connection.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'readings'").fetchone()
+        if table is None:
+            self.connection.execute(TABLE)
+        elif "AUTOINCREMENT" not in table[0]:
+            # a log created with reusable seqs, its rows are kept in order
+            self.connection.executescript(f"BEGIN; ALTER TABLE readings RENAME TO readings_old; {TABLE}; "
+                                          "INSERT INTO readings SELECT * FROM readings_old; DROP TABLE readings_old; COMMIT;")
+        self.appended = 0
+        # the replay thread reads and removes rows on its own connection
+        self.replay_connection = None
+        self.appended_event = threading.Event()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+        return connection
+
+    # logs a document for collection, one autocommit insert
+    # safe to call from any sensor thread
+    def append(self, collection, document) -> None:
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        row = (collection, bson.encode(document))
+        with self.lock:
+            self.connection.execute("INSERT INTO readings (collection, document) VALUES (?, ?)", row)
+            self.appended += 1
+        self.appended_event.set()
+
+    # the oldest rows, a list of (seq, collection name, document)
+    def oldest(self, limit) -> list:
+        if self.replay_connection is None:
+            self.replay_connection = self._connect()
+        rows = self.replay_connection.execute("SELECT seq, collection, document FROM readings ORDER BY seq LIMIT ?",
+                                              (limit,)).fetchall()
+        return [(seq, collection, bson.decode(document)) for seq, collection, document in rows]
+
+    # drops every row up to and including seq (a replayed batch)
+    def remove_through(self, seq) -> None:
+        self.replay_connection.execute("DELETE FROM readings WHERE seq <= ?", (seq,))
+        self.replay_connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    # rows waiting, rows are only removed from the oldest end
+    def backlog(self) -> int:
+        with self.lock:
+            low, high = self.connection.execute("SELECT min(seq), max(seq) FROM readings").fetchone()
+        return 0 if low is None else high - low + 1
+
+    # seq of the newest row, 0 for an empty log
+    def last_seq(self) -> int:
+        with self.lock:
+            return self.connection.execute("SELECT max(seq) FROM readings").fetchone()[0] or 0
+
+    # True once every row up to and including seq has been replayed
+    def replayed_through(self, seq) -> bool:
+        with self.lock:
+            low = self.connection.execute("SELECT min(seq) FROM readings").fetchone()[0]
+        return low is None or low > seq
+
+    def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+        if self.replay_connection is not None:
+            self.replay_connection.close()
+            self.replay_connection = None
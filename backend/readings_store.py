@@ -0,0 +1,110 @@
+import re
+from pymongo import ASCENDING
+
+#----------------------------------------------------------------------------------------
+#   Where sensor readings are stored
+#
+#   Per_Run_Store: the original layout, one collection per sensor,
+#       measure and run ({name}_{measure}_collection_run{N}), documents
+#       are {value, time, sensor_id}
+#   Consolidated_Store: one "readings" collection for every sensor and
+#       run, documents are {run, sensor_id, sensor_name, measure, test,
+#       time, value} with a compound index on (sensor_id, measure, time),
+#       so range queries use the index and one query spans every run
+#
+#   Both stores have the same methods, main.py and app.py only talk to
+#   the store selected by the "storage_backend" setting:
+#       collection(sensor, measure)  collection a sensor's measure is written to
+#       document(sensor_wrapper, value, read_time)  DB entry for a reading
+#       query(sensor_wrapper, time_query)  filter for a sensor's readings
+#       rollup_query(sensor_wrapper, time_query)  same for its rollups (rollups.py)
+#       exclude_runs(runs)  leaves runs moved to the run archive
+#           (run_archive.py) out of query and rollup_query
+#----------------------------------------------------------------------------------------
+
+READINGS_COLLECTION = "readings"
+
+# names of the per run collections, used by the migration
+RUN_COLLECTION_PATTERN = re.compile(r"^(?P<name>.+)_(?P<measure>CO2|DO)(?P<test>_test)?_collection_run(?P<run>\d+)$")
+
+class Per_Run_Store:
+
+    # constructor
+    def __init__(self, db, run_number) -> None:
+        self.db = db
+        self.run_number = run_number
+
+    # creates the collection for this run, marked with an init document
+    def collection(self, sensor, measure):
+        test = "_test" if sensor["connection"] == "test" else ""
+        collection = self.db[f"{sensor['name']}_{measure}{test}_collection_run{self.run_number}"]
+        collection.insert_one({"init": "collection created"})
+        return collection
+
+    def document(self, sensor_wrapper, value, read_time) -> dict:
+        return {"value": value, "time": read_time, "sensor_id": sensor_wrapper["id"]}
+
+    # the collection only holds this sensor's measure
+    def query(self, sensor_wrapper, time_query) -> dict:
+        return {"time": time_query}
+
+    # the rollups of this run only, like the run collection
+    def rollup_query(self, sensor_wrapper, time_query) -> dict:
+        return {"sensor_id": sensor_wrapper["id"], "measure": sensor_wrapper["measure"], "time": time_query, "run": self.run_number}
+
+    # the collection is the current run, which is never archived
+    def exclude_runs(self, runs) -> None:
+        pass
+
+class Consolidated_Store:
+
+    # constructor, makes sure the range query index exists
+    def __init__(self, db, run_number) -> None:
+        self.db = db
+        self.run_number = run_number
+        self.readings = db[READINGS_COLLECTION]
+        self.test_sensors = set()
+        # runs answered by the run archive, see exclude_runs
+        self.archived_runs = []
+        ensure_indexes(self.readings)
+
+    def collection(self, sensor, measure):
+        if sensor["connection"] == "test":
+            self.test_sensors.add(sensor["_id"])
+        return self.readings
+
+    def document(self, sensor_wrapper, value, read_time) -> dict:
+        return {
+            "run": self.run_number,
+            "sensor_id": sensor_wrapper["id"],
+            "sensor_name": sensor_wrapper["name"],
+            "measure": sensor_wrapper["measure"],
+            "test": sensor_wrapper["id"] in self.test_sensors,
+            "time": read_time,
+            "value": value
+        }
+
+    def query(self, sensor_wrapper, time_query) -> dict:
+        query = {"sensor_id": sensor_wrapper["id"], "measure": sensor_wrapper["measure"], "time": time_query}
+        archived_runs = self.archived_runs
+        if archived_runs:
+            query["run"] = {"$nin": archived_runs}
+        return query
+
+    def rollup_query(self, sensor_wrapper, time_query) -> dict:
+        return self.query(sensor_wrapper, time_query)
+
+    # the list is replaced, never changed, queries being built keep a consistent one
+    def exclude_runs(self, runs) -> None:
+        self.archived_runs = sorted(runs)
+
+# indexes of the consolidated readings collection
+def ensure_indexes(readings) -> None:
+    readings.create_index([("sensor_id", ASCENDING), ("measure", ASCENDING), ("time", ASCENDING)], name="sensor_measure_time")
+    readings.create_index([("run", ASCENDING), ("sensor_id", ASCENDING)], name="run_sensor")
+
+# Picks the store from the storage_backend setting ("per_run" or "consolidated")
+def create_store(db, settings) -> object:
+    if settings.get("storage_backend", "per_run") == "consolidated":
+        return Consolidated_Store(db, settings["run_number"])
+    return Per_Run_Store(db, settings["run_number"])
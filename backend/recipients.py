@@ -0,0 +1,105 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------------------------------------
+#   Cached recipient list for the out-of-range alerts
+#
+#   notification() runs while alerts are being raised, so it must not
+#   wait on the user collection. The addresses of the users with notifications on
+#   are kept here and read without touching the DB.
+#   The user routes (create/update/delete) call invalidate(), which
+#   reloads the list on a background thread. As a fallback for changes
+#   made outside the web app, a list older than ttl seconds is reloaded
+#   the same way on the next read, the old list is used until then.
+#   If a reload fails the previous list is kept.
+#----------------------------------------------------------------------------------------
+
+# seconds before a list that was not invalidated is reloaded anyway
+RECIPIENT_TTL = 300
+
+# notifs values that turn alerts on, users created without one get "yes"
+NOTIFS_ON = ("yes", "y", "true", "on", "1")
+
+# whether a user document has notifications on
+def notifications_on(user) -> bool:
+    notifs = user.get("notifs")
+    if notifs is None or notifs == "":
+        return True
+    return str(notifs).strip().lower() in NOTIFS_ON
+
+class Recipient_Cache:
+
+    # constructor
+    def __init__(self, user_collection, ttl=RECIPIENT_TTL) -> None:
+        self.user_collection = user_collection
+        self.ttl = float(ttl)
+        self.lock = threading.Lock()
+        self.emails = ()
+        self.loaded_at = None       # monotonic time of the last reload
+        self.refreshing = False     # a reload thread is running
+        self.stale = False          # reload again when the running one is done
+        self.reloads = 0
+        self.failures = 0
+
+    # reloads the list on the calling thread, used at startup
+    def load(self) -> None:
+        self._reload()
+
+    # addresses of the users with notifications on, never queries the DB
+    def addresses(self) -> tuple:
+        with self.lock:
+            emails = self.emails
+            expired = self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+        if expired:
+            self._refresh()
+        return emails
+
+    # the user collection changed, reload in the background
+    def invalidate(self) -> None:
+        self._refresh()
+
+    # counters for monitoring
+    def stats(self) -> dict:
+        with self.lock:
+            age = None if self.loaded_at is None else time.monotonic() - self.loaded_at
+            return {"recipients": len(self.emails), "age_seconds": age,
+                    "reloads": self.reloads, "failures": self.failures}
+
+    # starts a reload thread, or marks the running one to go again so
+    # changes made while it was reading are not missed
+    def _refresh(self) -> None:
+        with self.lock:
+            if self.refreshing:
+                self.stale = True
+                return
+            self.refreshing = True
+            self.stale = False
+        threading.Thread(target=self._refresh_loop, daemon=True).start()
+
+    def _refresh_loop(self) -> None:
+        while True:
+            self._reload()
+            with self.lock:
+                if not self.stale:
+                    self.refreshing = False
+                    return
+                self.stale = False
+
+    def _reload(self) -> None:
+        try:
+            users = self.user_collection.find({}, {"email": 1, "notifs": 1})
+            emails = tuple(user["email"] for user in users if user.get("email") and notifications_on(user))
+        except Exception as err:
+            logger.warning(f"Recipient cache: could not load users: {err}")
+            with self.lock:
+                self.failures += 1
+                # retry after another ttl instead of on every alert
+                self.loaded_at = time.monotonic()
+            return
+        with self.lock:
+            self.emails = emails
+            self.loaded_at = time.monotonic()
+            self.reloads += 1
@@ -0,0 +1,54 @@
+#----------------------------------------------------------------------------------------
+#   Hot reconfiguration of the running sensors
+#
+#   diff_sensors compares the sensor collection with the running Sensor
+#   List and sorts every sensor into what has to happen to it:
+#       update   only the ranges changed, new high/low applied in place,
+#                the sensor keeps running with its recent readings
+#       add      new sensor, or one whose port settings changed
+#       remove   sensor gone, or one whose port settings changed
+#   A sensor whose port settings changed is removed and added again, so
+#   its port is closed before the new one is opened. Sensors that did
+#   not change are not touched at all.
+#----------------------------------------------------------------------------------------
+
+# sensor document fields that need the device to be reopened when changed
+# (the name is part of the Sensor List key and of the run collection name)
+PORT_FIELDS = ["name", "type", "connection", "baud_rate"]
+
+# the fields of a sensor document the running device was opened with
+def port_config(sensor) -> dict:
+    return {field: sensor.get(field) for field in PORT_FIELDS}
+
+# (high, low) of one measure of a sensor document
+def measure_range(sensor, measure) -> tuple:
+    measure_range = sensor["measures"][measure]
+    return float(measure_range["range_high"]), float(measure_range["range_low"])
+
+# sensors is the sensor collection, sensor_list the running Sensor List
+# Returns {"update": [(sensor wrapper, high, low)], "add": [sensor document],
+# "remove": [(Sensor List key, sensor wrapper)]}
+def diff_sensors(sensors, sensor_list) -> dict:
+    running = {}
+    for key, sensor_wrapper in sensor_list.items():
+        running.setdefault(sensor_wrapper["id"], []).append((key, sensor_wrapper))
+
+    plan = {"update": [], "add": [], "remove": []}
+    for sensor in sensors:
+        wrappers = running.pop(sensor["_id"], None)
+        if wrappers is None:
+            plan["add"].append(sensor)
+            continue
+        if any(sensor_wrapper.get("config") != port_config(sensor) for _, sensor_wrapper in wrappers):
+            plan["remove"].extend(wrappers)
+            plan["add"].append(sensor)
+            continue
+        for _, sensor_wrapper in wrappers:
+            high, low = measure_range(sensor, sensor_wrapper["measure"])
+            if (high, low) != (sensor_wrapper["high"], sensor_wrapper["low"]):
+                plan["update"].append((sensor_wrapper, high, low))
+
+    # whatever is still running is no longer in the sensor collection
+    for wrappers in running.values():
+        plan["remove"].extend(wrappers)
+    return plan
@@ -0,0 +1,50 @@
+import numpy as np
+
+#----------------------------------------------------------------------------------------
+#   Fixed capacity ring buffer of (time, value) readings
+#
+#   Times (epoch seconds) and values are kept in two float64 arrays, so a
+#   reading costs 32 bytes instead of a dictionary per reading. Every
+#   reading is written twice, capacity apart, which keeps the newest
+#   capacity readings one contiguous slice of the arrays: last(n) and
+#   since(t) return numpy views without copying, and append stays O(1).
+#
+#   The views share memory with the buffer and are overwritten by later
+#   appends, the owner (Sensor_State) reads them under its lock and turns
+#   them into lists before releasing it. Times are expected in the order
+#   they are appended (since uses a binary search).
+#----------------------------------------------------------------------------------------
+
+class Ring_Buffer:
+
+    # constructor, capacity is the number of readings kept
+    def __init__(self, capacity) -> None:
+        self.capacity = max(1, int(capacity))
+        self.times = np.empty(2 * self.capacity, dtype=np.float64)
+        self.values = np.empty(2 * self.capacity, dtype=np.float64)
+        self.next = 0       # write position, in [0, capacity)
+        self.count = 0
+
+    def __len__(self) -> int:
+        return self.count
+
+    # add a reading, the oldest one is dropped when full
+    def append(self, time, value) -> None:
+        i = self.next
+        self.times[i] = self.times[i + self.capacity] = time
+        self.values[i] = self.values[i + self.capacity] = value
+        self.next = (i + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    # views of the newest n readings (all of them when n is None), oldest first
+    def last(self, n=None) -> tuple:
+        n = self.count if n is None else max(0, min(int(n), self.count))
+        end = self.next + self.capacity
+        return self.times[end - n:end], self.values[end - n:end]
+
+    # views of the readings newer than time t, oldest first
+    def since(self, t) -> tuple:
+        times, values = self.last()
+        start = int(np.searchsorted(times, t, side="right"))
+        return times[start:], values[start:]
@@ -0,0 +1,120 @@
+import threading
+from datetime import datetime, timedelta
+from pymongo import ASCENDING
+
+#----------------------------------------------------------------------------------------
+#   Minute and hour rollups of the sensor readings, kept at ingest time
+#
+#   record_reading feeds every reading to Rollup_Stage.add. For each
+#   sensor, measure and resolution the stage keeps the open bucket in
+#   memory (count, sum, min, max, first, last and how many readings were
+#   out of the sensor's range). When a reading falls in a later bucket
+#   the open one is closed and returned as a document for the rollup
+#   collection, which record_reading hands to the storage writer.
+#
+#   A bucket can be written in pieces: flushed early (flush_open on
+#   terminate) and continued by the next start within the same minute.
+#   Each piece is its own document and rollup_pipeline (downsample.py)
+#   adds the pieces of a bucket up. Being plain inserts, the documents
+#   go through the storage writer's write-ahead log and its retries like
+#   the readings, and a replayed one is a duplicate key, not a double count.
+#
+#   Rollup documents are {run, sensor_id, measure, time (bucket start),
+#   count, sum, min, max, first, first_time, last, last_time, out_of_range}.
+#   The bucket still open is not in the collection yet, so a rollup
+#   answer lags the raw readings by at most one bucket.
+#----------------------------------------------------------------------------------------
+
+# resolution -> (bucket width in seconds, collection name)
+ROLLUPS = {
+    "minute": (60, "rollup_minute"),
+    "hour": (3600, "rollup_hour")
+}
+
+# reading times are stored as naive UTC datetimes
+EPOCH = datetime(1970, 1, 1)
+
+class Rollup_Stage:
+
+    # constructor, makes sure the rollup collections are indexed
+    def __init__(self, db, run_number) -> None:
+        self.run_number = run_number
+        self.collections = {}
+        for resolution, (_, collection_name) in ROLLUPS.items():
+            collection = db[collection_name]
+            ensure_rollup_indexes(collection)
+            self.collections[resolution] = collection
+
+        # (sensor id, measure, resolution) -> open bucket
+        self.open_buckets = {}
+        self.lock = threading.Lock()
+
+    # adds a reading, returns the buckets it closed as
+    # (collection, document) pairs
+    def add(self, sensor_wrapper, value, read_time) -> list:
+        out_of_range = 1 if value > sensor_wrapper["high"] or value < sensor_wrapper["low"] else 0
+        closed = []
+        with self.lock:
+            for resolution, (seconds, _) in ROLLUPS.items():
+                key = (sensor_wrapper["id"], sensor_wrapper["measure"], resolution)
+                start = bucket_start(read_time, seconds)
+                bucket = self.open_buckets.get(key)
+                if bucket is not None and bucket["time"] != start:
+                    closed.append(self._document(key, bucket))
+                    bucket = None
+                if bucket is None:
+                    self.open_buckets[key] = {
+                        "time": start, "count": 1, "sum": value, "min": value, "max": value,
+                        "first": value, "first_time": read_time, "last": value, "last_time": read_time,
+                        "out_of_range": out_of_range
+                    }
+                    continue
+                bucket["count"] += 1
+                bucket["sum"] += value
+                bucket["min"] = min(bucket["min"], value)
+                bucket["max"] = max(bucket["max"], value)
+                bucket["last"] = value
+                bucket["last_time"] = read_time
+                bucket["out_of_range"] += out_of_range
+        return closed
+
+    # closes every open bucket, returns their documents
+    def flush_open(self) -> list:
+        with self.lock:
+            closed = [self._document(key, bucket) for key, bucket in self.open_buckets.items()]
+            self.open_buckets = {}
+        return closed
+
+    # rollup document of one closed bucket (piece) and its collection
+    def _document(self, key, bucket) -> tuple:
+        sensor_id, measure, resolution = key
+        document = {"run": self.run_number, "sensor_id": sensor_id, "measure": measure}
+        document.update(bucket)
+        return self.collections[resolution], document
+
+    # rollup collection that can answer buckets of bucket_ms milliseconds
+    # (the coarsest resolution dividing it), None if it is below a minute
+    def collection_for(self, bucket_ms):
+        for resolution, (seconds, _) in sorted(ROLLUPS.items(), key=lambda item: -item[1][0]):
+            if bucket_ms % (seconds * 1000) == 0:
+                return self.collections[resolution]
+        return None
+
+# start of the bucket of the given width holding read_time
+def bucket_start(read_time, seconds) -> datetime:
+    offset = read_time - EPOCH
+    into_bucket = (offset.days * 86400 + offset.seconds) % seconds
+    return read_time - timedelta(seconds=into_bucket, microseconds=offset.microseconds)
+
+# bucket width (ms) at least bucket_ms that a rollup resolution can answer
+def rollup_bucket_ms(bucket_ms) -> int:
+    minute_ms = ROLLUPS["minute"][0] * 1000
+    return -(-int(bucket_ms) // minute_ms) * minute_ms
+
+# a bucket may have several pieces, so the index is not unique
+# (a unique one left by an older version is replaced)
+def ensure_rollup_indexes(collection) -> None:
+    name = "sensor_measure_time_run"
+    if collection.index_information().get(name, {}).get("unique"):
+        collection.drop_index(name)
+    collection.create_index([("sensor_id", ASCENDING), ("measure", ASCENDING), ("time", ASCENDING), ("run", ASCENDING)], name=name)
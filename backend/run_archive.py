@@ -0,0 +1,390 @@
+import json
+import logging
+import mmap
+import os
+import re
+import shutil
+import struct
+import threading
+import zlib
+from datetime import datetime
+import numpy as np
+from readings_store import READINGS_COLLECTION, RUN_COLLECTION_PATTERN
+
+logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------------------------------------
+#   Columnar archive of finished runs
+#
+#   Once a run is over its readings never change, so they are compacted
+#   out of MongoDB into one file per sensor and measure:
+#       {root}/run{N}/{sensor_id}_{measure}.wcol
+#       {root}/run{N}/manifest.json   (the series of the run, with counts)
+#
+#   A .wcol file is a header, a chunk index and the chunks:
+#       header  magic, chunk count, chunk size, reading count (HEADER)
+#       index   one INDEX_DTYPE row per chunk: first and last time, count,
+#               offset and compressed sizes of its two columns
+#       chunks  CHUNK_SIZE readings each, the times as int64 microseconds
+#               since the epoch, delta encoded, and the values as float64,
+#               both byte shuffled and zlib compressed
+#   Files are memory mapped and the index is a NumPy array straight over
+#   the mapping, so a range query is a binary search in the index, the
+#   overlapping chunks decompressed, and a binary search plus a slice in
+#   the first and last of them. Nothing else of the file is read.
+#   Values are kept as float64, integer readings come back as floats.
+#
+#   Archiving leaves MongoDB untouched. The queries of app.py read the
+#   archived runs from here and the rest from MongoDB (the consolidated
+#   store leaves the archived runs out, see readings_store.py; a per run
+#   collection is always the current run, never archived).
+#   A run is written to a temporary directory and renamed into place, a
+#   crash while archiving leaves no partial run behind.
+#
+#   Usage (from backend/): python run_archive.py [archive directory]
+#       archives the finished runs of the database (run_number in the settings)
+#   python run_archive.py --zip [WAASMA_flaskdb.zip] [archive directory]
+#       archives the runs of a mongodump zip
+#----------------------------------------------------------------------------------------
+
+# next to this file unless the run_archive setting gives a path
+DEFAULT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run_archive")
+
+# the recorded runs at the repository root
+DEFAULT_ZIP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "WAASMA_flaskdb.zip")
+
+# readings per chunk, about 6 hours at the default 5 s read frequency
+CHUNK_SIZE = 4096
+
+COMPRESSION_LEVEL = 6
+
+MAGIC = b"WCOL0001"
+HEADER = struct.Struct("<8sIIQ")
+INDEX_DTYPE = np.dtype([("first", "<i8"), ("last", "<i8"), ("count", "<i8"),
+                        ("offset", "<i8"), ("time_bytes", "<i8"), ("value_bytes", "<i8")])
+
+MANIFEST = "manifest.json"
+RUN_DIRECTORY = re.compile(r"^run(?P<run>\d+)$")
+
+
+# microseconds since the epoch of a naive datetime
+def micros(value) -> int:
+    return int(np.datetime64(value, "us").astype(np.int64))
+
+# bytes of an 8 byte array regrouped by byte position (all the low bytes,
+# then the next ones...), the slowly changing high bytes then compress well
+def shuffle(array) -> bytes:
+    return np.ascontiguousarray(array.view(np.uint8).reshape(-1, 8).T).tobytes()
+
+def unshuffle(data, dtype):
+    return np.frombuffer(data, np.uint8).reshape(8, -1).T.copy().view(dtype).ravel()
+
+# writes times (int64 microseconds, sorted) and values (float64) as a .wcol file
+def write_column_file(path, times, values, chunk_size=CHUNK_SIZE) -> None:
+    chunk_count = -(-len(times) // chunk_size)
+    index = np.zeros(chunk_count, INDEX_DTYPE)
+    offset = HEADER.size + index.nbytes
+    blobs = []
+    for number in range(chunk_count):
+        chunk_times = times[number * chunk_size:(number + 1) * chunk_size]
+        chunk_values = values[number * chunk_size:(number + 1) * chunk_size]
+        # the first delta is from 0, each chunk decodes on its own
+        time_data = zlib.compress(shuffle(np.diff(chunk_times, prepend=0)), COMPRESSION_LEVEL)
+        value_data = zlib.compress(shuffle(chunk_values), COMPRESSION_LEVEL)
+        index[number] = (chunk_times[0], chunk_times[-1], len(chunk_times), offset, len(time_data), len(value_data))
+        offset += len(time_data) + len(value_data)
+        blobs.append(time_data)
+        blobs.append(value_data)
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, chunk_count, chunk_size, len(times)))
+        f.write(index.tobytes())
+        for blob in blobs:
+            f.write(blob)
+
+# one memory mapped .wcol file
+class Column_File:
+
+    def __init__(self, path) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, chunk_count, self.chunk_size, self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a column file")
+        self.index = np.frombuffer(self.map, INDEX_DTYPE, chunk_count, HEADER.size)
+        self.first = int(self.index["first"][0]) if chunk_count else None
+        self.last = int(self.index["last"][-1]) if chunk_count else None
+
+    # times (int64 microseconds) and values of chunk number
+    def chunk(self, number) -> tuple:
+        _, _, _, offset, time_bytes, value_bytes = self.index[number].tolist()
+        times = np.cumsum(unshuffle(zlib.decompress(self.map[offset:offset + time_bytes]), np.int64))
+        values = unshuffle(zlib.decompress(self.map[offset + time_bytes:offset + time_bytes + value_bytes]), np.float64)
+        return times, values
+
+    # (times, values) of the readings in [start, end) microseconds chunk by
+    # chunk, end None for an open range; only the overlapping chunks are read
+    def slices(self, start, end):
+        low = int(np.searchsorted(self.index["last"], start, "left"))
+        high = len(self.index) if end is None else int(np.searchsorted(self.index["first"], end, "left"))
+        for number in range(low, high):
+            times, values = self.chunk(number)
+            begin = int(np.searchsorted(times, start, "left"))
+            stop = len(times) if end is None else int(np.searchsorted(times, end, "left"))
+            if stop > begin:
+                yield times[begin:stop], values[begin:stop]
+
+    def close(self) -> None:
+        self.index = None
+        try:
+            self.map.close()
+        except BufferError:
+            # a slice of the index is still in use, the mapping goes with it
+            pass
+
+class Run_Archive:
+
+    # opens the archive at root, every run archived there is queryable
+    def __init__(self, root=DEFAULT_ROOT) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.lock = threading.Lock()
+        self.manifests = {}     # run number -> manifest
+        self.files = {}         # run number -> list of Column_File
+        self.series = {}        # (sensor id, measure) -> list of (run, Column_File), oldest first
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name.startswith("."):
+                # left by an archiving that did not finish
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            match = RUN_DIRECTORY.match(name)
+            if match is not None and os.path.exists(os.path.join(path, MANIFEST)):
+                self._load(int(match["run"]))
+
+    # archived run numbers
+    def runs(self) -> list:
+        with self.lock:
+            return sorted(self.manifests)
+
+    def _load(self, run) -> None:
+        directory = os.path.join(self.root, f"run{run}")
+        with open(os.path.join(directory, MANIFEST)) as f:
+            manifest = json.load(f)
+        files = []
+        for entry in manifest["series"]:
+            column_file = Column_File(os.path.join(directory, entry["file"]))
+            files.append(((entry["sensor_id"], entry["measure"]), column_file))
+        with self.lock:
+            # a query may still be reading the files replaced, they are
+            # unmapped once nothing refers to them
+            self.files.pop(run, None)
+            series = {key: [(other, column_file) for other, column_file in entries if other != run]
+                      for key, entries in self.series.items()}
+            for key, column_file in files:
+                if column_file.count:
+                    series.setdefault(key, []).append((run, column_file))
+            for entries in series.values():
+                entries.sort(key=lambda entry: entry[1].first)
+            self.series = series
+            self.files[run] = [column_file for _, column_file in files]
+            self.manifests[run] = manifest
+
+    # (times, values) chunk by chunk for a sensor's measure in [start, end),
+    # times as datetime64[us], oldest first; end None for an open range
+    def chunks(self, sensor_id, measure, start=None, end=None):
+        with self.lock:
+            entries = self.series.get((str(sensor_id), measure), [])
+        start_us = micros(start) if start is not None else np.iinfo(np.int64).min
+        end_us = micros(end) if end is not None else None
+        for _, column_file in entries:
+            if column_file.last < start_us or (end_us is not None and column_file.first >= end_us):
+                continue
+            for times, values in column_file.slices(start_us, end_us):
+                yield times.view("datetime64[us]"), values
+
+    # every reading of a sensor's measure in [start, end) as two arrays
+    def series_range(self, sensor_id, measure, start=None, end=None) -> tuple:
+        parts = list(self.chunks(sensor_id, measure, start, end))
+        if not parts:
+            return np.empty(0, "datetime64[us]"), np.empty(0, np.float64)
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate([times for times, _ in parts]), np.concatenate([values for _, values in parts])
+
+    # archives run from db, replacing an earlier archive of it
+    # the consolidated readings when they hold the run, else the per run collections
+    def archive_run(self, db, run) -> dict:
+        found = {}
+        names = db.list_collection_names()
+        readings = db[READINGS_COLLECTION]
+        if READINGS_COLLECTION in names and readings.find_one({"run": run}, {"_id": 1}) is not None:
+            source = READINGS_COLLECTION
+            projection = {"_id": 0, "sensor_id": 1, "sensor_name": 1, "measure": 1, "test": 1, "time": 1, "value": 1}
+            for document in readings.find({"run": run}, projection):
+                collect(found, document.get("sensor_id", document.get("sensor_name")), document["measure"],
+                        document.get("sensor_name"), document.get("test", False), document)
+        else:
+            source = "run collections"
+            sensor_ids = sensor_ids_by_name(db[name].find({}, {"name": 1}) for name in ["sensor_collection", "test_sensor_collection"])
+            for name in sorted(names):
+                match = RUN_COLLECTION_PATTERN.match(name)
+                if match is None or int(match["run"]) != run:
+                    continue
+                for document in db[name].find({"time": {"$exists": True}}, {"_id": 0, "time": 1, "value": 1, "sensor_id": 1}):
+                    collect(found, document.get("sensor_id", sensor_ids.get(match["name"], match["name"])), match["measure"],
+                            match["name"], match["test"] is not None, document)
+        return self.write_run(run, found, source)
+
+    # archives every finished run (before current_run) that is not archived yet
+    # on_archived(run) is called after each one, returns the runs archived
+    def archive_pending(self, db, current_run, on_archived=None) -> list:
+        runs = set()
+        names = db.list_collection_names()
+        for name in names:
+            match = RUN_COLLECTION_PATTERN.match(name)
+            if match is not None:
+                runs.add(int(match["run"]))
+        if READINGS_COLLECTION in names:
+            runs.update(db[READINGS_COLLECTION].distinct("run"))
+        archived = []
+        for run in sorted(runs - set(self.runs())):
+            if run >= current_run:
+                continue
+            manifest = self.archive_run(db, run)
+            logger.info(f"archived run {run}: {sum(entry['count'] for entry in manifest['series'])} readings")
+            archived.append(run)
+            if on_archived is not None:
+                on_archived(run)
+        return archived
+
+    # archives the per run collections of a mongodump zip, returns the runs
+    def archive_dump(self, path=DEFAULT_ZIP) -> list:
+        import zipfile
+        import bson
+        collections = {}
+        with zipfile.ZipFile(path) as dump:
+            for name in dump.namelist():
+                if name.endswith(".bson"):
+                    collections[os.path.basename(name)[:-len(".bson")]] = bson.decode_all(dump.read(name))
+        sensor_ids = sensor_ids_by_name(collections.get(name, []) for name in ["sensor_collection", "test_sensor_collection"])
+        runs = {}
+        for name in sorted(collections):
+            match = RUN_COLLECTION_PATTERN.match(name)
+            if match is None:
+                continue
+            found = runs.setdefault(int(match["run"]), {})
+            for document in collections[name]:
+                if "time" in document:
+                    collect(found, document.get("sensor_id", sensor_ids.get(match["name"], match["name"])), match["measure"],
+                            match["name"], match["test"] is not None, document)
+        for run, found in sorted(runs.items()):
+            self.write_run(run, found, os.path.basename(path))
+        return sorted(runs)
+
+    # writes the series collected for run (see collect) and loads them
+    def write_run(self, run, found, source) -> dict:
+        temporary = os.path.join(self.root, f".run{run}.tmp")
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        manifest = {"run": run, "source": source, "archived": datetime.now().isoformat(timespec="seconds"), "series": []}
+        for (sensor_id, measure), series in sorted(found.items()):
+            times = np.array(series["times"], dtype="datetime64[us]").view(np.int64)
+            values = np.array(series["values"], dtype=np.float64)
+            # readings are stored in arrival order, which is not always time order
+            order = np.argsort(times, kind="stable")
+            times, values = times[order], values[order]
+            file_name = re.sub(r"[^\w-]", "_", f"{sensor_id}_{measure}") + ".wcol"
+            write_column_file(os.path.join(temporary, file_name), times, values)
+            manifest["series"].append({
+                "file": file_name, "sensor_id": sensor_id, "sensor_name": series["sensor_name"], "measure": measure,
+                "test": series["test"], "count": len(times),
+                "first": str(times[0].view("datetime64[us]")), "last": str(times[-1].view("datetime64[us]"))
+            })
+        with open(os.path.join(temporary, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=1)
+
+        directory = os.path.join(self.root, f"run{run}")
+        replaced = os.path.join(self.root, f".run{run}.old")
+        if os.path.exists(directory):
+            os.rename(directory, replaced)
+        os.rename(temporary, directory)
+        self._load(run)
+        shutil.rmtree(replaced, ignore_errors=True)
+        return manifest
+
+    # archived runs, series, readings and bytes on disk
+    def stats(self) -> dict:
+        with self.lock:
+            files = [column_file for run_files in self.files.values() for column_file in run_files]
+            runs = len(self.manifests)
+            series = len(self.series)
+        return {"runs": runs, "series": series, "readings": sum(column_file.count for column_file in files),
+                "bytes": sum(os.path.getsize(column_file.path) for column_file in files)}
+
+    def close(self) -> None:
+        with self.lock:
+            for run_files in self.files.values():
+                for column_file in run_files:
+                    column_file.close()
+            self.files = {}
+            self.series = {}
+            self.manifests = {}
+
+# adds a reading document to the series of found, keyed by (sensor id, measure)
+# documents without a numeric value (init documents, failed reads) are skipped
+def collect(found, sensor_id, measure, sensor_name, test, document) -> None:
+    value = document.get("value")
+    if not isinstance(value, (int, float)) or isinstance(value, bool):
+        return
+    series = found.get((str(sensor_id), measure))
+    if series is None:
+        series = found[(str(sensor_id), measure)] = {"sensor_name": sensor_name, "test": bool(test), "times": [], "values": []}
+    series["times"].append(document["time"])
+    series["values"].append(value)
+
+# sensor name -> id from sensor documents, for readings stored before sensor_id was
+def sensor_ids_by_name(cursors) -> dict:
+    sensor_ids = {}
+    for cursor in cursors:
+        for sensor in cursor:
+            sensor_ids.setdefault(sensor["name"], sensor["_id"])
+    return sensor_ids
+
+# reading documents ({time, value} and sensor_id when given) of archived arrays
+def series_documents(times, values, sensor_id=None) -> list:
+    if sensor_id is None:
+        return [{"time": time, "value": value} for time, value in zip(times.tolist(), values.tolist())]
+    return [{"time": time, "value": value, "sensor_id": sensor_id} for time, value in zip(times.tolist(), values.tolist())]
+
+# time buckets of bucket_ms milliseconds of archived arrays, the same
+# documents as bucket_pipeline in downsample.py (time, value mean, min, max, count)
+def series_buckets(times, values, bucket_ms) -> list:
+    if len(times) == 0:
+        return []
+    bucket_ms = max(1, int(bucket_ms))
+    milliseconds = times.view(np.int64) // 1000
+    keys = milliseconds - milliseconds % bucket_ms
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    counts = np.diff(np.append(starts, len(keys)))
+    means = np.add.reduceat(values, starts) / counts
+    lows = np.minimum.reduceat(values, starts)
+    highs = np.maximum.reduceat(values, starts)
+    bucket_times = keys[starts].astype("datetime64[ms]").tolist()
+    return [{"time": time, "value": mean, "min": low, "max": high, "count": count}
+            for time, mean, low, high, count in zip(bucket_times, means.tolist(), lows.tolist(), highs.tolist(), counts.tolist())]
+
+
+if __name__ == "__main__":
+    import sys
+    arguments = sys.argv[1:]
+    if arguments[:1] == ["--zip"]:
+        path = arguments[1] if len(arguments) > 1 else DEFAULT_ZIP
+        archive = Run_Archive(arguments[2] if len(arguments) > 2 else DEFAULT_ROOT)
+        runs = archive.archive_dump(path)
+    else:
+        from db_config import db, settings_collection
+        archive = Run_Archive(arguments[0] if arguments else DEFAULT_ROOT)
+        runs = archive.archive_pending(db, settings_collection.find_one()["run_number"])
+    stats = archive.stats()
+    print(f"archived runs {runs}, {stats['runs']} runs in {archive.root}: {stats['readings']} readings in {stats['bytes']} bytes")
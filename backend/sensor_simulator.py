@@ -0,0 +1,336 @@
+import argparse
+import heapq
+import os
+import random
+import threading
+import time
+import zipfile
+from datetime import datetime
+
+import bson
+import numpy as np
+
+from w_sensor import FRAME_FIELDS, MEASURE_FIELDS
+
+#----------------------------------------------------------------------------------------
+#   Simulated sensors for load tests without lab hardware
+#
+#   Models give the value of one measure at a time (seconds since the
+#   simulation started):
+#       Signal_Model    base value with gaussian noise, linear drift and
+#                       random spikes
+#       Replay_Model    a recorded run from WAASMA_flaskdb.zip played back
+#                       at speed x (1x-1000x), looping at the end
+#   create_model builds one from the "simulation" entry of a sensor document.
+#
+#   Two ways to use them:
+#       Random_Test_Sensor  "test" connection, the models are read inline
+#                           (see random_test_sensor.py)
+#       Simulator_Farm      every device gets a pseudo-terminal pair, one
+#                           thread writes real #DATA: frames to the master
+#                           side and main opens the slave path as a normal
+#                           serial port, so Water_Sensor parsing, the
+#                           acquisition engines, storage and the dashboards
+#                           all run as with the meters.
+#   The farm needs pseudo-terminals, so it runs on Linux and macOS only.
+#   A farm device that is not read fast enough fills its pty buffer, the
+#   frames that do not fit are dropped and counted (like a meter whose
+#   output nobody reads).
+#
+#   Command line (from backend/), registers the devices in the sensor
+#   collection so main picks them up on its next start, and removes them
+#   again on Ctrl-C:
+#       python sensor_simulator.py --devices 200 --interval 1 --noise 0.2 --spike-rate 0.01
+#       python sensor_simulator.py --replay --speed 100
+#----------------------------------------------------------------------------------------
+
+ZIP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "WAASMA_flaskdb.zip")
+
+# values when a sensor document does not give a base
+DEFAULT_BASE = {"CO2": 8.0, "DO": 3.0}
+
+# columns of a #DATA: frame that are not a measure, from a recorded frame
+# "#DATA: 07/26/24,15:12:15,0.0,21.93,7.42,27.2,-2.76,104.6,8.91,4983.4,0.6,163.3,-18.8"
+FILLER_VALUES = [0.0, 21.93, 7.42, 27.2, -2.76, 104.6, 8.91, 4983.4, 0.6, 163.3, -18.8, 0.0, 0.0]
+
+# recorded gaps longer than this (seconds) are shortened when replaying
+MAX_REPLAY_GAP = 60.0
+
+# seconds a frame may be written before it is due
+SCHEDULE_SLACK = 0.001
+
+# base value + noise + drift + spikes
+class Signal_Model:
+
+    # noise: standard deviation, drift: change per hour,
+    # spike_rate: chance per reading, spike_size: added on a spike (either sign)
+    def __init__(self, base, noise=0.0, drift=0.0, spike_rate=0.0, spike_size=0.0, seed=None) -> None:
+        self.base = float(base)
+        self.noise = float(noise)
+        self.drift = float(drift)
+        self.spike_rate = float(spike_rate)
+        self.spike_size = float(spike_size)
+        self.random = random.Random(seed)
+
+    def value(self, elapsed) -> float:
+        value = self.base + self.drift * elapsed / 3600.0
+        if self.noise > 0:
+            value += self.random.gauss(0.0, self.noise)
+        if self.spike_rate > 0 and self.random.random() < self.spike_rate:
+            value += self.spike_size if self.random.random() < 0.5 else -self.spike_size
+        return round(value, 2)
+
+    # readings come at the farm's interval
+    def next_time(self, elapsed, interval) -> float:
+        return elapsed + interval
+
+# recorded readings played back at speed x
+class Replay_Model:
+
+    # times in epoch seconds, oldest first
+    def __init__(self, times, values, speed=1.0) -> None:
+        times = np.asarray(times, dtype=np.float64)
+        self.values = np.asarray(values, dtype=np.float64)
+        self.speed = float(speed)
+        # recording time from its first reading, long gaps shortened
+        gaps = np.minimum(np.diff(times, prepend=times[:1]), MAX_REPLAY_GAP)
+        self.offsets = np.cumsum(gaps)
+        # one loop of the recording, plus one typical gap before it repeats
+        self.duration = self.offsets[-1] + (float(np.median(gaps[1:])) if len(gaps) > 1 else 1.0)
+
+    # value of the recording at elapsed simulation seconds
+    def value(self, elapsed) -> float:
+        position = (elapsed * self.speed) % self.duration
+        index = max(0, int(np.searchsorted(self.offsets, position, side="right")) - 1)
+        return float(self.values[index])
+
+    # simulation time of the next recorded reading
+    def next_time(self, elapsed, interval) -> float:
+        position = elapsed * self.speed
+        loops, within = divmod(position, self.duration)
+        index = int(np.searchsorted(self.offsets, within, side="right"))
+        if index < len(self.offsets):
+            following = loops * self.duration + self.offsets[index]
+        else:
+            following = (loops + 1) * self.duration
+        return max(following / self.speed, elapsed + 1e-6)
+
+# builds the model of one measure from a "simulation" configuration
+#   {"model": "signal", "base": {"CO2": 24}, "noise": 0.1, "drift": 0.5,
+#    "spike_rate": 0.01, "spike_size": 5, "seed": 1}
+#   {"model": "replay", "run": "Water1_CO2_collection_run13", "speed": 100}
+# for replay, "run" names the CO2 collection, the DO one is found from it
+def create_model(config, measure, runs=None):
+    config = config or {}
+    if config.get("model") == "replay":
+        runs = runs if runs is not None else load_recorded_runs(config.get("path", ZIP_PATH))
+        run = runs[run_label(config["run"])]
+        times, values = run.get(measure) or next(iter(run.values()))
+        return Replay_Model(times, values, config.get("speed", 1.0))
+    base = config.get("base", {})
+    seed = config.get("seed")
+    return Signal_Model(base.get(measure, DEFAULT_BASE.get(measure, 0.0)) if isinstance(base, dict) else base,
+                        config.get("noise", 0.0), config.get("drift", 0.0),
+                        config.get("spike_rate", 0.0), config.get("spike_size", 0.0),
+                        None if seed is None else f"{seed}-{measure}")
+
+# "Water1_CO2_collection_run13" -> "Water1_collection_run13", the device
+# both of its measure collections belong to
+def run_label(collection):
+    parts = collection.split("_")
+    return "_".join(part for part in parts if part not in MEASURE_FIELDS)
+
+# recorded runs of the dump, device label -> {measure: (times, values)}
+def load_recorded_runs(path=ZIP_PATH) -> dict:
+    runs = {}
+    with zipfile.ZipFile(path) as archive:
+        for name in archive.namelist():
+            collection = os.path.basename(name)[:-len(".bson")]
+            if not name.endswith(".bson") or "_collection_run" not in collection:
+                continue
+            measure = next((part for part in collection.split("_") if part in MEASURE_FIELDS), None)
+            readings = [document for document in bson.decode_all(archive.read(name)) if "value" in document]
+            if measure is None or not readings:
+                continue
+            readings.sort(key=lambda document: document["time"])
+            times = [document["time"].timestamp() for document in readings]
+            values = [float(document["value"]) for document in readings]
+            runs.setdefault(run_label(collection), {})[measure] = (times, values)
+    return runs
+
+# one #DATA: line with the given measure values, see w_sensor.py
+def format_frame(readings, when=None) -> bytes:
+    when = when or datetime.now()
+    fields = [when.strftime("%m/%d/%y"), when.strftime("%H:%M:%S")] + [f"{value}" for value in FILLER_VALUES]
+    fields = fields[:FRAME_FIELDS]
+    for measure, index in MEASURE_FIELDS.items():
+        if measure in readings:
+            fields[index] = f"{readings[measure]}"
+    return ("#DATA: " + ",".join(fields) + "\r\n").encode("ascii")
+
+# one simulated meter on a pty pair (POSIX only)
+class Simulated_Device:
+
+    def __init__(self, models) -> None:
+        # tty needs termios, imported here so the models (and the "test"
+        # connection through random_test_sensor) still load on Windows
+        import tty
+        self.models = models
+        self.master, self.slave = os.openpty()
+        # raw: no echo back into the master and no newline translation
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.frames = 0
+        self.dropped = 0
+
+    def frame(self, elapsed) -> bytes:
+        return format_frame({measure: model.value(elapsed) for measure, model in self.models.items()})
+
+    # the next time a frame is due, from the first measure's model
+    def next_time(self, elapsed, interval) -> float:
+        return next(iter(self.models.values())).next_time(elapsed, interval)
+
+    def write(self, data) -> None:
+        try:
+            written = os.write(self.master, data)
+        except BlockingIOError:
+            written = 0
+        if written == len(data):
+            self.frames += 1
+        else:
+            self.dropped += 1
+
+    def close(self) -> None:
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+class Simulator_Farm:
+
+    # interval: seconds between frames of the signal models
+    def __init__(self, interval=1.0) -> None:
+        self.interval = float(interval)
+        self.devices = []
+        self.lock = threading.Lock()
+        self.schedule = []      # heap of (due, sequence, device)
+        self.sequence = 0
+        self.start_time = None
+        self.stopping = threading.Event()
+        self.wake = threading.Event()
+        self.thread = None
+
+    # adds a device with measure -> model, returns the serial port path to open
+    def add_device(self, models) -> str:
+        device = Simulated_Device(models)
+        with self.lock:
+            self.devices.append(device)
+            elapsed = 0.0 if self.start_time is None else time.monotonic() - self.start_time
+            self._push(elapsed, device)
+        self.wake.set()
+        return device.port
+
+    def start(self) -> None:
+        self.start_time = time.monotonic()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            for device in self.devices:
+                device.close()
+            self.devices = []
+            self.schedule = []
+
+    # frames written and dropped over all devices
+    def stats(self) -> dict:
+        with self.lock:
+            return {"devices": len(self.devices),
+                    "frames": sum(device.frames for device in self.devices),
+                    "dropped": sum(device.dropped for device in self.devices)}
+
+    def _push(self, elapsed, device) -> None:
+        self.sequence += 1
+        heapq.heappush(self.schedule, (elapsed, self.sequence, device))
+
+    # one thread writes the frames of every device when they are due
+    def _run(self) -> None:
+        while not self.stopping.is_set():
+            with self.lock:
+                elapsed = time.monotonic() - self.start_time
+                while self.schedule and self.schedule[0][0] <= elapsed + SCHEDULE_SLACK:
+                    due, _, device = heapq.heappop(self.schedule)
+                    device.write(device.frame(due))
+                    self._push(device.next_time(due, self.interval), device)
+                timeout = None if not self.schedule else self.schedule[0][0] - elapsed
+            self.wake.wait(timeout)
+            self.wake.clear()
+
+# sensor documents for farm devices, tank 99 keeps them apart from the real tanks
+def sensor_document(name, port, ranges) -> dict:
+    return {"name": name, "type": "water", "connection": port, "baud_rate": "19200", "tank": 99,
+            "simulated": True,
+            "measures": {measure: {"range_low": str(low), "range_high": str(high)} for measure, (low, high) in ranges.items()}}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Simulated water sensors on pseudo-terminals")
+    parser.add_argument("--devices", type=int, default=10, help="signal devices (ignored with --replay)")
+    parser.add_argument("--interval", type=float, default=1.0, help="seconds between frames of a signal device")
+    parser.add_argument("--noise", type=float, default=0.1)
+    parser.add_argument("--drift", type=float, default=0.0, help="change per hour")
+    parser.add_argument("--spike-rate", type=float, default=0.0, help="chance per frame")
+    parser.add_argument("--spike-size", type=float, default=5.0)
+    parser.add_argument("--replay", action="store_true", help="one device per recorded run in WAASMA_flaskdb.zip")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 1-1000")
+    parser.add_argument("--copies", type=int, default=1, help="devices per recorded run")
+    parser.add_argument("--no-register", action="store_true", help="only print the port paths")
+    arguments = parser.parse_args()
+
+    farm = Simulator_Farm(arguments.interval)
+    devices = []
+    if arguments.replay:
+        runs = load_recorded_runs()
+        for label, run in sorted(runs.items()):
+            for copy in range(arguments.copies):
+                models = {measure: Replay_Model(times, values, arguments.speed) for measure, (times, values) in run.items()}
+                devices.append((f"Replay_{label}_{copy}", farm.add_device(models)))
+    else:
+        for number in range(arguments.devices):
+            config = {"noise": arguments.noise, "drift": arguments.drift, "spike_rate": arguments.spike_rate,
+                      "spike_size": arguments.spike_size, "seed": number}
+            models = {measure: create_model(config, measure) for measure in MEASURE_FIELDS}
+            devices.append((f"Sim{number}", farm.add_device(models)))
+
+    registered = []
+    if not arguments.no_register:
+        from db_config import sensor_collection
+        for name, port in devices:
+            document = sensor_document(name, port, {"CO2": (0, 40), "DO": (0, 12)})
+            registered.append(sensor_collection.insert_one(document).inserted_id)
+        print(f"registered {len(registered)} simulated sensors, start main to read them")
+    for name, port in devices:
+        print(f"{name}: {port}")
+
+    farm.start()
+    try:
+        while True:
+            time.sleep(10)
+            print(farm.stats())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        farm.stop()
+        if registered:
+            sensor_collection.delete_many({"_id": {"$in": registered}})
+            print("simulated sensors removed")
+
+if __name__ == "__main__":
+    main()
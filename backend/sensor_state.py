@@ -0,0 +1,50 @@
+import threading
+from ring_buffer import Ring_Buffer
+
+# Per-sensor reading storage
+# Every sensor wrapper owns one of these, so publishing a new reading
+# only locks that one sensor instead of the whole Sys_State.
+# The lock is held just long enough to swap in a reading or to copy
+# out a snapshot, never across serial IO or DB writes.
+# The recent readings live in a Ring_Buffer of max_readings
+# (time, value) pairs, see ring_buffer.py. Readings are dictionaries
+# {"value", "time"} with time in epoch seconds.
+class Sensor_State:
+
+    # constructor
+    def __init__(self, max_readings=100) -> None:
+        self.lock = threading.Lock()
+        self.current = {}
+        self.recent = Ring_Buffer(max_readings)
+
+    # store a new reading as the current one and in the recent buffer
+    def push(self, reading) -> None:
+        with self.lock:
+            self.current = reading
+            self.recent.append(reading["time"], reading["value"])
+
+    # latest reading, empty dictionary if the sensor has not been read yet
+    def current_reading(self) -> dict:
+        with self.lock:
+            return self.current
+
+    # recent readings as {"time": [...], "value": [...]} lists, oldest first
+    # last: only the newest last readings, since: only readings after that time
+    # The lists are made from the buffer views in one vectorized step each
+    def recent_columns(self, last=None, since=None) -> dict:
+        with self.lock:
+            if since is not None:
+                times, values = self.recent.since(since)
+            else:
+                times, values = self.recent.last()
+            if last is not None:
+                start = len(times) - max(0, min(len(times), int(last)))
+                times, values = times[start:], values[start:]
+            return {"time": times.tolist(), "value": values.tolist()}
+
+    # copies of the newest n readings as (times, values) arrays, for the
+    # anomaly checks (see check_data.py)
+    def window(self, n=None) -> tuple:
+        with self.lock:
+            times, values = self.recent.last(n)
+            return times.copy(), values.copy()
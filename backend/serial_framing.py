@@ -0,0 +1,149 @@
+import logging
+import os
+import time
+from datetime import datetime
+from metrics import counter
+
+logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------------------------------------
+#   Framing of the line based serial protocols (meter #DATA: frames, arduino CO2 lines)
+#
+#   Frame_Reader keeps the bytes of a port in one bytearray that lives as
+#   long as the reader. Reads take everything the port has (in_waiting),
+#   complete lines are split off and parsed, the partial line at the end
+#   stays in the buffer for the next read. Lines are handed to the parser
+#   as bytes (float() and int() take bytes, no decoding), a line the
+#   parser rejects (ValueError) is counted in sensor_frame_parse_errors
+#   and skipped, it never raises into the caller.
+#
+#   A parsed line is a Frame: the time its last byte was read and the
+#   values by name. Frames read like the old dictionaries (frame["CO2"],
+#   "DO" in frame), so the sensor threads and engines use them as before.
+#----------------------------------------------------------------------------------------
+
+# lines from a device that could not be parsed as a frame
+FRAME_ERRORS = counter("sensor_frame_parse_errors", "Lines from a meter that could not be parsed as a frame", ["port"])
+
+# a line longer than this without a newline is line noise, it is dropped
+MAX_LINE_BYTES = 4096
+
+# seconds read_frame waits for a complete frame before giving up
+FRAME_TIMEOUT = 2.0
+
+# most bytes taken by one read_fd
+READ_BYTES = 65536
+
+# One parsed line
+#   time: datetime the line was read
+#   values: name -> value
+class Frame:
+    __slots__ = ("time", "values")
+
+    def __init__(self, time, values) -> None:
+        self.time = time
+        self.values = values
+
+    def __getitem__(self, name):
+        return self.values[name]
+
+    def __contains__(self, name) -> bool:
+        return name in self.values
+
+    def get(self, name, default=None):
+        return self.values.get(name, default)
+
+    def items(self):
+        return self.values.items()
+
+    def __repr__(self) -> str:
+        return f"Frame({self.time!r}, {self.values!r})"
+
+class Frame_Reader:
+
+    # parse(line) returns the values of a line without its newline,
+    # raises ValueError for a malformed one
+    # label names the port in sensor_frame_parse_errors
+    def __init__(self, parse, label) -> None:
+        self.parse = parse
+        self.label = label
+        self.buffer = bytearray()
+        # the buffer before this offset has no newline
+        self.scanned = 0
+        self.errors = FRAME_ERRORS.labels(port=label)
+        self.frames = 0
+        self.corrupt = 0
+        self.skipped = 0
+
+    # split the complete lines off data plus the buffered partial line
+    # returns the frames parsed from them, oldest first
+    def feed(self, data) -> list:
+        buffer = self.buffer
+        buffer.extend(data)
+        end = buffer.find(b"\n", self.scanned)
+        if end == -1:
+            self.scanned = len(buffer)
+            if self.scanned > MAX_LINE_BYTES:
+                self._reject(bytes(buffer[:80]))
+                buffer.clear()
+                self.scanned = 0
+            return []
+
+        received = datetime.now()
+        frames = []
+        start = 0
+        while end != -1:
+            line = buffer[start:end]
+            start = end + 1
+            end = buffer.find(b"\n", start)
+            if not line.strip():
+                continue
+            try:
+                values = self.parse(line)
+            except (ValueError, IndexError):
+                self._reject(line)
+                continue
+            frames.append(Frame(received, values))
+        del buffer[:start]
+        self.scanned = len(buffer)
+        self.frames += len(frames)
+        return frames
+
+    def _reject(self, line) -> None:
+        self.corrupt += 1
+        self.errors.inc()
+        logger.debug(f"{self.label}: corrupt frame {bytes(line)!r}")
+
+    # one bulk read of what the port has, at least one byte (waits up
+    # to the port timeout for it); returns the frames completed by it
+    def read(self, port) -> list:
+        return self.feed(port.read(port.in_waiting or 1))
+
+    # read_fd is for a descriptor the caller knows is readable (selector,
+    # event loop): pyserial's read selects it again, and select() cannot
+    # take descriptors past 1023. Raises OSError once the port is gone
+    # (readable without data, a closed pty or unplugged adapter)
+    def read_fd(self, fd) -> list:
+        try:
+            data = os.read(fd, READ_BYTES)
+        except BlockingIOError:
+            return []
+        if not data:
+            raise OSError(f"{self.label}: port closed")
+        return self.feed(data)
+
+    # the newest frame, waiting up to timeout seconds for one
+    # older frames of the same read are counted in skipped
+    # returns None on timeout
+    def read_frame(self, port, timeout=FRAME_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            frames = self.read(port)
+            if frames:
+                self.skipped += len(frames) - 1
+                return frames[-1]
+            if time.monotonic() >= deadline:
+                return None
+
+    def stats(self) -> dict:
+        return {"frames": self.frames, "corrupt": self.corrupt, "skipped": self.skipped, "buffered": len(self.buffer)}
@@ -0,0 +1,253 @@
+import heapq
+import logging
+import os
+import selectors
+import threading
+import time
+from collections import deque
+from datetime import datetime
+import serial
+from metrics import histogram
+from serial_framing import Frame
+
+logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------------------------------------
+#   selectors acquisition engine
+#
+#   Alternative to the threaded and async engines in main.py and
+#   async_engine.py. One thread serves every device, whatever their number:
+#       - the file descriptor of every serial port is registered with a
+#         selector (epoll on Linux), whatever bytes are ready on any port
+#         are read without blocking and handed to the sensor's
+#         Frame_Reader (serial_framing.py)
+#       - each device is sampled on its own schedule, at fixed multiples
+#         of Read Frequency from its start (a heap of due times). A due
+#         device records the first frame that arrives after it became
+#         due, as soon as it is read (like read_frame in the threaded
+#         engine, without a thread waiting for it); frames in between
+#         samples are dropped
+#       - sensors without a port (Random_Test_Sensor) are read when due,
+#         ports without a file descriptor are polled every POLL_INTERVAL
+#       - readings go straight to record (record_reading, which only
+#         queues them for storage and broadcast)
+#   add_devices/remove_devices/stop are handed to the thread through a
+#   command queue and a wake-up pipe, and return once it applied them.
+#   Pty pairs (see sensor_simulator.py) stand in for the serial adapters.
+#----------------------------------------------------------------------------------------
+
+# seconds between reads of ports the selector cannot watch
+POLL_INTERVAL = 0.05
+
+# /metrics, shared with the other engines: here the time from a device
+# being due to its frame being recorded
+READ_SECONDS = histogram("sensor_read_seconds", "Time to read one value or frame from a sensor", ["sensor"])
+
+# one physical device and its measures
+class _Device:
+    __slots__ = ("wrappers", "sensor", "port", "fd", "waiting_since", "removed", "timings")
+
+    def __init__(self, wrappers) -> None:
+        self.wrappers = wrappers
+        self.sensor = wrappers[0]["sensor"]
+        self.port = None
+        self.fd = None
+        # due time of a sample still waiting for its frame
+        self.waiting_since = None
+        self.removed = False
+        self.timings = READ_SECONDS.labels(sensor=wrappers[0]["name"])
+
+class Serial_Mux:
+
+    # state is the system state (for Read Frequency), record is called
+    # as record(sensor_wrapper, value, read_time) for every measure
+    def __init__(self, state, record) -> None:
+        self.state = state
+        self.record = record
+        self.thread = None
+        self.selector = None
+        self.wake_read = None
+        self.wake_write = None
+        self.devices = {}       # id of the sensor object -> _Device
+        self.polled = []        # devices with a port but no file descriptor
+        self.schedule = []      # heap of (due, sequence, device)
+        self.sequence = 0
+        self.commands = deque()
+        self.stopping = False
+
+    # start serving devices on a new thread
+    # devices is a list of wrapper lists, each list sharing one sensor object
+    def start(self, devices) -> None:
+        self.selector = selectors.DefaultSelector()
+        self.wake_read, self.wake_write = os.pipe()
+        os.set_blocking(self.wake_read, False)
+        self.selector.register(self.wake_read, selectors.EVENT_READ, None)
+        self.stopping = False
+        self._add_devices(devices)
+        self.thread = threading.Thread(target=self._run, name="serial mux", daemon=True)
+        self.thread.start()
+
+    # stop sampling and close every port
+    def stop(self) -> None:
+        if self.thread is None:
+            return
+        self.stopping = True
+        self._wake()
+        self.thread.join()
+        self.thread = None
+
+    # start more devices while the others keep running
+    def add_devices(self, devices) -> None:
+        self._call(self._add_devices, devices)
+
+    # stop some devices, returns once their ports are closed
+    def remove_devices(self, devices) -> None:
+        self._call(self._remove_devices, devices)
+
+    # runs function(argument) on the mux thread and waits for it
+    def _call(self, function, argument) -> None:
+        done = threading.Event()
+        self.commands.append((function, argument, done))
+        self._wake()
+        done.wait()
+
+    def _wake(self) -> None:
+        try:
+            os.write(self.wake_write, b"\0")
+        except BlockingIOError:
+            pass
+
+    def _run(self) -> None:
+        try:
+            while not self.stopping:
+                timeout = POLL_INTERVAL if self.polled else None
+                if self.schedule:
+                    until_due = max(0.0, self.schedule[0][0] - time.monotonic())
+                    timeout = until_due if timeout is None else min(timeout, until_due)
+                for key, _ in self.selector.select(timeout):
+                    if key.data is None:
+                        self._run_commands()
+                    # removed by a command earlier in this batch
+                    elif not key.data.removed:
+                        self._read(key.data)
+                for device in list(self.polled):
+                    self._read(device)
+                self._sample_due(time.monotonic())
+        finally:
+            self._run_commands()
+            self._remove_devices([device.wrappers for device in self.devices.values()])
+            self.selector.close()
+            os.close(self.wake_read)
+            os.close(self.wake_write)
+
+    def _run_commands(self) -> None:
+        try:
+            while os.read(self.wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.commands:
+            function, argument, done = self.commands.popleft()
+            try:
+                function(argument)
+            except Exception as err:
+                logger.error(f"Error changing devices: {err}")
+            finally:
+                done.set()
+
+    def _add_devices(self, devices) -> None:
+        now = time.monotonic()
+        for wrappers in devices:
+            device = _Device(wrappers)
+            port = getattr(device.sensor, "ser", None)
+            if port is not None and hasattr(device.sensor, "reader"):
+                device.port = port
+                try:
+                    port.timeout = 0
+                    device.fd = port.fileno()
+                    self.selector.register(device.fd, selectors.EVENT_READ, device)
+                except (AttributeError, ValueError, OSError, serial.SerialException) as e:
+                    logger.warning(f"{wrappers[0]['name']}: port cannot be watched ({e}), polling it")
+                    device.fd = None
+                    self.polled.append(device)
+            self.devices[id(device.sensor)] = device
+            self._schedule(device, now)
+
+    def _remove_devices(self, devices) -> None:
+        for wrappers in devices:
+            device = self.devices.pop(id(wrappers[0]["sensor"]), None)
+            if device is None:
+                continue
+            device.removed = True
+            if device.fd is not None:
+                try:
+                    self.selector.unregister(device.fd)
+                except (KeyError, ValueError):
+                    pass
+                device.fd = None
+            if device in self.polled:
+                self.polled.remove(device)
+            try:
+                device.sensor.disconnect_port()
+            except Exception as err:
+                logger.error(f"Error closing {wrappers[0]['name']}: {err}")
+
+    def _schedule(self, device, due) -> None:
+        self.sequence += 1
+        heapq.heappush(self.schedule, (due, self.sequence, device))
+
+    # bytes ready on a port, a waiting sample takes the newest frame
+    # a port that fails (unplugged, never opened) is no longer read
+    def _read(self, device) -> None:
+        try:
+            if device.fd is not None:
+                frames = device.sensor.reader.read_fd(device.fd)
+            else:
+                frames = device.sensor.reader.read(device.port)
+        except Exception as e:
+            logger.error(f"Error reading data from {device.wrappers[0]['name']}: {e}")
+            if device.fd is not None:
+                try:
+                    self.selector.unregister(device.fd)
+                except (KeyError, ValueError):
+                    pass
+                device.fd = None
+            if device in self.polled:
+                self.polled.remove(device)
+            return
+        if frames and device.waiting_since is not None:
+            self._record(device, frames[-1], device.waiting_since)
+
+    # sample every device that is due, the next sample is one
+    # period after this one (or now if that already passed)
+    def _sample_due(self, now) -> None:
+        period = None
+        while self.schedule and self.schedule[0][0] <= now:
+            due, _, device = heapq.heappop(self.schedule)
+            if device.removed:
+                continue
+            if device.port is None:
+                try:
+                    frame = device.sensor.read_frame()
+                except Exception as err:
+                    logger.error(f"Error in sensor reading for {device.wrappers[0]['name']}: {err}")
+                    frame = None
+                if frame is not None:
+                    self._record(device, frame, due)
+            else:
+                device.waiting_since = due
+            if period is None:
+                period = self.state.get("Read Frequency")
+            self._schedule(device, max(due + period, now))
+
+    def _record(self, device, frame, due) -> None:
+        device.waiting_since = None
+        device.timings.observe(max(0.0, time.monotonic() - due))
+        # a port frame carries the time it arrived
+        read_time = frame.time if isinstance(frame, Frame) else datetime.now()
+        try:
+            for sensor_wrapper in device.wrappers:
+                if sensor_wrapper["measure"] in frame:
+                    self.record(sensor_wrapper, frame[sensor_wrapper["measure"]], read_time)
+        except Exception as err:
+            logger.error(f"Error storing reading for {device.wrappers[0]['name']}: {err}")
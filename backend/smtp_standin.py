@@ -0,0 +1,121 @@
+import socket
+import socketserver
+import threading
+import time
+
+#----------------------------------------------------------------------------------------
+#   In-process SMTP stand-in
+#
+#   A minimal SMTP server (HELO/EHLO, MAIL, RCPT, DATA, NOOP, RSET, QUIT,
+#   no TLS or AUTH) that keeps every message it receives in memory.
+#   Used by the "local" mail mode and the mail benchmark so delivery can
+#   be run and measured without a real mail server or network access.
+#   handshake_delay is slept before the greeting of every connection, to
+#   stand in for the TCP/STARTTLS/login cost of a real server.
+#----------------------------------------------------------------------------------------
+
+class Local_SMTP_Server:
+
+    # constructor, port 0 picks a free port (see self.port after start)
+    def __init__(self, host="127.0.0.1", port=0, handshake_delay=0.0) -> None:
+        self.host = host
+        self.port = port
+        self.handshake_delay = handshake_delay
+        self.messages = []      # (sender, recipients, text)
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.sessions = set()     # open client sockets
+        self.server = None
+        self.thread = None
+
+    def start(self) -> None:
+        standin = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                with standin.lock:
+                    standin.sessions.add(self.request)
+                try:
+                    standin._session(self.rfile, self.wfile)
+                except OSError:
+                    pass    # connection dropped
+                finally:
+                    with standin.lock:
+                        standin.sessions.discard(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+        self.disconnect_all()
+
+    # drops every open client connection, as a server restart would
+    def disconnect_all(self) -> None:
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            try:
+                session.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    # one SMTP session
+    def _session(self, rfile, wfile) -> None:
+        with self.lock:
+            self.connections += 1
+        time.sleep(self.handshake_delay)
+
+        def reply(line):
+            wfile.write(line.encode("ascii") + b"\r\n")
+            wfile.flush()
+
+        reply("220 localhost SMTP stand-in")
+        sender = None
+        recipients = []
+        while True:
+            line = rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii", "replace").strip()
+            verb = command[:4].upper()
+            if verb in ("HELO", "EHLO"):
+                reply("250 localhost")
+            elif verb == "MAIL":
+                sender = command.split(":", 1)[1].strip()
+                recipients = []
+                reply("250 OK")
+            elif verb == "RCPT":
+                recipients.append(command.split(":", 1)[1].strip())
+                reply("250 OK")
+            elif verb == "DATA":
+                reply("354 End data with <CR><LF>.<CR><LF>")
+                lines = []
+                while True:
+                    data = rfile.readline()
+                    if not data or data in (b".\r\n", b".\n"):
+                        break
+                    # undo dot stuffing
+                    if data.startswith(b".."):
+                        data = data[1:]
+                    lines.append(data.decode("utf-8", "replace"))
+                with self.lock:
+                    self.messages.append((sender, recipients, "".join(lines)))
+                reply("250 OK")
+            elif verb in ("NOOP", "RSET"):
+                if verb == "RSET":
+                    sender, recipients = None, []
+                reply("250 OK")
+            elif verb == "QUIT":
+                reply("221 Bye")
+                return
+            else:
+                reply("502 Command not implemented")
@@ -0,0 +1,316 @@
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from pymongo.errors import BulkWriteError, PyMongoError
+from metrics import gauge, histogram
+from rollups import ROLLUPS
+
+logger = logging.getLogger(__name__)
+
+#----------------------------------------------------------------------------------------
+#   Storage pipeline stage for sensor readings
+#
+#   Sensor threads hand their DB documents to put() and move on, a
+#   single background thread collects them in a bounded queue and writes
+#   them with one insert_many(ordered=False) per collection.
+#   A batch is flushed when it reaches batch_size documents or when its
+#   oldest document has waited flush_interval seconds, whichever is first.
+#   When the queue is full put() blocks, so a stalled DB slows the sensors
+#   down instead of growing memory without bound.
+#
+#   flush() and stop() push a marker through the queue, so everything put
+#   before the call is written before they return (used on reset/terminate).
+#
+#   With a write-ahead log (wal, see reading_wal.py) put() appends the
+#   document to the log instead of the queue, which takes microseconds
+#   whatever MongoDB is doing. A second thread replays the log: up to
+#   batch_size of the oldest rows per insert_many, grouped by collection
+#   (looked up by name in database), removed once inserted. Duplicate key
+#   errors are rows inserted before a restart and count as replayed.
+#   While MongoDB cannot be reached the rows stay and the replay is
+#   retried after RETRY_MIN seconds, doubling up to RETRY_MAX. stop()
+#   replays for up to drain_timeout seconds, the rest waits on disk for
+#   the next start. The rollup documents (rollups.py) take the same path.
+#----------------------------------------------------------------------------------------
+
+# marker kinds passed through the queue next to (collection, document) items
+_FLUSH = "flush"
+_STOP = "stop"
+
+# how far back rows_per_second looks
+RATE_WINDOW = 10.0
+
+# seconds between replay attempts while MongoDB is unreachable
+RETRY_MIN = 0.5
+RETRY_MAX = 30.0
+
+# MongoDB error code of a duplicate _id
+DUPLICATE_KEY = 11000
+
+# their "time" is a bucket start, not a read time
+ROLLUP_COLLECTIONS = {collection_name for _, collection_name in ROLLUPS.values()}
+
+# /metrics, MONGO_WRITE_SECONDS is shared with main.py
+QUEUE_DEPTH = gauge("storage_writer_queue_depth", "Items waiting in the storage writer queue")
+MONGO_WRITE_SECONDS = histogram("mongo_write_seconds", "Time of one write to MongoDB", ["operation"])
+READ_TO_STORED = histogram("reading_read_to_stored_seconds", "Time from a sensor read to its document being inserted",
+                           buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0))
+WAL_BACKLOG = gauge("reading_wal_backlog", "Readings in the write-ahead log waiting to be replayed")
+WAL_APPEND_SECONDS = histogram("reading_wal_append_seconds", "Time to append one reading to the write-ahead log",
+                               buckets=(0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.025))
+
+class Storage_Writer:
+
+    # constructor
+    # wal and database: log readings to a Reading_WAL and replay it into database
+    def __init__(self, batch_size=500, flush_interval=1.0, max_queue=50000, wal=None, database=None, drain_timeout=10.0) -> None:
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = float(flush_interval)
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = None
+        self.wal = wal
+        self.database = database
+        self.drain_timeout = float(drain_timeout)
+        self.replay_thread = None
+        self.stopping = threading.Event()
+        self.append_timings = WAL_APPEND_SECONDS.labels()
+
+        # statistics, only written by the writer thread
+        self.rows_written = 0
+        self.rows_failed = 0
+        self.flushes = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.recent_flushes = deque()   # (finish time, rows) pairs inside RATE_WINDOW
+
+        # write-ahead log replay statistics, only written by the replay thread
+        self.replayed = 0
+        self.duplicates = 0
+        self.replay_rejected = 0
+        self.replay_failures = 0
+        self.replay_error = None
+        self.retry_at = None
+        self.recent_replays = deque()   # (finish time, rows) pairs inside RATE_WINDOW
+
+    # start the background writer thread (and the replay thread)
+    def start(self) -> None:
+        QUEUE_DEPTH.set_function(self.queue.qsize)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        if self.wal is not None:
+            WAL_BACKLOG.set_function(self.wal.backlog)
+            self.stopping.clear()
+            self.replay_thread = threading.Thread(target=self._replay, daemon=True)
+            self.replay_thread.start()
+
+    # queue a document for insertion into collection
+    def put(self, collection, document) -> None:
+        if self.wal is not None:
+            start = time.perf_counter()
+            self.wal.append(collection.name, document)
+            self.append_timings.observe(time.perf_counter() - start)
+            return
+        self.queue.put((collection, document))
+
+    # write everything queued so far, returns once it is in the DB
+    def flush(self, timeout=None) -> bool:
+        done = threading.Event()
+        self.queue.put((_FLUSH, done))
+        return done.wait(timeout)
+
+    # flush and end the writer thread, replay what the log holds
+    # for up to drain_timeout seconds
+    def stop(self, timeout=None) -> None:
+        if self.thread is None:
+            return
+        done = threading.Event()
+        self.queue.put((_STOP, done))
+        done.wait(timeout)
+        self.thread.join(timeout)
+        self.thread = None
+        if self.replay_thread is not None:
+            self.stopping.set()
+            self.wal.appended_event.set()
+            self.replay_thread.join()
+            self.replay_thread = None
+            backlog = self.wal.backlog()
+            if backlog:
+                logger.warning(f"Storage writer: {backlog} readings left in {self.wal.path}, replayed on the next start")
+
+    # queue depth, flush latency and throughput for monitoring
+    def stats(self) -> dict:
+        now = time.time()
+        recent = [rows for finished, rows in list(self.recent_flushes) if now - finished <= RATE_WINDOW]
+        out = {
+            "queue_depth": self.queue.qsize(),
+            "queue_capacity": self.queue.maxsize,
+            "batch_size": self.batch_size,
+            "flush_interval": self.flush_interval,
+            "rows_written": self.rows_written,
+            "rows_failed": self.rows_failed,
+            "flushes": self.flushes,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "rows_per_second": sum(recent) / RATE_WINDOW
+        }
+        if self.wal is not None:
+            replays = [rows for finished, rows in list(self.recent_replays) if now - finished <= RATE_WINDOW]
+            out["wal"] = {
+                "path": self.wal.path,
+                "backlog": self.wal.backlog(),
+                "appended": self.wal.appended,
+                "replayed": self.replayed,
+                "duplicates": self.duplicates,
+                "rejected": self.replay_rejected,
+                "replay_failures": self.replay_failures,
+                "replay_rows_per_second": sum(replays) / RATE_WINDOW,
+                "last_error": self.replay_error,
+                "retrying_in": max(0.0, self.retry_at - time.monotonic()) if self.retry_at is not None else None
+            }
+        return out
+
+    # writer thread loop
+    def _run(self) -> None:
+        batch = []
+        deadline = None
+        while True:
+            # wait for the next item, but not past the oldest document's deadline
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                collection, item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                self._write(batch)
+                batch, deadline = [], None
+                continue
+
+            if collection is _FLUSH or collection is _STOP:
+                self._write(batch)
+                batch, deadline = [], None
+                item.set()
+                if collection is _STOP:
+                    return
+                continue
+
+            batch.append((collection, item))
+            if deadline is None:
+                deadline = time.monotonic() + self.flush_interval
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch, deadline = [], None
+
+    # replay thread loop, see the header
+    def _replay(self) -> None:
+        delay = RETRY_MIN
+        deadline = None
+        while True:
+            if self.stopping.is_set() and deadline is None:
+                deadline = time.monotonic() + self.drain_timeout
+            if deadline is not None and time.monotonic() >= deadline:
+                return
+            try:
+                rows = self.wal.oldest(self.batch_size)
+                if rows:
+                    self._replay_rows(rows)
+            except (PyMongoError, sqlite3.Error) as err:
+                # MongoDB down or restarting (or the log busy), the rows stay in the log
+                self.replay_failures += 1
+                self.replay_error = str(err)
+                logger.warning(f"Storage writer: replay failed, retrying in {delay:.1f} s: {err}")
+                self.retry_at = time.monotonic() + delay
+                self.stopping.wait(delay if deadline is None else min(delay, max(0.0, deadline - time.monotonic())))
+                delay = min(delay * 2, RETRY_MAX)
+                continue
+            self.retry_at = None
+            delay = RETRY_MIN
+            if len(rows) < self.batch_size:
+                if deadline is not None:
+                    return
+                # wait for new rows, batching what arrives in flush_interval
+                self.wal.appended_event.wait()
+                self.wal.appended_event.clear()
+                self.stopping.wait(self.flush_interval)
+
+    # inserts one batch of log rows, then removes them from the log
+    def _replay_rows(self, rows) -> None:
+        groups = {}
+        for _, collection, document in rows:
+            groups.setdefault(collection, []).append(document)
+        start = time.perf_counter()
+        for collection, documents in groups.items():
+            try:
+                self.database[collection].insert_many(documents, ordered=False)
+                self._observe_stored(collection, documents)
+            except BulkWriteError as err:
+                errors = err.details.get("writeErrors", [])
+                duplicates = sum(1 for error in errors if error.get("code") == DUPLICATE_KEY)
+                self.duplicates += duplicates
+                # anything else was rejected by MongoDB and would be rejected again
+                if len(errors) > duplicates:
+                    self.replay_rejected += len(errors) - duplicates
+                    logger.warning(f"Storage writer: {len(errors) - duplicates} replayed documents rejected by {collection}")
+        MONGO_WRITE_SECONDS.labels(operation="insert_many").observe(time.perf_counter() - start)
+        self.wal.remove_through(rows[-1][0])
+        self.replayed += len(rows)
+        self.replay_error = None
+        now = time.time()
+        self.recent_replays.append((now, len(rows)))
+        while self.recent_replays and now - self.recent_replays[0][0] > RATE_WINDOW:
+            self.recent_replays.popleft()
+
+    # write a batch, one insert_many per target collection
+    def _write(self, batch) -> None:
+        if not batch:
+            return
+
+        # group documents by collection, keeping arrival order
+        groups = {}
+        for collection, document in batch:
+            key = id(collection)
+            if key not in groups:
+                groups[key] = (collection, [])
+            groups[key][1].append(document)
+
+        start = time.perf_counter()
+        written = 0
+        for collection, documents in groups.values():
+            written += self._insert(collection, documents)
+        elapsed = time.perf_counter() - start
+
+        self.rows_written += written
+        self.flushes += 1
+        self.last_flush_seconds = elapsed
+        self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+        now = time.time()
+        self.recent_flushes.append((now, written))
+        while self.recent_flushes and now - self.recent_flushes[0][0] > RATE_WINDOW:
+            self.recent_flushes.popleft()
+
+    # insert_many, returns how many documents were written
+    def _insert(self, collection, documents) -> int:
+        try:
+            start = time.perf_counter()
+            collection.insert_many(documents, ordered=False)
+            MONGO_WRITE_SECONDS.labels(operation="insert_many").observe(time.perf_counter() - start)
+            self._observe_stored(collection.name, documents)
+            return len(documents)
+        except BulkWriteError as err:
+            failed = len(err.details.get("writeErrors", []))
+            self.rows_failed += failed
+            logger.warning(f"Storage writer: {failed} documents rejected by {collection.name}")
+            return len(documents) - failed
+        except Exception as err:
+            self.rows_failed += len(documents)
+            logger.error(f"Storage writer: failed to write {len(documents)} documents: {err}")
+            return 0
+
+    # read to stored latency of inserted readings, from their "time"
+    def _observe_stored(self, collection_name, documents) -> None:
+        if collection_name in ROLLUP_COLLECTIONS:
+            return
+        now = datetime.now()
+        READ_TO_STORED.labels().observe_many([(now - document["time"]).total_seconds()
+                                              for document in documents if isinstance(document.get("time"), datetime)])
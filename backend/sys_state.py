@@ -1,41 +1,361 @@
 import threading
+import collections
 import copy
+import logging
+import os
+import sys
+import time
+from bisect import bisect_left
+from time import perf_counter
+from metrics import histogram, LATENCY_BUCKETS
+
+logger = logging.getLogger("sys_state")
+
+# time spent waiting for and holding the lock, for /metrics
+LOCK_WAIT = histogram("sys_state_lock_wait_seconds", "Time spent waiting for the Sys_State lock").labels()
+LOCK_HOLD = histogram("sys_state_lock_hold_seconds", "Time the Sys_State lock was held").labels()
 
 # Semaphore protected dictionary
 # Takes a dictionary as the initialization value
 # Locks during any access to the dictionary
 # Supports manually locking and unlocking from other classes
+#
+# Signalling: setting one of the keys listed in signals (e.g. "terminate")
+# wakes every thread blocked in wait_for, which then re-checks its
+# condition. Threads wait on the condition instead of polling the flags.
+#
+# Every access goes through _acquire/_release, which time the wait for
+# the lock and how long it was held (sys_state_lock_*_seconds). Both are
+# recorded while the lock is held, so the lock itself serializes them.
+#
+# Profiling (opt-in, see start_profiling and Lock_Profile below) adds
+# wait/hold times per key and per caller, the holder of the lock when a
+# wait passes a threshold, and the bytes and time of the get() copies.
+# Off, it costs one attribute check per access.
 class Sys_State:
 	lock = None
 	parameters = None
 
-	def __init__(self, default_dict):
+	def __init__(self, default_dict, signals=()):
 		self.lock = threading.Lock()
+		self.changed = threading.Condition(self.lock)
+		self.signals = set(signals)
 		self.parameters = default_dict
+		self.acquired_at = 0.0
+		# profile in use when profiling, the one of the current holder,
+		# and the last one started (kept after stop_profiling for the dump)
+		self.profile = None
+		self.holding = None
+		self.last_profile = None
 
 	def get(self, target):
-		self.lock.acquire()
-		out = copy.copy(self.parameters[target])
-		self.lock.release()
+		self._acquire(target)
+		if self.holding is None:
+			out = copy.copy(self.parameters[target])
+		else:
+			value = self.parameters[target]
+			start = perf_counter()
+			out = copy.copy(value)
+			self.holding.copied(target, 0 if out is value else sys.getsizeof(out), perf_counter() - start)
+		self._release()
+		return out
+
+	# Returns the stored object itself instead of a copy
+	# For shared services (mail server, storage writer) that
+	# must not be duplicated and do their own locking
+	def get_ref(self, target):
+		self._acquire(target)
+		out = self.parameters[target]
+		self._release()
 		return out
 
 	def set(self, target, new_value):
-		self.lock.acquire()
+		self._acquire(target)
 		self.parameters[target] = new_value
-		self.lock.release()
+		if target in self.signals:
+			self.changed.notify_all()
+		self._release()
+
+	# Blocks until check(parameters) is True or timeout seconds passed
+	# Returns the last result of check
+	# check runs with the lock held: it reads the parameters dictionary
+	# it is given and must not call back into this object
+	# Each stretch the lock is held (the first check, the check after
+	# every wake up) is timed like any other access, under "wait_for"
+	def wait_for(self, check, timeout=None):
+		self._acquire("wait_for")
+		try:
+			end = None if timeout is None else time.monotonic() + timeout
+			result = check(self.parameters)
+			while not result:
+				remaining = None if end is None else end - time.monotonic()
+				if remaining is not None and remaining <= 0:
+					break
+				# the condition releases the lock while waiting
+				self._hold_ended()
+				self.changed.wait(remaining)
+				self._resumed("wait_for", sys._getframe(1))
+				result = check(self.parameters)
+			return result
+		finally:
+			self._release()
+
+	# Wakes the threads in wait_for after a change they check that is
+	# not a signal key (e.g. a sensor's stop event)
+	def notify(self):
+		self._acquire("notify")
+		self.changed.notify_all()
+		self._release()
 
 	def add_to_dict(self, target, key, value):
-		self.lock.acquire()
+		self._acquire(target)
 		self.parameters[target][key] = value
-		self.lock.release()
+		self._release()
+
+	def remove_from_dict(self, target, key):
+		self._acquire(target)
+		self.parameters[target].pop(key, None)
+		self._release()
 
 	def add_to_list(self, target, value):
-		self.lock.acquire()
+		self._acquire(target)
 		self.parameters[target].append(value)
-		self.lock.release()
+		self._release()
+
+	# Replaces the value only if check(current value) is True
+	# Returns whether the value was replaced, so callers can claim
+	# a shared resource (e.g. the email cooldown) without a race
+	def compare_and_set(self, target, check, new_value):
+		self._acquire(target)
+		try:
+			if not check(self.parameters[target]):
+				return False
+			self.parameters[target] = new_value
+			return True
+		finally:
+			self._release()
 
 	def hard_lock(self):
-		self.lock.acquire()
+		self._acquire()
 
 	def hard_release(self):
+		self._release()
+
+	# Starts a new profile, waits longer than threshold seconds flag
+	# the holder of the lock
+	def start_profiling(self, threshold=None):
+		profile = Lock_Profile(SLOW_WAIT_THRESHOLD if threshold is None else threshold)
+		with self.lock:
+			self.profile = self.last_profile = profile
+
+	def stop_profiling(self):
+		with self.lock:
+			self.profile = None
+
+	# Summary of the last profile (see Lock_Profile.summary), None if
+	# profiling was never started
+	def lock_profile(self):
+		with self.lock:
+			if self.last_profile is None:
+				return None
+			out = self.last_profile.summary()
+			out["enabled"] = self.profile is self.last_profile
+			return out
+
+	# target is the key accessed, None for hard_lock
+	def _acquire(self, target=None):
+		profile = self.profile
+		if profile is None:
+			start = perf_counter()
+			self.lock.acquire()
+			self.acquired_at = perf_counter()
+			LOCK_WAIT.observe_serialized(self.acquired_at - start)
+			self.holding = None
+			return
+		site = _caller_site(sys._getframe(2))
+		start = perf_counter()
+		holder = profile.wait(self.lock, target, site)
+		self.acquired_at = perf_counter()
+		LOCK_WAIT.observe_serialized(self.acquired_at - start)
+		profile.acquired(target, site, self.acquired_at, self.acquired_at - start, holder)
+		self.holding = profile
+
+	def _release(self):
+		self._hold_ended()
 		self.lock.release()
+
+	# records how long the lock was held, before it is released
+	def _hold_ended(self):
+		held = perf_counter() - self.acquired_at
+		LOCK_HOLD.observe_serialized(held)
+		if self.holding is not None:
+			self.holding.released(held)
+
+	# the lock is held again after a condition wait (see wait_for), frame
+	# is the caller's; no wait is recorded, the hold is timed from here
+	def _resumed(self, target, frame):
+		self.acquired_at = perf_counter()
+		profile = self.profile
+		if profile is None:
+			self.holding = None
+			return
+		profile.resumed(target, _caller_site(frame), self.acquired_at)
+		self.holding = profile
+
+# waits on the lock longer than this (seconds) flag the holder, default
+# of start_profiling
+SLOW_WAIT_THRESHOLD = 0.01
+# flagged waits kept in a profile, the oldest are dropped
+SLOW_WAITS_KEPT = 200
+
+# file:line function of a frame, the caller of a Sys_State method
+# (cached, the same few call sites come back on every access)
+_sites = {}
+
+def _caller_site(frame) -> str:
+	code = frame.f_code
+	site = _sites.get((code, frame.f_lineno))
+	if site is None:
+		site = _sites[(code, frame.f_lineno)] = f"{os.path.basename(code.co_filename)}:{frame.f_lineno} {code.co_name}"
+	return site
+
+# Latency histogram of one key or caller, in the buckets of /metrics
+class _Timings:
+	__slots__ = ("counts", "total", "max")
+
+	def __init__(self):
+		self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+		self.total = 0.0
+		self.max = 0.0
+
+	def add(self, seconds):
+		self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	# quantiles are the upper bound of their bucket (max past the last)
+	def quantile(self, q, count):
+		rank = q * count
+		seen = 0
+		for bound, bucket in zip(LATENCY_BUCKETS, self.counts):
+			seen += bucket
+			if seen >= rank:
+				return min(bound, self.max)
+		return self.max
+
+	def summary(self):
+		count = sum(self.counts)
+		return {
+			"count": count,
+			"total_ms": round(self.total * 1e3, 3),
+			"mean_us": round(self.total / count * 1e6, 3) if count else 0.0,
+			"p50_us": round(self.quantile(0.5, count) * 1e6, 3) if count else 0.0,
+			"p99_us": round(self.quantile(0.99, count) * 1e6, 3) if count else 0.0,
+			"max_us": round(self.max * 1e6, 3)
+		}
+
+# Lock profile of one Sys_State
+#
+# Every update happens with the Sys_State lock held (like the /metrics
+# timings), the holder is a tuple replaced on each acquire so waiters
+# can read it without the lock.
+#   by_key / by_caller: wait and hold _Timings per key and per caller
+#       site (file:line function), hard_lock holds are under key None
+#   copies: per key, get() copies, bytes copied (sys.getsizeof of the
+#       copy, a shallow copy duplicates only the container) and seconds
+#   slow_waits: waits that passed threshold with the holder at the time
+class Lock_Profile:
+
+	def __init__(self, threshold):
+		self.threshold = threshold
+		self.started = time.time()
+		self.by_key = {}
+		self.by_caller = {}
+		self.copies = {}
+		self.slow_waits = collections.deque(maxlen=SLOW_WAITS_KEPT)
+		self.slow_wait_count = 0
+		# (key, site, thread name, acquired at) of the current holder
+		self.holder = None
+		self.holder_timings = ()
+
+	# Acquires lock, if that takes longer than threshold logs the
+	# holder at that moment and returns it (None otherwise)
+	def wait(self, lock, target, site):
+		if lock.acquire(timeout=self.threshold):
+			return None
+		holder = self.holder
+		if holder is not None:
+			key, holder_site, thread, acquired_at = holder
+			held = perf_counter() - acquired_at
+			logger.warning(f"{site} waited {self.threshold * 1e3:.0f} ms for the lock on {target!r}, "
+						   f"held by {holder_site} ({thread}) on {key!r} for {held * 1e3:.1f} ms")
+			holder = {"key": key, "caller": holder_site, "thread": thread, "held_ms": round(held * 1e3, 3)}
+		else:
+			holder = {"key": None, "caller": "unknown (acquired before profiling)", "thread": None, "held_ms": None}
+		lock.acquire()
+		return holder
+
+	def acquired(self, target, site, acquired_at, waited, holder):
+		key_timings, caller_timings = self._timings(target, site)
+		key_timings[0].add(waited)
+		caller_timings[0].add(waited)
+		if holder is not None:
+			self.slow_wait_count += 1
+			self.slow_waits.append({"time": time.time(), "key": target, "caller": site,
+									"thread": threading.current_thread().name,
+									"wait_ms": round(waited * 1e3, 3), "holder": holder})
+		self.holder = (target, site, threading.current_thread().name, acquired_at)
+		self.holder_timings = (key_timings[1], caller_timings[1])
+
+	# the lock was taken back by a condition wait, a new holder without a wait
+	def resumed(self, target, site, acquired_at):
+		key_timings, caller_timings = self._timings(target, site)
+		self.holder = (target, site, threading.current_thread().name, acquired_at)
+		self.holder_timings = (key_timings[1], caller_timings[1])
+
+	# (wait, hold) timings of a key and (wait, hold, key) of a caller site
+	def _timings(self, target, site):
+		key_timings = self.by_key.get(target)
+		if key_timings is None:
+			key_timings = self.by_key[target] = (_Timings(), _Timings())
+		caller_timings = self.by_caller.get(site)
+		if caller_timings is None:
+			caller_timings = self.by_caller[site] = (_Timings(), _Timings(), target)
+		return key_timings, caller_timings
+
+	def released(self, held):
+		for timings in self.holder_timings:
+			timings.add(held)
+
+	def copied(self, target, size, seconds):
+		copies = self.copies.get(target)
+		if copies is None:
+			copies = self.copies[target] = [0, 0, 0.0]
+		copies[0] += 1
+		copies[1] += size
+		copies[2] += seconds
+
+	# keys and callers sorted by total hold time, the ones that
+	# serialize the system first
+	def summary(self):
+		keys = [{"key": key, "wait": wait.summary(), "hold": hold.summary()}
+				for key, (wait, hold) in self.by_key.items()]
+		callers = [{"caller": site, "key": key, "wait": wait.summary(), "hold": hold.summary()}
+				   for site, (wait, hold, key) in self.by_caller.items()]
+		keys.sort(key=lambda entry: entry["hold"]["total_ms"], reverse=True)
+		callers.sort(key=lambda entry: entry["hold"]["total_ms"], reverse=True)
+		copies = [{"key": key, "count": count, "bytes": size, "total_ms": round(seconds * 1e3, 3),
+				   "mean_us": round(seconds / count * 1e6, 3)}
+				  for key, (count, size, seconds) in self.copies.items()]
+		copies.sort(key=lambda entry: entry["bytes"], reverse=True)
+		return {
+			"started": self.started,
+			"seconds": round(time.time() - self.started, 3),
+			"threshold_ms": self.threshold * 1e3,
+			"keys": keys,
+			"callers": callers,
+			"copies": copies,
+			"slow_wait_count": self.slow_wait_count,
+			"slow_waits": list(self.slow_waits)
+		}
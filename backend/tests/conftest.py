@@ -0,0 +1,51 @@
+import os
+import sys
+import pytest
+
+BACKEND = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.join(BACKEND, "benchmarks"))
+
+import sample_data
+
+#----------------------------------------------------------------------------------------
+#   Shared fixtures: the recorded runs of WAASMA_flaskdb.zip
+#
+#   recorded    collection name -> documents of the dump
+#   database    a mongomock database restored from the dump
+#   runs        names of the Water*_collection_run* collections
+#
+#   Usage (from backend/): python -m pytest -q tests
+#----------------------------------------------------------------------------------------
+
+
+@pytest.fixture(scope="session")
+def recorded():
+    return sample_data.load_collections()
+
+
+@pytest.fixture(scope="session")
+def database(recorded):
+    database = sample_data.connect()
+    sample_data.restore(database, recorded)
+    return database
+
+
+@pytest.fixture(scope="session")
+def runs(recorded):
+    return sample_data.run_collections(recorded)
+
+
+# time sorted (time, value) series of every sensor of every recorded run
+@pytest.fixture(scope="session")
+def series(recorded, runs):
+    result = []
+    for run in runs:
+        by_sensor = {}
+        for document in recorded[run]:
+            if document.get("value") is not None:
+                by_sensor.setdefault(document["sensor_id"], []).append(document)
+        for sensor_id, documents in by_sensor.items():
+            documents.sort(key=lambda document: document["time"])
+            result.append((run, sensor_id, documents))
+    return result
@@ -0,0 +1,199 @@
+import threading
+import time
+import numpy as np
+import pytest
+
+from bench_check_data import Scalar_Check, recorded_runs
+from check_data import Check_Data
+from ring_buffer import Ring_Buffer
+from sensor_state import Sensor_State
+
+#----------------------------------------------------------------------------------------
+#   Check_Data on the recorded runs of WAASMA_flaskdb.zip
+#
+#   replay      every run reading by reading against Scalar_Check, the
+#               plain Python rules of bench_check_data.py, and in batches
+#               of readings per check (as check_proc sees them)
+#   rules       raise and clear of each rule, on recorded readings with
+#               an excursion spliced in; hysteresis; forget
+#   check_proc  alerts raised during the email cooldown are mailed once
+#               it is over
+#----------------------------------------------------------------------------------------
+
+RECENT_READINGS = 100
+
+
+@pytest.fixture(scope="module")
+def runs():
+    return {name: (times, values, low, high) for name, times, values, low, high in recorded_runs()}
+
+
+# feeds a run through a checker, checking every `every` readings
+# returns the (index of the reading, rule, state) events
+def replay(checker, times, values, low, high, every=1, rules=None):
+    buffer = Ring_Buffer(RECENT_READINGS)
+    index = {}
+    events = []
+    for i, (t, value) in enumerate(zip(times, values)):
+        buffer.append(t, value)
+        index[float(t)] = i
+        if (i + 1) % every and i + 1 < len(values):
+            continue
+        window_times, window_values = buffer.last()
+        for event in checker.check([("sensor", window_times, window_values, low, high)]):
+            if rules is None or event["rule"] in rules:
+                events.append((index[event["time"]], event["rule"], event["state"]))
+    return events
+
+
+# a recorded run with its readings from `at` on replaced by spliced
+def splice(run, at, spliced):
+    times, values, low, high = run
+    values = values.copy()
+    values[at:at + len(spliced)] = spliced
+    return times, values, low, high
+
+
+def test_replay_matches_scalar_rules(runs):
+    for name, (times, values, low, high) in runs.items():
+        checker = Check_Data()
+        scalar = Scalar_Check(checker.rules)
+        buffer = Ring_Buffer(RECENT_READINGS)
+        for t, value in zip(times, values):
+            buffer.append(t, value)
+            window_times, window_values = buffer.last()
+            events = checker.check([(name, window_times, window_values, low, high)])
+            expected = scalar.check(window_times.tolist()[-checker.window:], window_values.tolist()[-checker.window:], low, high)
+            assert [(event["rule"], event["state"]) for event in events] == expected, f"{name} at {t}"
+
+
+@pytest.mark.parametrize("every", [2, 5, 30])
+def test_every_reading_between_checks_is_evaluated(runs, every):
+    for name, run in runs.items():
+        assert replay(Check_Data(), *run, every=every) == replay(Check_Data(), *run), name
+
+
+def test_excursion_between_checks_raises(runs):
+    recorded = runs["Water1_CO2_test_collection_run13"]
+    run = splice(recorded, 200, [recorded[3] + 5.0])
+    # checked at readings 196 and 203 only
+    events = replay(Check_Data({"rules": ("range",)}), *run, every=7)
+    assert events == [(200, "range", "raised"), (201, "range", "cleared")]
+
+
+def test_range_raise_and_clear(runs):
+    times, values, low, high = runs["Water1_CO2_collection_run11"]
+    band = Check_Data().rules["hysteresis"] * (high - low)
+    expected = []
+    active = False
+    for i, value in enumerate(values):
+        if not active and (value > high or value < low):
+            expected.append((i, "range", "raised"))
+            active = True
+        elif active and low + band <= value <= high - band:
+            expected.append((i, "range", "cleared"))
+            active = False
+    assert expected
+    assert replay(Check_Data(), times, values, low, high, rules=("range",)) == expected
+
+
+def test_range_hysteresis(runs):
+    run = runs["Water11_CO2_collection_run1"]
+    high = run[3]
+    # hovering around high, never back inside the hysteresis band
+    hovering = np.where(np.arange(300) % 2, high + 0.01, high - 0.01)
+    events = replay(Check_Data({"rules": ("range",)}), *splice(run, 100, hovering))
+    assert events == [(101, "range", "raised"), (400, "range", "cleared")]
+
+
+def test_zscore_raise_and_clear(runs):
+    run = runs["Water1_DO_collection_run13"]
+    _, values, low, high = run
+    spike = values[300] + 20 * (high - low)
+    events = replay(Check_Data({"rules": ("zscore",)}), *splice(run, 300, [spike]))
+    assert (300, "zscore", "raised") in events
+    assert (301, "zscore", "cleared") in events
+    assert (300, "zscore", "raised") not in replay(Check_Data({"rules": ("zscore",)}), *run)
+
+
+def test_rate_raise_and_clear(runs):
+    run = runs["Water11_CO2_collection_run1"]
+    _, values, low, high = run
+    step = values[400] + Check_Data().rules["rate_limit"] * (high - low)
+    # a step up, then steady at the new level
+    events = replay(Check_Data({"rules": ("rate",)}), *splice(run, 400, np.full(len(values) - 400, step)))
+    assert events == [(400, "rate", "raised"), (401, "rate", "cleared")]
+
+
+def test_flatline_raise_and_clear(runs):
+    run = runs["Water11_DO_collection_run1"]
+    values = run[1]
+    flat_points = Check_Data().rules["flat_points"]
+    assert replay(Check_Data({"rules": ("flatline",)}), *run) == [(flat_points - 1, "flatline", "raised")]
+    events = replay(Check_Data({"rules": ("flatline",)}), *splice(run, 500, [values[500] + 0.5]))
+    assert events[:2] == [(flat_points - 1, "flatline", "raised"), (500, "flatline", "cleared")]
+    assert events[2] == (501 + flat_points - 1, "flatline", "raised")
+
+
+def test_forget(runs):
+    times, values, low, high = runs["Water1_CO2_collection_run12"]
+    checker = Check_Data({"rules": ("range",)})
+    window = ("sensor", times[:10], values[:10], low, high)
+    assert [event["state"] for event in checker.check([window])] == ["raised"]
+    assert checker.active_rules("sensor") == ["range"]
+    # nothing new, nothing raised again
+    assert checker.check([window]) == []
+    checker.forget(["sensor"])
+    assert checker.active_rules("sensor") == []
+    assert [event["state"] for event in checker.check([window])] == ["raised"]
+
+
+class Recording_Mail:
+    def __init__(self):
+        self.sent = []
+
+    def send_email(self, address, text):
+        self.sent.append(text)
+
+
+class Recipients:
+    def addresses(self):
+        return ["alerts@example.com"]
+
+
+def test_alerts_during_cooldown_are_sent_after(runs):
+    import main
+    times, values, low, high = runs["Water1_CO2_test_collection_run13"]
+    state = main.system_state
+    saved = {key: state.parameters[key] for key in ["terminate", "Sensor List", "Read Frequency", "last emails", "mail server", "Recipients"]
+             if key in state.parameters}
+    mail = Recording_Mail()
+    sensors = {f"Sim{number}-CO2": {"name": f"Sim{number}", "measure": "CO2", "low": low, "high": high,
+                                    "readings": Sensor_State(RECENT_READINGS)} for number in range(2)}
+    state.parameters.update({"terminate": False, "Sensor List": sensors, "Read Frequency": 0.01,
+                             "last emails": time.time() - 601, "mail server": mail, "Recipients": Recipients()})
+    thread = threading.Thread(target=main.check_proc, args=[Check_Data({"rules": ("range",)})])
+    thread.start()
+
+    def wait_for(check):
+        deadline = time.monotonic() + 5
+        while not check() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return check()
+
+    try:
+        # Sim0 raises and is mailed right away
+        sensors["Sim0-CO2"]["readings"].push({"time": times[0], "value": high + 1})
+        assert wait_for(lambda: len(mail.sent) == 1)
+        # Sim1 raises during the cooldown and is not mailed yet
+        sensors["Sim1-CO2"]["readings"].push({"time": times[0], "value": high + 2})
+        time.sleep(0.2)
+        assert len(mail.sent) == 1
+        # once the cooldown is over
+        state.set("last emails", time.time() - 601)
+        assert wait_for(lambda: len(mail.sent) == 2)
+        assert "Sim1 CO2" in mail.sent[1]
+    finally:
+        state.set("terminate", True)
+        thread.join()
+        state.parameters.update(saved)
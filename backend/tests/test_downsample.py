@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from bson import ObjectId
+
+import sample_data
+from downsample import bucket_ms_for, bucket_pipeline, lttb
+
+#----------------------------------------------------------------------------------------
+#   Downsampling of /analysis_query/ against the recorded runs
+#
+#   bucket_pipeline     the aggregation on every recorded sensor against
+#                       a NumPy reference (bucket starts, count, min, max, mean)
+#   lttb                point count, endpoints and real readings kept
+#   max_points          the route never returns more points than asked for
+#----------------------------------------------------------------------------------------
+
+MAX_POINTS = [3, 10, 50, 200]
+
+
+# NumPy reference of bucket_pipeline: (start, count, min, max, mean) per bucket
+# starts in ms since the epoch, which reading times are naive datetimes from
+def reference_buckets(documents, bucket_ms):
+    times = np.array([document["time"] for document in documents], dtype="datetime64[ms]").astype(np.int64)
+    values = np.array([document["value"] for document in documents], dtype=np.float64)
+    starts = times - times % bucket_ms
+    keys, inverse, counts = np.unique(starts, return_inverse=True, return_counts=True)
+    sums = np.bincount(inverse, weights=values)
+    minimums = np.full(len(keys), np.inf)
+    maximums = np.full(len(keys), -np.inf)
+    np.minimum.at(minimums, inverse, values)
+    np.maximum.at(maximums, inverse, values)
+    return keys, counts, minimums, maximums, sums / counts
+
+
+@pytest.mark.parametrize("max_points", MAX_POINTS)
+def test_bucket_pipeline_matches_numpy(database, series, max_points):
+    for run, sensor_id, documents in series:
+        bucket_ms = bucket_ms_for(documents[0]["time"], documents[-1]["time"], max_points)
+        buckets = list(database[run].aggregate(bucket_pipeline({"sensor_id": sensor_id}, bucket_ms)))
+        keys, counts, minimums, maximums, means = reference_buckets(documents, bucket_ms)
+
+        starts = np.array([bucket["time"] for bucket in buckets], dtype="datetime64[ms]").astype(np.int64)
+        np.testing.assert_array_equal(starts, keys, err_msg=run)
+        np.testing.assert_array_equal([bucket["count"] for bucket in buckets], counts, err_msg=run)
+        np.testing.assert_array_equal([bucket["min"] for bucket in buckets], minimums, err_msg=run)
+        np.testing.assert_array_equal([bucket["max"] for bucket in buckets], maximums, err_msg=run)
+        np.testing.assert_allclose([bucket["value"] for bucket in buckets], means, rtol=1e-12, err_msg=run)
+
+
+@pytest.mark.parametrize("threshold", MAX_POINTS)
+def test_lttb_count_and_endpoints(series, threshold):
+    for run, sensor_id, documents in series:
+        readings = [{"time": document["time"], "value": document["value"]} for document in documents]
+        sampled = lttb(readings, threshold)
+        assert len(sampled) == min(len(readings), max(3, threshold)), run
+        assert sampled[0] is readings[0] and sampled[-1] is readings[-1], run
+        # real readings, in time order, none twice
+        positions = [readings.index(reading) for reading in sampled]
+        assert positions == sorted(set(positions)), run
+
+
+def test_lttb_keeps_short_series():
+    readings = [{"time": datetime(2025, 1, 1) + timedelta(seconds=i), "value": float(i)} for i in range(5)]
+    assert lttb(readings, 10) == readings
+    assert lttb([], 10) == []
+
+
+@pytest.fixture(scope="module")
+def client(database, runs):
+    from sys_state import Sys_State
+    from readings_store import Per_Run_Store
+    import app as app_module
+    sample_data.use_database(database)
+    database.settings_collection.update_one({}, {"$set": {"start_date": datetime(2024, 1, 1)}})
+    # every recorded run becomes one sensor of tank 99
+    sensor_list = {}
+    for run in runs:
+        sensor_id = ObjectId()
+        database.sensor_collection.insert_one({"_id": sensor_id, "name": run, "type": "water", "tank": 99})
+        measure = "CO2" if "_CO2_" in run else "DO"
+        sensor_list[f"{run}-{measure}"] = {"id": sensor_id, "name": run, "measure": measure, "db": database[run]}
+    state = Sys_State({"Sensor List": sensor_list, "reset sensors": False, "Readings Store": Per_Run_Store(database, 0),
+                       "Rollups": None, "Run Archive": None, "Query Cache": None})
+    yield app_module.Flask_App(state).app.test_client()
+    database.sensor_collection.delete_many({"tank": 99})
+
+
+@pytest.mark.parametrize("method", ["buckets", "lttb"])
+@pytest.mark.parametrize("max_points", MAX_POINTS)
+def test_max_points_limit(client, runs, method, max_points):
+    body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all",
+            "formattedStart": "0", "formattedEnd": "0", "max_points": max_points, "downsample": method}
+    response = client.post("/analysis_query/", json=body)
+    assert response.status_code == 200
+    sensor_data = response.get_json()["sensor_data"]
+    assert len(sensor_data) == len(runs)
+    for name, points in sensor_data.items():
+        assert 0 < len(points) <= max(3, max_points), name
+
+
+def test_max_points_rejects_bad_values(client):
+    body = {"selectedTank": "99", "selectedSensor": "water", "selectedMeasure": "all",
+            "formattedStart": "0", "formattedEnd": "0"}
+    assert client.post("/analysis_query/", json={**body, "max_points": "many"}).status_code == 400
+    assert client.post("/analysis_query/", json={**body, "downsample": "median"}).status_code == 400
@@ -0,0 +1,60 @@
+import sqlite3
+import bson
+import pytest
+
+from reading_wal import Reading_WAL
+
+#----------------------------------------------------------------------------------------
+#   Reading_WAL seqs
+#
+#   A mark taken with last_seq() must stay valid after the log drains
+#   and fills again, also for a log created with reusable seqs.
+#----------------------------------------------------------------------------------------
+
+
+@pytest.fixture
+def wal(tmp_path):
+    wal = Reading_WAL(str(tmp_path / "wal.sqlite3"))
+    yield wal
+    wal.close()
+
+
+# replays everything the log holds
+def drain(wal):
+    rows = wal.oldest(1000)
+    if rows:
+        wal.remove_through(rows[-1][0])
+
+
+def test_mark_survives_a_drain(wal):
+    for i in range(3):
+        wal.append("readings", {"value": i})
+    mark = wal.last_seq()
+    assert not wal.replayed_through(mark)
+
+    drain(wal)
+    assert wal.replayed_through(mark)
+    wal.append("readings", {"value": 3})
+    assert wal.replayed_through(mark)
+    assert wal.oldest(1)[0][0] > mark
+    assert wal.backlog() == 1
+
+
+def test_old_log_is_migrated(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE readings (seq INTEGER PRIMARY KEY, collection TEXT NOT NULL, document BLOB NOT NULL)")
+    connection.execute("INSERT INTO readings (collection, document) VALUES (?, ?)", ("readings", bson.encode({"value": 0})))
+    connection.commit()
+    connection.close()
+
+    wal = Reading_WAL(path)
+    assert [(row[0], row[2]["value"]) for row in wal.oldest(10)] == [(1, 0)]
+    wal.append("readings", {"value": 1})
+    wal.append("readings", {"value": 2})
+    mark = wal.last_seq()
+    drain(wal)
+    wal.append("readings", {"value": 3})
+    assert wal.replayed_through(mark)
+    assert [row[2]["value"] for row in wal.oldest(10)] == [3]
+    wal.close()
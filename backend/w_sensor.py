@@ -1,9 +1,38 @@
+import logging
 import serial
+from serial_framing import Frame, Frame_Reader
+
+logger = logging.getLogger(__name__)
 
 ###################
 #  RS232 to USB   --- maybe its actually sensor BNC->meter->RS232->USB or something
 ###################
 
+# layout of a #DATA: frame after the header, entries 0 and 1 are date and time
+FRAME_HEADER = b"#DATA:"
+FRAME_FIELDS = 15
+FIRST_VALUE_FIELD = 2
+MEASURE_FIELDS = {"CO2": 3, "DO": 8}
+OTHER_FIELDS = {f"field{index}": index for index in range(FIRST_VALUE_FIELD, FRAME_FIELDS) if index not in MEASURE_FIELDS.values()}
+
+# values of one #DATA: line (bytes, without the newline),
+# see serial_framing.py; raises ValueError if it is not a complete frame
+# CO2 is the 4th entry and DO the 9th, the other numeric columns are
+# kept by position (and left out when they do not parse)
+def parse_data_line(line):
+    if not line.startswith(FRAME_HEADER):
+        raise ValueError("no #DATA: header")
+    entries = line[len(FRAME_HEADER):].split(b",")
+    if len(entries) != FRAME_FIELDS:
+        raise ValueError(f"{len(entries)} fields")
+    values = {measure: float(entries[index]) for measure, index in MEASURE_FIELDS.items()}
+    for name, index in OTHER_FIELDS.items():
+        try:
+            values[name] = float(entries[index])
+        except ValueError:
+            pass
+    return values
+
 class Water_Sensor:
 
     # constructor
@@ -11,48 +40,41 @@ class Water_Sensor:
         self.com_port = com_port        #ex 'COM5'
         self.baud_rate = baud_rate        #ex 19200
         self.ser = ""
+        self.reader = Frame_Reader(parse_data_line, com_port)
         self.connect_port()
     
     # read data from sensor
     def read_data(self, measure) -> dict:
+        frame = self.read_frame()
+        if frame is None:
+            return None
+        return frame[measure]
+
+    # the newest #DATA: frame on the port (a Frame, see serial_framing.py)
+    # returns None if no complete frame came in time or the port failed
+    def read_frame(self) -> Frame:
         try:
-            waiting_for_read = True
-            while (waiting_for_read):
-                value = self.ser.readline()
-                valueInString=str(value, 'UTF-8')
-                print(valueInString)
-                data_wo_header = valueInString[5:]
-                data_entries = data_wo_header.split(",")
-                if len(data_entries) == 15:
-                    waiting_for_read = False
-
-            # Return 5th entry - the CO2 data
-            if measure == "CO2":
-                data = float(data_entries[3])
-            else:
-                data = float(data_entries[8])
-            print(data)    
-            return data
+            return self.reader.read_frame(self.ser)
 
         except serial.SerialException as e:
-            print(f"Error reading data: {e}")
+            logger.error(f"Error reading data: {e}")
 
     # connect to port
     def connect_port(self):
         try:
             # Open the serial port
             self.ser = serial.Serial(self.com_port, self.baud_rate, timeout=1)
-            print("connected to: " + self.ser.portstr)
+            logger.info("connected to: " + self.ser.portstr)
 
         except serial.SerialException as e:
-            print(f"Error opening port: {e}")
+            logger.error(f"Error opening port: {e}")
 
     # disconnect from port
     def disconnect_port(self) -> None:
         try:
             # Close the serial port
             self.ser.close()
-            print("port successfully closed")
+            logger.info("port successfully closed")
 
         except serial.SerialException as e:
-            print(f"Error: {e}")
\ No newline at end of file
+            logger.error(f"Error: {e}")
\ No newline at end of file
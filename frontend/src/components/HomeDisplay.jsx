@@ -17,34 +17,26 @@ const HomeDisplay = ({ }) => {
   useEffect(() => {
     if (!socket) return;
        
-    // Function to handle async fetch data packet and sensor data
+    // Function to handle async fetch data packet and live readings
     const fetchData = async () => {
       try {
         // Fetch the packet data and await its completion
-        const read_frequency = await fetchSettings();
         await fetchDataPacket();
-        while (read_frequency == 0) {
-          continue
-        }
-        const intervalId = setInterval(fetchSensorData, read_frequency);
-        return () => {
-          clearInterval(intervalId);
-          socket.off("response");
-        };
+        // The server pushes one "reading" event per new reading
+        socket.on("reading", addReading);
+        socket.emit("subscribe", { request: "home" });
       } catch (error) {
         console.error("Error in fetchData:", error);
       }
     };
     fetchData();
     fetchSensors();
+    return () => {
+      socket.emit("unsubscribe", { request: "home" });
+      socket.off("reading", addReading);
+    };
   }, [socket]);
 
-  const fetchSettings = async () => {
-    const response = await fetch("http://127.0.0.1:5000/settings");
-    const data = await response.json();
-    return data.settings[0].read_frequency * 1000
-  };
-
   const fetchSensors = async () => {
     const response = await fetch("http://127.0.0.1:5000/sensors");
     const data = await response.json();
@@ -69,7 +61,8 @@ const HomeDisplay = ({ }) => {
       setChartData({
         datasets: Object.keys(packetData).map((sensor, index) => ({
           label: sensor,
-          data: packetData[sensor].map((entry) => ({ x: new Date(entry.time * 1000).toISOString(), y: entry.value })), // Each sensor has its own timestamps
+          // packets carry {time: [...], value: [...]} columns, each sensor has its own timestamps
+          data: packetData[sensor].time.map((time, i) => ({ x: new Date(time * 1000).toISOString(), y: packetData[sensor].value[i] })),
           borderColor: `hsl(${index * 60}, 70%, 50%, 0.7)`,
           backgroundColor: `hsl(${index * 60}, 70%, 80%, 0.7)`,
           lineTension: 0.4,
@@ -107,43 +100,37 @@ const HomeDisplay = ({ }) => {
     });
   };
     
-  const fetchSensorData = async () => {
-    try {
-      const updateData = await new Promise((resolve, reject) => {
-        socket.emit("update", { request: "home" });
-        socket.on("update_home", (data) => {
-          resolve(data.update_data); // Resolve promise when data is received
-        });
-      });
-      setChartData((prevData) => ({
-        datasets: Object.keys(updateData).map((sensor, index) => {
-          // Find existing dataset for this sensor
-          const prevDataset = prevData?.datasets?.find((d) => d.label === sensor);
-
-          // Preserve previous data and add new entries from the array
-          const newEntries = [updateData[sensor]].map(entry => ({ x: new Date(entry.time * 1000).toISOString(), y: entry.value }));
-
-          // Preserve previous data and add new point
-          const newData = [...prevDataset.data, ...newEntries ];
-          // Keep only the latest 20 data points
-          if (newData.length > 100) {
-            newData.shift(); // Remove the oldest entry
-          }
-          return {
-            label: sensor,
-            data: newData,
+  // Append a pushed reading to the dataset of its sensor
+  const addReading = (reading) => {
+    const newEntry = { x: new Date(reading.time * 1000).toISOString(), y: reading.value };
+    setChartData((prevData) => {
+      const datasets = prevData?.datasets || [];
+      const prevDataset = datasets.find((d) => d.label === reading.sensor);
+      if (!prevDataset) {
+        const index = datasets.length;
+        return {
+          datasets: [...datasets, {
+            label: reading.sensor,
+            data: [newEntry],
             borderColor: `hsl(${index * 60}, 70%, 50%, 0.7)`,
             backgroundColor: `hsl(${index * 60}, 70%, 80%, 0.7)`,
             lineTension: 0.4,
-          };
+          }]
+        };
+      }
+      return {
+        datasets: datasets.map((dataset) => {
+          if (dataset !== prevDataset) return dataset;
+          // Preserve previous data and add the new point
+          const newData = [...dataset.data, newEntry];
+          // Keep only the latest 100 data points
+          if (newData.length > 100) {
+            newData.shift(); // Remove the oldest entry
+          }
+          return { ...dataset, data: newData };
         })
-      }));
-      // Optional: Reject the promise if there is an error with the socket event
-      // setTimeout(() => reject(new Error('Timeout waiting for data')), 5000); // 5-second timeout
-    } catch (error) {
-      console.error('Error fetching data:', error);
-      SpeechSynthesisErrorEvent('Something went wrong. Try again');
-    }
+      };
+    });
   };
 
   return (
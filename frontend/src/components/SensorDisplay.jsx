@@ -1,4 +1,4 @@
-import React, { useContext, useState, useEffect } from 'react';
+import React, { useContext, useState, useEffect, useRef } from 'react';
 import { Line } from 'react-chartjs-2';
 import { Chart as ChartJS, CategoryScale, LinearScale, TimeScale, Title, Tooltip, Legend,
   LineElement, PointElement,
@@ -29,6 +29,7 @@ const SensorDisplay = ({ inputSensor , onBackendReset }) => {
   const [CO2chartOptions, setCO2ChartOptions] = useState({});
   const [DOchartOptions, setDOChartOptions] = useState({});
   const [sensorData, setSensorData] = useState({ datasets : [] });
+  const latestValues = useRef({});
 
   // Web socket things
   useEffect(() => {
@@ -40,33 +41,25 @@ const SensorDisplay = ({ inputSensor , onBackendReset }) => {
     resetChartOptions( CO2rangeLow, CO2rangeHigh, DOrangeLow, DOrangeHigh );
     if (!socket) return;
     
-    // Function to handle async fetch data packet and sensor data
+    // Function to handle async fetch data packet and live readings
     const fetchData = async () => {
       try {
         // Fetch the packet data and await its completion
-        const read_frequency = await fetchSettings();
         await fetchDataPacket();
-        while (read_frequency == 0) {
-          continue
-        }
-        const intervalId = setInterval(fetchSensorData, read_frequency);
-        return () => {
-          clearInterval(intervalId);
-          socket.off("response");
-        };
+        // The server pushes one "reading" event per new reading of this sensor
+        socket.on("reading", addReading);
+        socket.emit("subscribe", { request: inputSensor._id });
       } catch (error) {
         console.error("Error in fetchData:", error);
       }
     };
     fetchData();
+    return () => {
+      socket.emit("unsubscribe", { request: inputSensor._id });
+      socket.off("reading", addReading);
+    };
   }, [socket]);
 
-  const fetchSettings = async () => {
-    const response = await fetch("http://127.0.0.1:5000/settings");
-    const data = await response.json();
-    return data.settings[0].read_frequency * 1000
-  };
-
   const resetChartOptions = ( CO2L, CO2H, DOL, DOH ) => {
     setCO2ChartOptions({
       /*plugins: {
@@ -152,9 +145,10 @@ const SensorDisplay = ({ inputSensor , onBackendReset }) => {
         datasets: [
           {
             label: sensor1Key,
-            data: sensor1Data.map((entry) => ({
-              x: new Date(entry.time * 1000).toISOString(),
-              y: entry.value,
+            // packets carry {time: [...], value: [...]} columns
+            data: sensor1Data.time.map((time, i) => ({
+              x: new Date(time * 1000).toISOString(),
+              y: sensor1Data.value[i],
             })),
             borderColor: 'rgba(75,192,192,1)',
             lineTension: 0.4,
@@ -171,9 +165,9 @@ const SensorDisplay = ({ inputSensor , onBackendReset }) => {
           },
           {
             label: sensor2Key,
-            data: sensor2Data.map((entry) => ({
-              x: new Date(entry.time * 1000).toISOString(),
-              y: entry.value,
+            data: sensor2Data.time.map((time, i) => ({
+              x: new Date(time * 1000).toISOString(),
+              y: sensor2Data.value[i],
             })),
             borderColor: 'rgba(75,192,192,1)',
             lineTension: 0.4,
@@ -199,81 +193,57 @@ const SensorDisplay = ({ inputSensor , onBackendReset }) => {
   });
   };
 
-  const fetchSensorData = async () => {
-    try {
-      const sensor = inputSensor
-      const sensor_id = sensor._id;
-      const updateData = await new Promise((resolve, reject) => {
-        socket.emit("update", { request: sensor_id });
-        socket.on(`update-${sensorName}`, (data) => {
-          resolve(data); // Resolve promise when data is received
-        });
+  // Append a data point to the dataset with the given label
+  const updateSensorDataset = (datasets, key, dataPoint) => {
+    const existingSensorData = datasets.find((dataset) => dataset.label === key);
+
+    if (existingSensorData) {
+      return datasets.map((dataset) => {
+        if (dataset.label === key) {
+          const newData = [...dataset.data, dataPoint];
+          if (newData.length > 100) newData.shift();
+          return { ...dataset, data: newData };
+        }
+        return dataset;
       });
-      const newData = updateData.update_data;
-      setSensorValueCO2(newData[`${sensorName}-CO2`].value);
-      setSensorValueDO(newData[`${sensorName}-DO`].value);
-      let tempCO2 = newData[`${sensorName}-CO2`].value;
-      let tempDO = newData[`${sensorName}-DO`].value;
-      let num1, num2, num3, num4;
-      num1 = CO2rangeLow < tempCO2 ? CO2rangeLow : tempCO2;
-      num2 = CO2rangeHigh > tempCO2 ? CO2rangeHigh : tempCO2;
-      num3 = DOrangeLow < tempDO ? DOrangeLow : tempDO;
-      num4 = DOrangeHigh > tempDO ? DOrangeHigh : tempDO;
-      resetChartOptions(num1, num2, num3, num4);
+    } else {
+      const newDataset = {
+        label: key,
+        data: [dataPoint],
+        borderColor: 'rgba(75,192,192,1)',
+        backgroundColor: 'rgba(75,192,192,0.2)',
+        pointBackgroundColor: 'blue',
+        pointBorderColor: 'blue',
+        lineTension: 0.4,
+      };
+      return [...datasets, newDataset];
+    }
+  };
 
-      const sensorKeys = Object.keys(newData);
-      const sensor1Key = sensorKeys[0];
-      const sensor2Key = sensorKeys[1];
+  // Handle a pushed reading, the socket is shared so skip other sensors
+  const addReading = (reading) => {
+    if (reading.id !== inputSensor._id) return;
+    latestValues.current[reading.measure] = reading.value;
+    if (reading.measure === "CO2") setSensorValueCO2(reading.value);
+    if (reading.measure === "DO") setSensorValueDO(reading.value);
 
-      const sensor1Data = newData[sensor1Key];
-      const sensor2Data = newData[sensor2Key];
+    // Grow the y axis to include readings outside the range
+    const tempCO2 = latestValues.current.CO2 ?? CO2rangeLow;
+    const tempDO = latestValues.current.DO ?? DOrangeLow;
+    let num1, num2, num3, num4;
+    num1 = CO2rangeLow < tempCO2 ? CO2rangeLow : tempCO2;
+    num2 = CO2rangeHigh > tempCO2 ? CO2rangeHigh : tempCO2;
+    num3 = DOrangeLow < tempDO ? DOrangeLow : tempDO;
+    num4 = DOrangeHigh > tempDO ? DOrangeHigh : tempDO;
+    resetChartOptions(num1, num2, num3, num4);
 
-      setSensorData((prevData) => {
-        const updateSensorDataset = (datasets, key, dataPoint) => {
-          const existingSensorData = datasets.find((dataset) => dataset.label === key);
-      
-          if (existingSensorData) {
-            return datasets.map((dataset) => {
-              if (dataset.label === key) {
-                const newData = [...dataset.data, dataPoint];
-                if (newData.length > 100) newData.shift();
-                return { ...dataset, data: newData };
-              }
-              return dataset;
-            });
-          } else {
-            const newDataset = {
-              label: key,
-              data: [dataPoint],
-              borderColor: 'rgba(75,192,192,1)',
-              backgroundColor: 'rgba(75,192,192,0.2)',
-              pointBackgroundColor: 'blue',
-              pointBorderColor: 'blue',
-              lineTension: 0.4,
-            };
-            return [...datasets, newDataset];
-          }
-        };
-      
-        const co2DataPoint = {
-          x: new Date(sensor1Data.time * 1000).toISOString(),
-          y: sensor1Data.value,
-        };
-      
-        const doDataPoint = {
-          x: new Date(sensor2Data.time * 1000).toISOString(),
-          y: sensor2Data.value,
-        };
-      
-        let updatedDatasets = prevData.datasets;
-        updatedDatasets = updateSensorDataset(updatedDatasets, sensor1Key, co2DataPoint);
-        updatedDatasets = updateSensorDataset(updatedDatasets, sensor2Key, doDataPoint);
-      
-        return { datasets: updatedDatasets };
-      });
-    } catch (error) {
-        console.error('Error fetching data:', error);
-    }
+    const dataPoint = {
+      x: new Date(reading.time * 1000).toISOString(),
+      y: reading.value,
+    };
+    setSensorData((prevData) => ({
+      datasets: updateSensorDataset(prevData.datasets, reading.sensor, dataPoint)
+    }));
   };
 
   // My attempt to fix the weird lag server issue